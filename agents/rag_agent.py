@@ -1,35 +1,148 @@
 from __future__ import annotations
+import re
+import uuid
 from dataclasses import dataclass
 from langchain_core.documents import Document
-from typing_extensions import List
-from langchain_openai import AzureChatOpenAI
+from typing_extensions import Annotated, List, Optional
 from langgraph.graph import StateGraph, MessagesState
-from langchain.messages import SystemMessage
+from langgraph.graph.message import add_messages
+from langchain.messages import AnyMessage, RemoveMessage, SystemMessage, ToolMessage
 from langchain_core.tools import tool
 from langgraph.graph import END
 from langgraph.prebuilt import ToolNode, tools_condition
-from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.runtime import Runtime
 from pydantic import BaseModel, Field
 import os
+import threading
+import time
 from utils.vector_store import get_vector_store
-from utils.groundedness import detect_groundness
+from utils.checkpointer import get_checkpointer, POSTGRES
+from utils.context_packer import ContextPacker
+from utils.constants import DocumentMetadata
+from utils.groundedness import check_groundedness
+from utils.logger import logger
+from utils.metrics import traced, count_outbound
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Retrieval modes: "agentic" lets the LLM decide whether to call the retrieve tool,
+# "retrieve-first" always retrieves from the latest human message (unless it is
+# small talk) and generates the answer with a single LLM call
+AGENTIC_MODE = "agentic"
+RETRIEVE_FIRST_MODE = "retrieve-first"
+RETRIEVAL_MODES = [AGENTIC_MODE, RETRIEVE_FIRST_MODE]
+DEFAULT_RETRIEVAL_MODE = os.getenv("RAG_AGENT_MODE", AGENTIC_MODE)
+
+# Words that make up greetings, thanks and goodbyes, which need no retrieval
+SMALL_TALK_WORDS = set(
+    "hi hello hey hiya there good morning afternoon evening night thanks thank you "
+    "very so much a lot many cheers bye goodbye see later".split()
+)
+SMALL_TALK_MAX_WORDS = 6
+
+# A message starts a new conversation if the thread was idle for longer than this, in seconds
+CHAT_SESSION_TIMEOUT = int(os.getenv("CHAT_SESSION_TIMEOUT", 60 * 60))
+
+# Number of recent conversation messages passed to the LLM; the state keeps at most
+# twice as many, older ones are dropped or, if enabled, folded into a summary
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", 10))
+CHAT_STATE_MAX_MESSAGES = 2 * CHAT_HISTORY_WINDOW
+CHAT_SUMMARY_ENABLED = os.getenv("CHAT_SUMMARY_ENABLED", "false").lower() == "true"
+
+# Number of chunks retrieved per query, and maximum number of tokens of retrieved
+# content passed to the LLM
+RETRIEVE_K = int(os.getenv("RETRIEVE_K", 8))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1000))
+
+dm = DocumentMetadata()
+context_packer = ContextPacker(token_budget=CONTEXT_TOKEN_BUDGET)
+
 
 @dataclass
 class ContextSchema:
     googleSheetId: str
 
 
-# Initialize the LLM client
-llm = AzureChatOpenAI(
-    azure_endpoint=os.environ["OPENAI_ENDPOINT"],
-    azure_deployment=os.environ["MODEL_CHAT"],
-    openai_api_version=os.environ["OPENAI_API_VERSION"],
-    temperature=0.2,
-)
+def is_conversation_message(message: AnyMessage) -> bool:
+    """Human messages and AI answers, i.e. no system prompts, tool calls or tool results."""
+    return message.type == "human" or (message.type == "ai" and not message.tool_calls)
+
+
+def bounded_messages(left: list, right: list) -> list:
+    """
+    Reducer that appends messages like add_messages, but keeps the state bounded:
+    only the latest system message, only the tool calls and results of the latest turn,
+    and at most CHAT_STATE_MAX_MESSAGES conversation messages. With summaries enabled,
+    conversation messages are only removed by summarize, once folded into the summary.
+    """
+    messages = add_messages(left, right)
+
+    last_system = max(
+        (ix for ix, message in enumerate(messages) if message.type == "system"),
+        default=None,
+    )
+    last_human = max(
+        (ix for ix, message in enumerate(messages) if message.type == "human"),
+        default=0,
+    )
+    conversation_ixs = [
+        ix for ix, message in enumerate(messages) if is_conversation_message(message)
+    ]
+    if not CHAT_SUMMARY_ENABLED:
+        conversation_ixs = conversation_ixs[-CHAT_STATE_MAX_MESSAGES:]
+
+    keep = set(conversation_ixs) | set(range(last_human, len(messages)))
+    keep.add(last_system)
+    return [
+        message
+        for ix, message in enumerate(messages)
+        if ix in keep and (message.type != "system" or ix == last_system)
+    ]
+
+
+class ChatState(MessagesState):
+    """Bounded conversation state, with an optional summary of older messages."""
+
+    messages: Annotated[list[AnyMessage], bounded_messages]
+    summary: str
+    # latest question that retrieved documents, and when (retrieve-first mode)
+    retrieved_query: str
+    retrieved_at: float
+
+
+def get_system_prompt_and_conversation(state: ChatState) -> tuple[str, list]:
+    """Get the latest system prompt, extended with the conversation summary if any,
+    and the recent conversation messages."""
+    system_prompt = next(
+        message.content
+        for message in reversed(state["messages"])
+        if message.type == "system"
+    )
+    if state.get("summary"):
+        system_prompt = f"{system_prompt}\n\nSummary of the earlier conversation: {state['summary']}"
+    conversation_messages = [
+        message for message in state["messages"] if is_conversation_message(message)
+    ][-CHAT_HISTORY_WINDOW:]
+    return system_prompt, conversation_messages
+
+
+_llm = None
+
+
+def get_llm():
+    """Initialize the LLM client on first use."""
+    global _llm
+    if _llm is None:
+        from langchain_openai import AzureChatOpenAI
+
+        _llm = AzureChatOpenAI(
+            azure_endpoint=os.environ["OPENAI_ENDPOINT"],
+            azure_deployment=os.environ["MODEL_CHAT"],
+            openai_api_version=os.environ["OPENAI_API_VERSION"],
+            temperature=0.2,
+        )
+    return _llm
 
 
 class RetrieveInput(BaseModel):
@@ -37,49 +150,117 @@ class RetrieveInput(BaseModel):
 
     query: str = Field(description="The search query to retrieve relevant documents.")
     googleSheetId: str = Field(description="The ID of the Google Sheet to search.")
+    categoryID: Optional[int] = Field(
+        None, description="Only search documents of this category ID, if given."
+    )
+    subcategoryID: Optional[int] = Field(
+        None, description="Only search documents of this subcategory ID, if given."
+    )
 
 
-# Retrieval tool
-@tool(response_format="content_and_artifact", args_schema=RetrieveInput)
-def retrieve(query: str, googleSheetId: str) -> tuple[str, List[Document]]:
-    """Retrieve information related to a query."""
+def retrieve_documents(
+    query: str,
+    googleSheetId: str,
+    categoryID: int = None,
+    subcategoryID: int = None,
+) -> tuple[str, List[Document]]:
+    """Retrieve documents related to a query (optionally of one category and/or subcategory) and pack them for the prompt."""
     vector_store = get_vector_store(googleSheetId)
-    retrieved_docs = vector_store.similarity_search(query, k=5)
-    serialized = "\n\n".join(f"Document: {doc.page_content}" for doc in retrieved_docs)
+    retrieved_docs = []
+    for doc, score in vector_store.similarity_search_with_score(
+        query, k=RETRIEVE_K, category_id=categoryID, subcategory_id=subcategoryID
+    ):
+        doc.metadata[dm.SCORE] = score
+        retrieved_docs.append(doc)
+    serialized = "\n\n".join(
+        f"Document: {text}" for text in context_packer.pack(retrieved_docs)
+    )
     return serialized, retrieved_docs
 
 
+def is_small_talk(message: str) -> bool:
+    """Cheap heuristic to detect greetings, thanks and goodbyes, which need no retrieval."""
+    words = re.findall(r"[a-z]+", message.lower())
+    return 0 < len(words) <= SMALL_TALK_MAX_WORDS and all(
+        word in SMALL_TALK_WORDS for word in words
+    )
+
+
+# Retrieval tool
+@tool(response_format="content_and_artifact", args_schema=RetrieveInput)
+@traced("graph.tools")
+def retrieve(
+    query: str,
+    googleSheetId: str,
+    categoryID: int = None,
+    subcategoryID: int = None,
+) -> tuple[str, List[Document]]:
+    """Retrieve information related to a query, optionally only of a category and/or subcategory."""
+    return retrieve_documents(query, googleSheetId, categoryID, subcategoryID)
+
+
 # Define retrieve-or-respond node
-def query_or_respond(state: MessagesState) -> dict:
+@traced("graph.query_or_respond")
+def query_or_respond(state: ChatState) -> dict:
     """Generate tool call for retrieval or respond."""
-    llm_with_tools = llm.bind_tools([retrieve])
+    llm_with_tools = get_llm().bind_tools([retrieve])
     # prompt = [SystemMessage(f"{rag_agent_prompt}")] + state["messages"]
     # response = llm_with_tools.invoke(prompt)
 
-    # Get most recent message of type system to use as system prompt
-    system_prompt = [
-        message.content
-        for message in reversed(state["messages"])
-        if message.type == "system"
-    ][0]
-
-    # Pass also recent conversation messages
-    conversation_messages = [
-        message
-        for message in state["messages"]
-        if message.type == "human" or (message.type == "ai" and not message.tool_calls)
-    ][-10:]
+    # Get most recent system prompt and recent conversation messages
+    system_prompt, conversation_messages = get_system_prompt_and_conversation(state)
 
     prompt = [SystemMessage(system_prompt)] + conversation_messages
 
+    count_outbound("openai_chat")
     response = llm_with_tools.invoke(prompt)
 
     # MessagesState appends messages to state instead of overwriting
     return {"messages": [response]}
 
 
+# Define retrieve-first node, used instead of query_or_respond in retrieve-first mode
+@traced("graph.retrieve_first")
+def retrieve_first(state: ChatState, runtime: Runtime[ContextSchema]) -> dict:
+    """Retrieve documents for the latest human message, without calling the LLM."""
+    questions = [
+        message.content for message in state["messages"] if message.type == "human"
+    ]
+    query = questions[-1]
+    if is_small_talk(query):
+        logger.info("Small talk detected, skipping retrieval.")
+        return {"messages": []}
+
+    # a short follow-up (e.g. "and the price?") of a question retrieved in the same
+    # session is searched along with that question
+    retrieved_query = query
+    if (
+        state.get("retrieved_query")
+        and len(query.split()) <= SMALL_TALK_MAX_WORDS
+        and time.time() - state.get("retrieved_at", 0) <= CHAT_SESSION_TIMEOUT
+    ):
+        retrieved_query = state["retrieved_query"]
+        query = f"{retrieved_query} {query}"
+
+    serialized, retrieved_docs = retrieve_documents(
+        query, runtime.context.googleSheetId
+    )
+    tool_message = ToolMessage(
+        content=serialized,
+        artifact=retrieved_docs,
+        name=retrieve.name,
+        tool_call_id=str(uuid.uuid4()),
+    )
+    return {
+        "messages": [tool_message],
+        "retrieved_query": retrieved_query,
+        "retrieved_at": time.time(),
+    }
+
+
 # Generate a response using the retrieved content.
-def generate(state: MessagesState):
+@traced("graph.generate")
+def generate(state: ChatState):
     """Generate answer."""
 
     # Get all docs recently retrieved
@@ -90,57 +271,135 @@ def generate(state: MessagesState):
         else:
             break
     tool_messages = recent_tool_messages[::-1]
-    docs = [doc.content for doc in tool_messages]
-    docs_content = "\n\n".join(docs)
 
-    # Get most recent message of type system to use as system prompt
-    system_prompt = [
-        message.content
-        for message in reversed(state["messages"])
-        if message.type == "system"
-    ][0]
+    # Merge, deduplicate and pack retrieved chunks of all tool calls within the token budget
+    if all(message.artifact for message in tool_messages):
+        # artifacts restored from a checkpoint may be serialized documents
+        docs = context_packer.pack(
+            [
+                doc if isinstance(doc, Document) else Document(**doc)
+                for message in tool_messages
+                for doc in message.artifact
+            ]
+        )
+        docs_content = "\n\n".join(f"Document: {doc}" for doc in docs)
+    else:
+        docs = [message.content for message in tool_messages]
+        docs_content = "\n\n".join(docs)
+
+    # Get most recent system prompt and recent conversation messages
+    system_prompt, conversation_messages = get_system_prompt_and_conversation(state)
 
     # Merge system prompt with retrieved docs
     system_prompt = f"{system_prompt}.\n\n{docs_content}"
 
-    # Pass also recent conversation messages
-    conversation_messages = [
-        message
-        for message in state["messages"]
-        if message.type == "human" or (message.type == "ai" and not message.tool_calls)
-    ][-10:]
     prompt = [SystemMessage(system_prompt)] + conversation_messages
 
     # Run
-    response = llm.invoke(prompt)
+    count_outbound("openai_chat")
+    response = get_llm().invoke(prompt)
 
-    # # Check groundedness
-    # user_query = conversation_messages[-1].content
-    # response.content = detect_groundness(
-    #     content_text=response.content, grounding_sources=docs, query=user_query
-    # )
+    # Check groundedness, within a latency budget (see GROUNDEDNESS_MODE)
+    if docs:
+        user_query = conversation_messages[-1].content
+        response.content = check_groundedness(
+            content_text=response.content, grounding_sources=docs, query=user_query
+        )
 
     return {"messages": [response]}
 
 
-# Define and build the agent graph
-DB_URI = f'postgresql://{os.environ["CHECKPOINT_DB_USER"]}:{os.environ["CHECKPOINT_DB_PASSWORD"]}@{os.environ["CHECKPOINT_DB_HOST"]}'
-_checkpointer_context = PostgresSaver.from_conn_string(DB_URI)
-checkpointer = _checkpointer_context.__enter__()
+# Fold conversation messages older than the history window into a summary
+@traced("graph.summarize")
+def summarize(state: ChatState) -> dict:
+    """Summarize older conversation messages once the state is full."""
+    conversation_messages = [
+        message for message in state["messages"] if is_conversation_message(message)
+    ]
+    if len(conversation_messages) < CHAT_STATE_MAX_MESSAGES:
+        return {}
+    old_messages = conversation_messages[:-CHAT_HISTORY_WINDOW]
+
+    summary_prompt = (
+        "Summarize the conversation below in a few sentences, keeping the facts about "
+        "the user and the questions asked."
+    )
+    if state.get("summary"):
+        summary_prompt += (
+            f" Extend this summary of the earlier conversation: {state['summary']}"
+        )
+    count_outbound("openai_chat")
+    response = get_llm().invoke([SystemMessage(summary_prompt)] + old_messages)
 
-tools = ToolNode([retrieve])
-graph_builder = StateGraph(MessagesState)
-graph_builder.add_node(query_or_respond)
-graph_builder.add_node(tools)
-graph_builder.add_node(generate)
+    return {
+        "summary": response.content,
+        "messages": [RemoveMessage(id=message.id) for message in old_messages],
+    }
+
+
+# Define and build the agent graphs
+
+
+def build_rag_agent(retrieval_mode: str, checkpointer: str = POSTGRES):
+    """Build and compile the agent graph for the given retrieval mode, with the given checkpointer."""
+    graph_builder = StateGraph(ChatState, context_schema=ContextSchema)
+    graph_builder.add_node(generate)
+    # every turn ends with summarize, if enabled, so that no message is dropped unsummarized
+    if CHAT_SUMMARY_ENABLED:
+        graph_builder.add_node(summarize)
+        graph_builder.add_edge("summarize", END)
+        end = "summarize"
+    else:
+        end = END
+
+    if retrieval_mode == AGENTIC_MODE:
+        # query_or_respond -> (tools -> generate) | END: two LLM calls per retrieval
+        tools = ToolNode([retrieve])
+        graph_builder.add_node(query_or_respond)
+        graph_builder.add_node(tools)
+
+        graph_builder.set_entry_point("query_or_respond")
+        graph_builder.add_conditional_edges(
+            "query_or_respond",
+            tools_condition,
+            {END: end, "tools": "tools"},
+        )
+        graph_builder.add_edge("tools", "generate")
+    elif retrieval_mode == RETRIEVE_FIRST_MODE:
+        # retrieve_first -> generate: a single LLM call per turn
+        graph_builder.add_node(retrieve_first)
+
+        graph_builder.set_entry_point("retrieve_first")
+        graph_builder.add_edge("retrieve_first", "generate")
+    else:
+        raise ValueError(
+            f"Retrieval mode {retrieval_mode} not available. Only {RETRIEVAL_MODES} are currently available."
+        )
+    graph_builder.add_edge("generate", end)
+
+    return graph_builder.compile(checkpointer=get_checkpointer(checkpointer))
+
+
+# Agent graphs are compiled on first use, so that importing this module does not connect to the database
+rag_agents = {}
+_rag_agents_lock = threading.Lock()
 
-graph_builder.set_entry_point("query_or_respond")
-graph_builder.add_conditional_edges(
-    "query_or_respond",
-    tools_condition,
-    {END: END, "tools": "tools"},
-)
-graph_builder.add_edge("tools", "generate")
-graph_builder.add_edge("generate", END)
 
-rag_agent = graph_builder.compile(checkpointer=checkpointer)
+def get_rag_agent(retrieval_mode: str = None, checkpointer: str = POSTGRES):
+    """
+    Get the agent graph for the given retrieval mode, or for the configured default one,
+    keeping its threads in the given checkpointer.
+    """
+    if not retrieval_mode:
+        retrieval_mode = DEFAULT_RETRIEVAL_MODE
+    if retrieval_mode not in RETRIEVAL_MODES:
+        logger.warning(
+            f"Retrieval mode {retrieval_mode} not available, using {AGENTIC_MODE}."
+        )
+        retrieval_mode = AGENTIC_MODE
+    key = (retrieval_mode, checkpointer)
+    if key not in rag_agents:
+        with _rag_agents_lock:
+            if key not in rag_agents:
+                rag_agents[key] = build_rag_agent(retrieval_mode, checkpointer)
+    return rag_agents[key]
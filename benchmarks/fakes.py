@@ -0,0 +1,549 @@
+"""
+Deterministic local stand-ins for the external services used by hia-search, for benchmarking:
+    1. Azure AI Search (index client, search client and the LangChain vector store)
+    2. Embeddings that return seeded vectors
+    3. Translator
+    4. Chat model with configurable latency
+    5. In-memory checkpointer
+    6. Redis client, for the shared cache
+All latencies are in seconds and are simulated with time.sleep, like blocking network calls.
+"""
+
+from __future__ import annotations
+import json
+import math
+import re
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any, Iterable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langgraph.checkpoint.memory import InMemorySaver
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+# Fields of indexes created by LangChain without explicit fields
+DEFAULT_FIELDS = ["id", "content", "content_vector", "metadata"]
+
+
+def default_fields() -> list:
+    return [SimpleNamespace(name=name, stored=None) for name in DEFAULT_FIELDS]
+
+
+class FakeIndexes:
+    """
+    In-memory search indexes, shared by all fake clients: index name -> {id: document},
+    and the fields and the vector search configuration of each index
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.fields = {}
+        self.vector_search = {}
+        self.lock = threading.Lock()
+
+    def get(
+        self,
+        name: str,
+        create: bool = False,
+        fields: list = None,
+        vector_search: Any = None,
+    ) -> Optional[dict]:
+        with self.lock:
+            if create and name not in self.indexes:
+                self.indexes[name] = {}
+                self.fields[name] = fields or default_fields()
+                self.vector_search[name] = vector_search
+            return self.indexes.get(name)
+
+    def delete(self, name: str):
+        with self.lock:
+            self.indexes.pop(name, None)
+            self.fields.pop(name, None)
+            self.vector_search.pop(name, None)
+
+
+# 'field/any()' (non-empty collection) or 'field/any(x: x eq value)'
+ANY_PATTERN = re.compile(r"^(\w+)/any\((?:(\w+): \2 eq ([^)]+))?\)")
+
+
+def matches(document: dict, filter: Optional[str]) -> bool:
+    """
+    Whether a document matches an OData filter of 'field eq value' and 'field/any(...)'
+    clauses joined by 'and' / 'or'
+    """
+    if not filter:
+        return True
+    for conjunction in filter.split(" or "):
+        if all(
+            _matches_clause(document, clause) for clause in conjunction.split(" and ")
+        ):
+            return True
+    return False
+
+
+def _parse_value(value: str):
+    if value == "null":
+        return None
+    if value.startswith("'"):
+        return value.strip("'").replace("''", "'")
+    return int(value)
+
+
+def _matches_clause(document: dict, clause: str) -> bool:
+    clause = clause.lstrip("( ")
+    match = ANY_PATTERN.match(clause)
+    if match:
+        field, _, value = match.groups()
+        values = document.get(field) or []
+        return bool(values) if value is None else _parse_value(value) in values
+    field, operator, value = clause.rstrip(") ").split(" ", 2)
+    if operator != "eq":
+        raise ValueError(f"Unsupported filter {clause}")
+    return document.get(field) == _parse_value(value)
+
+
+def select_fields(document: dict, select) -> dict:
+    """Only the selected fields of a document"""
+    if not select:
+        return dict(document)
+    fields = select if isinstance(select, list) else select.split(",")
+    return {field: document.get(field) for field in fields}
+
+
+INDEXES = FakeIndexes()
+
+
+class FakeSearchIndexClient:
+    """Stand-in for azure.search.documents.indexes.SearchIndexClient"""
+
+    latency = 0.0
+
+    def __init__(self, endpoint: str = None, credential: Any = None, **kwargs):
+        self.endpoint = endpoint
+
+    def create_index(self, index):
+        time.sleep(self.latency)
+        INDEXES.get(
+            index.name,
+            create=True,
+            fields=index.fields,
+            vector_search=index.vector_search,
+        )
+        return index
+
+    def create_or_update_index(self, index):
+        time.sleep(self.latency)
+        INDEXES.fields[index.name] = index.fields
+        INDEXES.vector_search[index.name] = index.vector_search
+        return index
+
+    def delete_index(self, index):
+        time.sleep(self.latency)
+        INDEXES.delete(getattr(index, "name", index))
+
+    def get_index(self, name: str):
+        time.sleep(self.latency)
+        if INDEXES.get(name) is None:
+            raise KeyError(f"Index {name} not found")
+        return SimpleNamespace(
+            name=name,
+            fields=INDEXES.fields[name],
+            vector_search=INDEXES.vector_search[name],
+        )
+
+
+class FakeSearchClient:
+    """Stand-in for azure.search.documents.SearchClient"""
+
+    latency = 0.0
+
+    def __init__(
+        self, endpoint: str = None, index_name: str = None, credential: Any = None
+    ):
+        self.endpoint = endpoint
+        self.index_name = index_name
+
+    def get_document_count(self) -> int:
+        time.sleep(self.latency)
+        return len(INDEXES.get(self.index_name) or {})
+
+    def search(
+        self,
+        search_text: str = None,
+        select: list = None,
+        filter: str = None,
+        order_by: list = None,
+        top: int = None,
+        skip: int = 0,
+        **kwargs,
+    ):
+        time.sleep(self.latency)
+        documents = [
+            doc
+            for doc in (INDEXES.get(self.index_name) or {}).values()
+            if matches(doc, filter)
+        ]
+        if order_by:
+            documents.sort(key=lambda doc: [doc.get(field) or 0 for field in order_by])
+        documents = documents[skip : skip + top if top else None]
+        return iter([select_fields(doc, select) for doc in documents])
+
+    def upload_documents(self, documents: list):
+        time.sleep(self.latency)
+        index = INDEXES.get(self.index_name, create=True)
+        for doc in documents:
+            index[doc["id"]] = dict(doc)
+        return [SimpleNamespace(key=doc["id"], succeeded=True) for doc in documents]
+
+
+class FakeAzureSearch:
+    """
+    Stand-in for langchain_community.vectorstores.azuresearch.AzureSearch,
+    with exact (brute-force) cosine similarity search
+    """
+
+    latency = 0.0
+
+    def __init__(
+        self,
+        azure_search_endpoint: str = None,
+        azure_search_key: str = None,
+        index_name: str = None,
+        embedding_function: Any = None,
+        fields: list = None,
+        vector_search: Any = None,
+        **kwargs,
+    ):
+        self.index_name = index_name
+        self.embedding_function = (
+            embedding_function.embed_query
+            if hasattr(embedding_function, "embed_query")
+            else embedding_function
+        )
+        self.fields = [field.name for field in fields] if fields else DEFAULT_FIELDS
+        INDEXES.get(index_name, create=True, fields=fields, vector_search=vector_search)
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable,
+        metadatas: Optional[List[dict]] = None,
+        keys: Optional[List[str]] = None,
+        **kwargs,
+    ) -> List[str]:
+        time.sleep(self.latency)
+        index = INDEXES.get(self.index_name, create=True)
+        ids = []
+        for ix, (text, embedding) in enumerate(text_embeddings):
+            key = keys[ix] if keys else str(uuid.uuid4())
+            metadata = metadatas[ix] if metadatas else {}
+            index[key] = {
+                "id": key,
+                "content": text,
+                "content_vector": list(embedding),
+                "metadata": json.dumps(metadata),
+            }
+            # like LangChain, metadata that are index fields are also stored as such
+            index[key].update(
+                {name: value for name, value in metadata.items() if name in self.fields}
+            )
+            ids.append(key)
+        return ids
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filters: str = None, select: list = None, **kwargs
+    ) -> List[tuple[Document, float]]:
+        embedding = np.asarray(self.embedding_function(query), dtype=np.float32)
+        time.sleep(self.latency)
+        documents = [
+            doc
+            for doc in (INDEXES.get(self.index_name) or {}).values()
+            if matches(doc, filters)
+        ]
+        if not documents:
+            return []
+        vectors = np.asarray([d["content_vector"] for d in documents], dtype=np.float32)
+        compressions = getattr(
+            INDEXES.vector_search.get(self.index_name), "compressions", None
+        )
+        if compressions:
+            # like Azure AI Search, search the quantized vectors, then rescore
+            rescoring = compressions[0].rescoring_options
+            top, scores = ScalarQuantizer(vectors).search(
+                embedding,
+                k,
+                vectors=vectors if rescoring and rescoring.enable_rescoring else None,
+                oversampling=(rescoring.default_oversampling or 1) if rescoring else 1,
+            )
+        else:
+            top, scores = exact_search(vectors, embedding, k)
+        return [
+            (
+                Document(
+                    page_content=documents[ix]["content"],
+                    metadata=self._to_metadata(documents[ix], select),
+                ),
+                float(score),
+            )
+            for ix, score in zip(top, scores)
+        ]
+
+    @staticmethod
+    def _to_metadata(document: dict, select: list = None) -> dict:
+        """Like LangChain, the JSON metadata if selected, else the other selected fields"""
+        document = select_fields(document, select)
+        if "metadata" in document:
+            return json.loads(document["metadata"])
+        return {
+            name: value
+            for name, value in document.items()
+            if name not in ["content", "content_vector"]
+        }
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [
+            doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)
+        ]
+
+
+def cosine_similarities(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    return (
+        vectors
+        @ query
+        / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+    )
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int) -> tuple:
+    """Indexes and cosine similarities of the k vectors most similar to the query"""
+    scores = cosine_similarities(vectors, query)
+    top = np.argsort(-scores)[:k]
+    return top, scores[top]
+
+
+class ScalarQuantizer:
+    """
+    int8 scalar quantization, like the compression of Azure AI Search: each dimension is
+    mapped linearly from its range over the indexed vectors to 256 levels, and searches
+    compare the query with the dequantized vectors
+    """
+
+    def __init__(self, vectors: np.ndarray):
+        self.minimum = vectors.min(axis=0)
+        self.step = np.maximum(vectors.max(axis=0) - self.minimum, 1e-12) / 255
+        self.codes = self.quantize(vectors)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the quantized vectors and of the range of each dimension"""
+        return self.codes.nbytes + self.minimum.nbytes + self.step.nbytes
+
+    def quantize(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.minimum) / self.step), 0, 255).astype(
+            np.uint8
+        )
+
+    def dequantize(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.step + self.minimum
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        vectors: np.ndarray = None,
+        oversampling: float = 1,
+    ) -> tuple:
+        """
+        Indexes and similarities of the k vectors most similar to the query. If the
+        full-precision vectors are given, k * oversampling candidates are found with the
+        quantized vectors and rescored with the full-precision ones.
+        """
+        top, scores = exact_search(
+            self.dequantize(self.codes), query, math.ceil(k * oversampling)
+        )
+        if vectors is None:
+            return top[:k], scores[:k]
+        rescored = cosine_similarities(vectors[top], query)
+        order = np.argsort(-rescored)[:k]
+        return top[order], rescored[order]
+
+
+class SeededEmbeddings(Embeddings):
+    """
+    Embeddings that return deterministic vectors: the normalized sum of a seeded random
+    vector per word, so that texts sharing words are similar. Simulates one API call
+    per batch of chunk_size texts.
+    """
+
+    def __init__(
+        self,
+        dimensions: int = 1536,
+        latency: float = 0.0,
+        chunk_size: int = 1,
+        seed: int = 0,
+        **kwargs,
+    ):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.n_calls = 0
+        self._word_vectors = {}
+        self._lock = threading.Lock()
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            rng = np.random.default_rng(zlib.crc32(word.encode()) + self.seed)
+            vector = rng.standard_normal(self.dimensions).astype(np.float32)
+            with self._lock:
+                self._word_vectors[word] = vector
+        return vector
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            vector += self._word_vector(word)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0], norm = 1.0, 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        n_batches = math.ceil(len(texts) / max(self.chunk_size, 1))
+        self.n_calls += n_batches
+        time.sleep(self.latency * n_batches)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.n_calls += 1
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeTranslator:
+    """Translator stub that returns texts unchanged and detects every text as English"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.n_calls = 0
+
+    def translate(self, from_lang: str, to_lang: str, text: str) -> str:
+        self.n_calls += 1
+        time.sleep(self.latency)
+        return text
+
+    def detect_language(self, text: str) -> str:
+        self.n_calls += 1
+        time.sleep(self.latency)
+        return "en"
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model with configurable latency. When tools are bound, it calls the first tool
+    (retrieve) for every user message, with the googleSheetId found in the system prompt;
+    otherwise it answers with a summary of the prompt it received.
+    """
+
+    latency: float = 0.0
+    tool_names: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools: list, **kwargs) -> "FakeChatModel":
+        return self.model_copy(
+            update={"tool_names": [getattr(t, "name", str(t)) for t in tools]}
+        )
+
+    def _generate(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        if self.tool_names and isinstance(messages[-1], HumanMessage):
+            system_prompt = " ".join(
+                m.content for m in messages if isinstance(m, SystemMessage)
+            )
+            match = re.search(r"googleSheetId is ([\w-]+)", system_prompt)
+            message = AIMessage(
+                content="",
+                tool_calls=[
+                    {
+                        "name": self.tool_names[0],
+                        "args": {
+                            "query": messages[-1].content,
+                            "googleSheetId": match.group(1) if match else "",
+                        },
+                        "id": f"call_{uuid.uuid4().hex}",
+                    }
+                ],
+            )
+        else:
+            n_chars = sum(len(str(m.content)) for m in messages)
+            message = AIMessage(
+                content=f"This is a generated answer based on {n_chars} characters of context."
+            )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class FakeCheckpointer(InMemorySaver):
+    """In-memory checkpointer that also supports pruning old checkpoints of a thread"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def prune_thread(self, thread_id: str, keep_last: int = 1):
+        with self.lock:
+            for checkpoint_ns, checkpoints in self.storage[thread_id].items():
+                for checkpoint_id in sorted(checkpoints)[:-keep_last]:
+                    checkpoints.pop(checkpoint_id, None)
+                    self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+    def expire_threads(self, max_idle: float) -> int:
+        """No thread is idle long enough during a benchmark"""
+        return 0
+
+
+@contextmanager
+def fake_checkpointer_from_conn_string(conn_string: str, **kwargs):
+    """Stand-in for PostgresSaver.from_conn_string"""
+    yield FakeCheckpointer()
+
+
+class FakeRedis:
+    """In-memory stand-in for the subset of the redis.Redis client used by utils.cache"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value, expires_at = self._values.get(key, (None, None))
+            if expires_at is not None and expires_at < time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key: str, value, ex: int = None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ex if ex else None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = int(self._values.get(key, (0, None))[0]) + 1
+            self._values[key] = (str(value).encode(), None)
+            return value
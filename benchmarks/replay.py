@@ -0,0 +1,216 @@
+"""
+Replay traffic captured by utils.traffic_capture against a running hia-search service,
+at the original rate or a scaled one, and report latency distributions and error rates.
+
+Usage (from the repository root):
+    python -m benchmarks.replay traffic.jsonl --base-url http://localhost:8000 --rate-scale 2 --concurrency 32
+
+Queries captured as hashes are replayed as placeholder texts of the same length.
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from benchmarks.run import summarize
+
+
+def load_records(path: str, limit: int = None) -> list:
+    """Load captured records, sorted by timestamp"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record["timestamp"])
+    return records[:limit] if limit else records
+
+
+def get_query(record: dict) -> str:
+    """Captured query text, or a placeholder of the same length if it was hashed"""
+    if "query" in record:
+        return record["query"]
+    placeholder = f"query {record.get('query_hash', '')} "
+    length = max(record.get("query_length", 0), 1)
+    return (placeholder * (length // len(placeholder) + 1))[:length]
+
+
+def query_params(**params) -> dict:
+    """Query parameters without the missing ones, for the endpoint to use its defaults
+    (httpx would send None as an empty string)"""
+    return {name: value for name, value in params.items() if value is not None}
+
+
+def build_request(record: dict, api_key: str) -> dict:
+    """HTTP request replaying a captured record, as keyword arguments of httpx.AsyncClient.post"""
+    endpoint = record["endpoint"]
+    query = get_query(record)
+    user = record.get("user") or "replay"
+    if endpoint == "/search":
+        payload = {
+            "query": query,
+            "googleSheetId": record["googleSheetId"],
+            "k": record.get("k", 5),
+            "lang": record.get("lang", "en"),
+        }
+        if record.get("googleSheetIds"):
+            payload["googleSheetIds"] = record["googleSheetIds"]
+        for field in ["categoryID", "subcategoryID"]:
+            if record.get(field) is not None:
+                payload[field] = record[field]
+        return {
+            "url": endpoint,
+            "json": payload,
+            "headers": {"Authorization": api_key},
+        }
+    if endpoint == "/chat-dummy":
+        return {
+            "url": endpoint,
+            "params": query_params(
+                googleSheetId=record["googleSheetId"], threadId=user
+            ),
+            "json": {"message": query},
+            "headers": {"Authorization": api_key},
+        }
+    if endpoint == "/chat-twilio-webhook":
+        return {
+            "url": endpoint,
+            "params": query_params(googleSheetId=record["googleSheetId"]),
+            "data": {"Body": query, "From": f"replay:{user}"},
+        }
+    raise ValueError(f"Cannot replay endpoint {endpoint}")
+
+
+async def replay(
+    records: list,
+    base_url: str,
+    api_key: str,
+    rate_scale: float,
+    concurrency: int,
+    timeout: float,
+) -> dict:
+    """
+    Send the captured requests, keeping their original spacing divided by rate_scale
+    (0 sends them as fast as possible), with at most concurrency requests in flight
+    """
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    errors = defaultdict(int)
+    # delay between the scheduled and actual send time, e.g. when concurrency is saturated
+    lags = []
+
+    async def send(client, record: dict, scheduled: float):
+        endpoint = record["endpoint"]
+        async with semaphore:
+            lags.append(time.perf_counter() - scheduled)
+            request_start = time.perf_counter()
+            try:
+                response = await client.post(**build_request(record, api_key))
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies[endpoint].append(time.perf_counter() - request_start)
+            statuses[endpoint][str(status)] += 1
+            if status != 200:
+                errors[endpoint] += 1
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+        start = time.perf_counter()
+        first_timestamp = records[0]["timestamp"]
+        tasks = []
+        for record in records:
+            scheduled = start
+            if rate_scale > 0:
+                scheduled += (record["timestamp"] - first_timestamp) / rate_scale
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            tasks.append(asyncio.create_task(send(client, record, scheduled)))
+        await asyncio.gather(*tasks)
+        wall_time = time.perf_counter() - start
+
+    report = {"endpoints": {}}
+    for endpoint in latencies:
+        result = summarize(latencies[endpoint], errors[endpoint], wall_time)
+        result["error_rate"] = round(errors[endpoint] / len(latencies[endpoint]), 4)
+        result["statuses"] = dict(statuses[endpoint])
+        report["endpoints"][endpoint] = result
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    report["total"] = summarize(all_latencies, sum(errors.values()), wall_time)
+    report["total"]["error_rate"] = round(
+        sum(errors.values()) / max(len(all_latencies), 1), 4
+    )
+    report["total"]["max_send_lag_ms"] = round(max(lags, default=0) * 1000, 3)
+    report["original_duration_s"] = round(records[-1]["timestamp"] - first_timestamp, 3)
+    return report
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture", help="JSONL file of captured traffic")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument(
+        "--api-key",
+        default=os.getenv("API_KEY"),
+        help="API key of the service (default: API_KEY environment variable)",
+    )
+    parser.add_argument(
+        "--rate-scale",
+        type=float,
+        default=1.0,
+        help="Speed-up of the original rate (2 = twice as fast, 0 = as fast as possible)",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Maximum requests in flight"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="Replay only the first N requests"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=120.0, help="Request timeout, in seconds"
+    )
+    parser.add_argument(
+        "--output", default=None, help="Path of the JSON results (default: stdout)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    records = load_records(args.capture, args.limit)
+    if not records:
+        sys.exit(f"No requests found in {args.capture}")
+    print(
+        f"Replaying {len(records)} requests against {args.base_url}...",
+        file=sys.stderr,
+    )
+    report = asyncio.run(
+        replay(
+            records,
+            args.base_url,
+            args.api_key,
+            args.rate_scale,
+            args.concurrency,
+            args.timeout,
+        )
+    )
+    report["config"] = {
+        key: value for key, value in vars(args).items() if key not in ["api_key"]
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
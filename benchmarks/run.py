@@ -0,0 +1,513 @@
+"""
+Offline benchmark of hia-search: measure throughput and latency percentiles of /search,
+/chat-dummy, /chat-twilio-webhook and create_vector_store_index at several concurrency
+levels and sheet sizes, with all external services replaced by local fakes (see fakes.py).
+The tiktoken encoding used for chunking is downloaded on first use: run it once with
+network access, or set TIKTOKEN_CACHE_DIR to a directory holding it.
+
+Usage (from the repository root):
+    python -m benchmarks.run --concurrency 1,4,16 --sheet-sizes 100,1000 --output benchmark.json
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Dummy credentials, so that no real service is ever called
+DUMMY_ENVIRONMENT = {
+    "API_KEY": "benchmark",
+    "API_KEY_WRITE": "benchmark-write",
+    "OPENAI_API_KEY": "benchmark",
+    "OPENAI_API_VERSION": "2024-06-01",
+    "OPENAI_ENDPOINT": "https://benchmark.openai.azure.com",
+    "MODEL_CHAT": "benchmark-chat",
+    "MODEL_EMBEDDINGS": "benchmark-embeddings",
+    "MODEL_GROUNDEDNESS": "benchmark-chat",
+    "VECTOR_STORE_ADDRESS": "https://benchmark.search.windows.net",
+    "VECTOR_STORE_PASSWORD": "benchmark",
+    "CHECKPOINT_DB_USER": "benchmark",
+    "CHECKPOINT_DB_PASSWORD": "benchmark",
+    "CHECKPOINT_DB_HOST": "localhost",
+    "MSCOGNITIVE_KEY": "benchmark",
+    "MSCOGNITIVE_LOCATION": "westeurope",
+    "AISAFETY_API_KEY": "benchmark",
+    "AISAFETY_ENDPOINT": "https://benchmark.cognitiveservices.azure.com",
+    "AISAFETY_API_VERSION": "2024-09-15-preview",
+    "APPLICATIONINSIGHTS_CONNECTION_STRING": "InstrumentationKey=00000000-0000-0000-0000-000000000000",
+    "GROUNDEDNESS_MODE": "off",
+}
+
+ENDPOINTS = ["search", "chat-dummy", "chat-twilio-webhook"]
+# Searches across several sheets, benchmarked only if requested with --endpoints
+MULTI_SEARCH_ENDPOINT = "search-multi"
+
+TOPICS = (
+    "visa residence permit asylum shelter housing health insurance doctor hospital "
+    "school education work permit job salary bank account transport train bus ticket "
+    "family reunification child benefit pregnancy vaccination mental health legal aid "
+    "lawyer police emergency food clothing money allowance language course registration"
+).split()
+FILLER = (
+    "the a to of and for you your can is are with in on at by if this that be will "
+    "need please contact more information about how when where what which apply"
+).split()
+
+
+def replace_everywhere(original, replacement, module_prefixes: tuple):
+    """Replace every reference to an object in the modules of this repository"""
+    for name, module in list(sys.modules.items()):
+        if module is None or not name.startswith(module_prefixes):
+            continue
+        for attribute, value in list(vars(module).items()):
+            if value is original:
+                setattr(module, attribute, replacement)
+
+
+def set_up(args: argparse.Namespace) -> dict:
+    """Set dummy credentials, replace all external services with local fakes and return the app and fakes"""
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+    os.environ.update(DUMMY_ENVIRONMENT)
+    os.environ["RAG_AGENT_MODE"] = args.mode
+
+    from benchmarks import fakes
+
+    # clients are created on first use, from the classes of the modules they come from
+    import langchain_openai
+    import langchain_community.vectorstores.azuresearch as azuresearch
+    from langgraph.checkpoint.postgres import PostgresSaver
+
+    PostgresSaver.from_conn_string = staticmethod(
+        fakes.fake_checkpointer_from_conn_string
+    )
+
+    import main
+    import agents.rag_agent
+    import utils.cache
+    import utils.prompt_loader
+    import utils.translator
+    import utils.vector_store
+    from azure.search.documents import SearchClient
+    from azure.search.documents.indexes import SearchIndexClient
+
+    logging.getLogger().setLevel(logging.WARNING)
+    repo_modules = ("main", "routes", "utils", "agents")
+
+    # vector store
+    fakes.FakeSearchClient.latency = args.search_latency
+    fakes.FakeSearchIndexClient.latency = args.search_latency
+    fakes.FakeAzureSearch.latency = args.search_latency
+    replace_everywhere(SearchClient, fakes.FakeSearchClient, repo_modules)
+    replace_everywhere(SearchIndexClient, fakes.FakeSearchIndexClient, repo_modules)
+    azuresearch.AzureSearch = fakes.FakeAzureSearch
+
+    # embeddings, shared by all vector stores like a remote embedding service
+    embeddings = fakes.SeededEmbeddings(
+        dimensions=args.embedding_dimensions,
+        latency=args.embedding_latency,
+        seed=args.seed,
+    )
+
+    def make_embeddings(*_args, chunk_size: int = 1, **_kwargs):
+        embeddings.chunk_size = chunk_size
+        return embeddings
+
+    langchain_openai.AzureOpenAIEmbeddings = make_embeddings
+
+    # chunking: the spaCy model may not be installed, fall back to the rule-based sentencizer
+    chunker_class = utils.vector_store.DocumentChunker
+    pipeline = args.spacy_pipeline
+
+    def make_chunker(chunking_strategy: str, **kwargs):
+        kwargs["kwargs"] = {**kwargs.get("kwargs", {}), "pipeline": pipeline}
+        return chunker_class(chunking_strategy, **kwargs)
+
+    utils.vector_store.DocumentChunker = make_chunker
+
+    # translator, behind the translations cache
+    translator = fakes.FakeTranslator(latency=args.translator_latency)
+    utils.translator._translate = translator.translate
+    utils.translator._detect_language = translator.detect_language
+
+    # shared cache
+    if args.cache_backend == "redis":
+        utils.cache.set_backend(utils.cache.RedisBackend(client=fakes.FakeRedis()))
+    elif args.cache_backend is not None:
+        utils.cache.CACHE_BACKEND = args.cache_backend
+
+    # chat settings sheet: not found, i.e. default prompt and retrieval mode
+    def load_no_chat_settings(self):
+        time.sleep(args.sheet_latency)
+        return None
+
+    utils.prompt_loader.PromptLoader._to_dataframe = load_no_chat_settings
+
+    # chat model
+    chat_model = fakes.FakeChatModel(latency=args.llm_latency)
+    agents.rag_agent.get_llm = lambda: chat_model
+
+    return {
+        "app": main.app,
+        "create_vector_store_index": utils.vector_store.create_vector_store_index,
+        "embeddings": embeddings,
+        "translator": translator,
+    }
+
+
+def make_sheet(n_rows: int, rng: random.Random) -> dict:
+    """Make HIA Q&As sheet data with n_rows questions, every 5th of which is a parent of the next 2"""
+    values = [
+        [
+            "#CATEGORY",
+            "#SUBCATEGORY",
+            "#SLUG",
+            "#PARENT",
+            "#QUESTION",
+            "#ANSWER",
+            "#VISIBLE",
+        ]
+    ]
+    parent = ""
+    for ix in range(n_rows):
+        topic = rng.sample(TOPICS, 3)
+        question = f"How do I get {' '.join(topic)} {rng.choice(FILLER)} {ix}?"
+        answer = " ".join(
+            " ".join(
+                rng.choice(TOPICS if rng.random() < 0.3 else FILLER)
+                for _ in range(rng.randint(8, 20))
+            ).capitalize()
+            + "."
+            for _ in range(rng.randint(2, 20))
+        )
+        slug = ""
+        if ix % 5 == 0:
+            slug = f"slug-{ix}"
+            parent = slug
+        values.append(
+            [
+                str(1 + ix // 50),
+                str(1 + ix // 10),
+                slug,
+                parent if ix % 5 in [1, 2] else "",
+                question,
+                answer,
+                "show",
+            ]
+        )
+    return {"values": values}
+
+
+def make_queries(sheet: dict, n_queries: int, rng: random.Random) -> list:
+    """Make queries similar to the questions of a sheet"""
+    questions = [row[4] for row in sheet["values"][1:]]
+    queries = []
+    for _ in range(n_queries):
+        words = rng.choice(questions).rstrip("?").split()
+        queries.append(" ".join(rng.sample(words, max(1, len(words) - 2))) + "?")
+    return queries
+
+
+def summarize(latencies: list, n_errors: int, wall_time: float) -> dict:
+    """Throughput and latency percentiles of a benchmark run, latencies in milliseconds"""
+    latencies_ms = np.asarray(latencies) * 1000
+    p50, p95, p99 = (
+        np.percentile(latencies_ms, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+    )
+    return {
+        "requests": len(latencies),
+        "errors": n_errors,
+        "wall_time_s": round(wall_time, 4),
+        "throughput_rps": round(len(latencies) / wall_time, 3) if wall_time else 0,
+        "latency_ms": {
+            "mean": round(float(latencies_ms.mean()), 3) if len(latencies) else 0,
+            "p50": round(float(p50), 3),
+            "p95": round(float(p95), 3),
+            "p99": round(float(p99), 3),
+            "max": round(float(latencies_ms.max()), 3) if len(latencies) else 0,
+        },
+    }
+
+
+def benchmark_ingestion(
+    create_vector_store_index, sheet_id: str, sheet: dict, repeats: int
+) -> dict:
+    """Time create_vector_store_index, replacing the index every time"""
+    latencies = []
+    n_errors = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        request_start = time.perf_counter()
+        try:
+            create_vector_store_index(
+                document_type="json", document_id=sheet_id, document_data=sheet
+            )
+        except Exception as e:
+            n_errors += 1
+            logging.error(f"Ingestion failed: {e}")
+        latencies.append(time.perf_counter() - request_start)
+    result = summarize(latencies, n_errors, time.perf_counter() - start)
+    result["rows_per_s"] = round(
+        (len(sheet["values"]) - 1) * len(latencies) / sum(latencies), 3
+    )
+    return result
+
+
+def build_request(
+    endpoint: str, sheet_id: str, query: str, user: str, sheet_ids: list = None
+) -> dict:
+    """HTTP request to an endpoint, as keyword arguments of httpx.AsyncClient.post"""
+    if endpoint == MULTI_SEARCH_ENDPOINT:
+        return {
+            "url": "/search",
+            "json": {"query": query, "googleSheetIds": sheet_ids, "k": 5, "lang": "en"},
+            "headers": {"Authorization": DUMMY_ENVIRONMENT["API_KEY"]},
+        }
+    if endpoint == "search":
+        return {
+            "url": "/search",
+            "json": {"query": query, "googleSheetId": sheet_id, "k": 5, "lang": "en"},
+            "headers": {"Authorization": DUMMY_ENVIRONMENT["API_KEY"]},
+        }
+    if endpoint == "chat-dummy":
+        return {
+            "url": "/chat-dummy",
+            "params": {"googleSheetId": sheet_id, "threadId": user},
+            "json": {"message": query},
+            "headers": {"Authorization": DUMMY_ENVIRONMENT["API_KEY"]},
+        }
+    if endpoint == "chat-twilio-webhook":
+        return {
+            "url": "/chat-twilio-webhook",
+            "params": {"googleSheetId": sheet_id},
+            "data": {"Body": query, "From": f"whatsapp:{user}"},
+        }
+    raise ValueError(f"Unknown endpoint {endpoint}")
+
+
+async def benchmark_endpoint(
+    app,
+    endpoint: str,
+    sheet_id: str,
+    queries: list,
+    concurrency: int,
+    turns: int,
+    sheet_ids: list = None,
+) -> dict:
+    """Send one request per query to an endpoint, with at most concurrency requests in flight"""
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def send(client, ix: int, query: str):
+        # consecutive queries of a user are turns of the same conversation
+        user = f"{endpoint}-{sheet_id}-{concurrency}-{ix // turns}"
+        request = build_request(endpoint, sheet_id, query, user, sheet_ids)
+        async with semaphore:
+            request_start = time.perf_counter()
+            response = await client.post(**request)
+            latencies.append(time.perf_counter() - request_start)
+            if response.status_code != 200:
+                errors.append(f"{response.status_code}: {response.text[:200]}")
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://benchmark", timeout=None
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[send(client, ix, query) for ix, query in enumerate(queries)]
+        )
+        wall_time = time.perf_counter() - start
+
+    result = summarize(latencies, len(errors), wall_time)
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def parse_list(value: str) -> list:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--concurrency",
+        type=lambda v: [int(c) for c in parse_list(v)],
+        default=[1, 4, 16],
+        help="Comma-separated concurrency levels",
+    )
+    parser.add_argument(
+        "--sheet-sizes",
+        type=lambda v: [int(s) for s in parse_list(v)],
+        default=[100, 1000],
+        help="Comma-separated numbers of questions per sheet",
+    )
+    parser.add_argument(
+        "--endpoints",
+        type=parse_list,
+        default=ENDPOINTS,
+        help="Comma-separated endpoints to benchmark",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=50, help="Requests per endpoint and level"
+    )
+    parser.add_argument(
+        "--regions",
+        type=int,
+        default=3,
+        help=f"Number of sheets searched at once by {MULTI_SEARCH_ENDPOINT}",
+    )
+    parser.add_argument(
+        "--turns", type=int, default=3, help="Chat turns per conversation"
+    )
+    parser.add_argument(
+        "--ingestion-repeats", type=int, default=3, help="Ingestions per sheet size"
+    )
+    parser.add_argument(
+        "--mode",
+        default="agentic",
+        help="Retrieval mode of the chat agent (agentic or retrieve-first)",
+    )
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--embedding-dimensions", type=int, default=1536)
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    parser.add_argument("--translator-latency", type=float, default=0.05)
+    parser.add_argument("--sheet-latency", type=float, default=0.2)
+    parser.add_argument(
+        "--spacy-pipeline",
+        default=None,
+        help="spaCy pipeline used for chunking, defaults to en_core_web_sm if installed, else sentencizer",
+    )
+    parser.add_argument(
+        "--cache-backend",
+        default=None,
+        help="Cache backend (memory, sqlite, redis or none); redis uses a local stand-in",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default=None, help="Path of the JSON results (default: stdout)"
+    )
+    args = parser.parse_args(argv)
+    if args.output:
+        args.output = str(Path(args.output).resolve())
+    if args.spacy_pipeline is None:
+        import spacy.util
+
+        args.spacy_pipeline = (
+            "en_core_web_sm"
+            if spacy.util.is_package("en_core_web_sm")
+            else "sentencizer"
+        )
+    return args
+
+
+def check_tokenizer():
+    """Fail early if the tiktoken encoding cannot be loaded, e.g. offline without a cache"""
+    import tiktoken
+    from utils.constants import TIKTOKEN_ENCODING
+
+    try:
+        tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception as e:
+        sys.exit(
+            f"Could not load the tiktoken encoding {TIKTOKEN_ENCODING} ({e}). Run once with "
+            "network access to cache it, or set TIKTOKEN_CACHE_DIR to a directory holding it."
+        )
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    services = set_up(args)
+    check_tokenizer()
+    rng = random.Random(args.seed)
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ["output"]
+        },
+        "ingestion": [],
+        "endpoints": [],
+    }
+
+    for sheet_size in args.sheet_sizes:
+        sheet_id = f"benchmark-sheet-{sheet_size}"
+        sheet = make_sheet(sheet_size, rng)
+        print(f"Ingesting sheet with {sheet_size} rows...", file=sys.stderr)
+        result = benchmark_ingestion(
+            services["create_vector_store_index"],
+            sheet_id,
+            sheet,
+            args.ingestion_repeats,
+        )
+        report["ingestion"].append({"sheet_size": sheet_size, **result})
+
+        # neighboring regions: copies of the sheet, searched together by search-multi
+        sheet_ids = [sheet_id]
+        if MULTI_SEARCH_ENDPOINT in args.endpoints:
+            for region in range(1, args.regions):
+                sheet_ids.append(f"{sheet_id}-region-{region}")
+                services["create_vector_store_index"](
+                    document_type="json", document_id=sheet_ids[-1], document_data=sheet
+                )
+
+        for concurrency in args.concurrency:
+            for endpoint in args.endpoints:
+                print(
+                    f"Benchmarking {endpoint} with {sheet_size} rows and concurrency {concurrency}...",
+                    file=sys.stderr,
+                )
+                queries = make_queries(sheet, args.requests, rng)
+                result = asyncio.run(
+                    benchmark_endpoint(
+                        services["app"],
+                        endpoint,
+                        sheet_id,
+                        queries,
+                        concurrency,
+                        args.turns,
+                        sheet_ids,
+                    )
+                )
+                report["endpoints"].append(
+                    {
+                        "endpoint": endpoint,
+                        "sheet_size": sheet_size,
+                        "concurrency": concurrency,
+                        **result,
+                    }
+                )
+
+    report["finished_at"] = datetime.now(timezone.utc).isoformat()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
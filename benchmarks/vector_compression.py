@@ -0,0 +1,148 @@
+"""
+Offline benchmark of vector compression: size of the vectors of a sheet's index and
+recall@k of its searches, with full-precision vectors and with int8 scalar quantization,
+without and with rescoring, and with or without a stored copy of the vectors.
+
+Usage (from the repository root):
+    python -m benchmarks.vector_compression --sheet sheet.json --queries queries.txt --embeddings huggingface --oversampling 1,2,4 --output compression.json
+
+Inputs are the same as for benchmarks.vector_search_sweep. Searches are exhaustive, with
+the local stand-in of Azure AI Search scalar quantization (fakes.ScalarQuantizer), so
+recall only reflects compression. Sizes count the vectors only, not the HNSW graph.
+"""
+
+from __future__ import annotations
+import argparse
+import sys
+
+import numpy as np
+
+from benchmarks.fakes import ScalarQuantizer, exact_search
+from benchmarks.run import parse_list
+from benchmarks.vector_search_sweep import (
+    add_input_arguments,
+    resolve_input_arguments,
+    embed_inputs,
+    recall,
+    write_report,
+)
+
+MB = 1024 * 1024
+
+
+def sizes(
+    vectors: np.ndarray, quantizer: ScalarQuantizer, compression: str, stored: bool
+) -> dict:
+    """
+    Size (MB) of the vector index, held in memory by the search units, and the storage
+    of the vectors: the vector index, the full-precision vectors kept for rescoring
+    compressed vectors, and the stored (retrievable) copy
+    """
+    full = vectors.nbytes
+    vector_index = full if compression == "none" else quantizer.nbytes
+    storage = vector_index + (full if compression != "none" else 0)
+    if stored:
+        storage += full
+    return {
+        "vector_index_mb": round(vector_index / MB, 3),
+        "storage_mb": round(storage / MB, 3),
+    }
+
+
+def evaluate(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    quantizer: ScalarQuantizer,
+    k: int,
+    oversampling: float = None,
+) -> float:
+    """Mean recall@k of searches of the quantized vectors, rescored if oversampling is given"""
+    recalls = []
+    for query in queries:
+        expected, _ = exact_search(vectors, query, k)
+        if oversampling is None:
+            found, _ = quantizer.search(query, k)
+        else:
+            found, _ = quantizer.search(
+                query, k, vectors=vectors, oversampling=oversampling
+            )
+        recalls.append(recall(found, expected))
+    return round(float(np.mean(recalls)), 4)
+
+
+def print_table(results: list):
+    print(
+        f"{'compression':<13}{'rescoring':>10}{'stored':>8}{'k':>4}{'recall':>8}"
+        f"{'index MB':>10}{'storage MB':>12}",
+        file=sys.stderr,
+    )
+    for result in results:
+        rescoring = result["oversampling"] if result["oversampling"] else "-"
+        print(
+            f"{result['compression']:<13}{rescoring:>10}{str(result['stored']):>8}"
+            f"{result['k']:>4}{result['recall']:>8.4f}"
+            f"{result['vector_index_mb']:>10.3f}{result['storage_mb']:>12.3f}",
+            file=sys.stderr,
+        )
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_input_arguments(parser)
+    parser.add_argument(
+        "--oversampling",
+        type=lambda v: [float(item) for item in parse_list(v)],
+        default=[1, 2, 4],
+        help="Comma-separated oversampling factors of rescoring",
+    )
+    parser.add_argument(
+        "--k",
+        type=lambda v: [int(item) for item in parse_list(v)],
+        default=[5, 8],
+    )
+    return resolve_input_arguments(parser.parse_args(argv))
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    vectors, query_vectors = embed_inputs(args)
+    quantizer = ScalarQuantizer(vectors)
+
+    results = []
+    for k in [k for k in args.k if k <= len(vectors)]:
+        variants = [("none", None, 1.0), ("scalar", None, None)]
+        variants += [
+            ("scalar", oversampling, None) for oversampling in args.oversampling
+        ]
+        for compression, oversampling, fixed_recall in variants:
+            if fixed_recall is None:
+                fixed_recall = evaluate(
+                    vectors, query_vectors, quantizer, k, oversampling
+                )
+            for stored in [True, False]:
+                results.append(
+                    {
+                        "compression": compression,
+                        "oversampling": oversampling,
+                        "stored": stored,
+                        "k": k,
+                        "recall": fixed_recall,
+                        **sizes(vectors, quantizer, compression, stored),
+                    }
+                )
+    print_table(results)
+
+    report = {
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ["output"]
+        },
+        "chunks": len(vectors),
+        "queries": len(query_vectors),
+        "dimensions": int(vectors.shape[1]),
+        "results": results,
+    }
+    write_report(args, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Offline sweep of vector search settings: build HNSW indexes of a sheet's chunks with
+several (m, efConstruction, efSearch) settings, search them with a query set, and report
+recall@k against exact (brute-force) cosine search, query latency and build time.
+
+Usage (from the repository root):
+    python -m benchmarks.vector_search_sweep --sheet sheet.json --queries queries.txt --embeddings huggingface --m 4,8 --ef-search 100,500 --output sweep.json
+
+The sheet is JSON data as accepted by /create-vector-store, or a Google Sheet ID
+(--google-sheet-id); it is chunked like at ingestion. Queries are one per line, or
+traffic captured by utils.traffic_capture in text mode. Without a sheet or queries, a
+synthetic sheet and queries are used. Indexes are built with hnswlib
+(pip install hnswlib), which implements the same algorithm and parameters as the HNSW
+of Azure AI Search: recalls are representative, latencies and build times are local
+and single-threaded, so compare them with each other.
+"""
+
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.run import (
+    ROOT,
+    DUMMY_ENVIRONMENT,
+    make_sheet,
+    make_queries,
+    parse_list,
+    summarize,
+)
+
+
+def load_chunks(args: argparse.Namespace, sheet: dict) -> list:
+    """Load the sheet and chunk it like create_vector_store_index, return the texts of the chunks"""
+    from utils.document_loader import DocumentLoader
+    from utils.document_chunker import DocumentChunker
+    from utils.vector_store import CHUNKING_STRATEGY, CHUNKING_KWARGS
+
+    if args.google_sheet_id:
+        loader = DocumentLoader(
+            document_type="googlesheet",
+            document_id=args.google_sheet_id,
+            document_data={},
+        )
+    else:
+        loader = DocumentLoader(
+            document_type="json", document_id="sweep", document_data=sheet
+        )
+    chunker = DocumentChunker(
+        chunking_strategy=CHUNKING_STRATEGY,
+        kwargs={**CHUNKING_KWARGS, "pipeline": args.spacy_pipeline},
+    )
+    return [doc.page_content for doc in chunker.split_documents(loader.load())]
+
+
+def load_queries(path: str) -> list:
+    """Queries of a text file, one per line, or of captured traffic (JSONL with a query)"""
+    queries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                if record.get("query"):
+                    queries.append(record["query"])
+            else:
+                queries.append(line)
+    return queries
+
+
+def get_embeddings(args: argparse.Namespace):
+    """Embedding model: seeded (synthetic, no model needed), huggingface or openai"""
+    if args.embeddings == "seeded":
+        from benchmarks.fakes import SeededEmbeddings
+
+        return SeededEmbeddings(dimensions=args.embedding_dimensions, seed=args.seed)
+    if args.embeddings == "huggingface":
+        from utils.local_embeddings import get_local_embeddings
+        from utils.vector_store import DEFAULT_HUGGING_FACE_MODEL
+
+        return get_local_embeddings(
+            os.getenv("MODEL_EMBEDDINGS_LOCAL", DEFAULT_HUGGING_FACE_MODEL)
+        )
+    from langchain_openai import AzureOpenAIEmbeddings
+    from utils.vector_store import OPENAI_EMBEDDING_CHUNK_SIZE
+
+    return AzureOpenAIEmbeddings(
+        azure_endpoint=os.environ["OPENAI_ENDPOINT"],
+        deployment=os.environ["MODEL_EMBEDDINGS"],
+        chunk_size=OPENAI_EMBEDDING_CHUNK_SIZE,
+    )
+
+
+def normalize(vectors: list) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    """IDs of the k most similar vectors (cosine), by brute force"""
+    scores = vectors @ query
+    top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    return len(set(found.tolist()) & set(expected.tolist())) / len(expected)
+
+
+def sweep_exhaustive(vectors: np.ndarray, queries: np.ndarray, k: int) -> dict:
+    """Exhaustive KNN: exact, so recall is 1; only latency is measured"""
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        exact_search(vectors, query, k)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "algorithm": "exhaustive",
+        "k": k,
+        "recall": 1.0,
+        "latency_ms": summarize(latencies, 0, sum(latencies))["latency_ms"],
+        "build_time_s": 0.0,
+    }
+
+
+def sweep_hnsw(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    ground_truth: dict,
+    m: int,
+    ef_construction: int,
+    ef_searches: list,
+    ks: list,
+    seed: int,
+) -> list:
+    """Build one HNSW index, then search it with each efSearch and k"""
+    try:
+        import hnswlib
+    except ImportError:
+        sys.exit("The sweep requires hnswlib: pip install hnswlib")
+
+    index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+    start = time.perf_counter()
+    index.init_index(
+        max_elements=len(vectors),
+        M=m,
+        ef_construction=ef_construction,
+        random_seed=seed,
+    )
+    index.add_items(vectors, np.arange(len(vectors)), num_threads=1)
+    build_time = time.perf_counter() - start
+
+    results = []
+    for ef_search, k in itertools.product(ef_searches, ks):
+        # hnswlib, like Azure AI Search, keeps at least k candidates
+        index.set_ef(max(ef_search, k))
+        latencies, recalls = [], []
+        for ix, query in enumerate(queries):
+            start = time.perf_counter()
+            labels, _ = index.knn_query(query, k=k, num_threads=1)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(recall(labels[0], ground_truth[k][ix]))
+        results.append(
+            {
+                "algorithm": "hnsw",
+                "m": m,
+                "ef_construction": ef_construction,
+                "ef_search": ef_search,
+                "k": k,
+                "recall": round(float(np.mean(recalls)), 4),
+                "latency_ms": summarize(latencies, 0, sum(latencies))["latency_ms"],
+                "build_time_s": round(build_time, 4),
+            }
+        )
+    return results
+
+
+def print_table(results: list):
+    print(
+        f"{'algorithm':<11}{'m':>4}{'efC':>6}{'efS':>6}{'k':>4}{'recall':>8}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'build s':>9}",
+        file=sys.stderr,
+    )
+    for result in results:
+        print(
+            f"{result['algorithm']:<11}{result.get('m', ''):>4}"
+            f"{result.get('ef_construction', ''):>6}{result.get('ef_search', ''):>6}"
+            f"{result['k']:>4}{result['recall']:>8.4f}"
+            f"{result['latency_ms']['p50']:>9.3f}{result['latency_ms']['p95']:>9.3f}"
+            f"{result['build_time_s']:>9.3f}",
+            file=sys.stderr,
+        )
+
+
+def add_input_arguments(parser: argparse.ArgumentParser):
+    """Arguments of the sheet, queries and embedding model, shared with vector_compression"""
+    parser.add_argument(
+        "--sheet", default=None, help="Path of the sheet data (JSON), or synthetic"
+    )
+    parser.add_argument(
+        "--google-sheet-id", default=None, help="Google Sheet to download instead"
+    )
+    parser.add_argument(
+        "--sheet-size",
+        type=int,
+        default=1000,
+        help="Number of questions of the synthetic sheet",
+    )
+    parser.add_argument(
+        "--queries", default=None, help="Path of the queries, or synthetic"
+    )
+    parser.add_argument(
+        "--n-queries", type=int, default=200, help="Number of synthetic queries"
+    )
+    parser.add_argument(
+        "--embeddings",
+        choices=["seeded", "huggingface", "openai"],
+        default="seeded",
+        help="Embedding model; openai uses OPENAI_ENDPOINT and MODEL_EMBEDDINGS",
+    )
+    parser.add_argument("--embedding-dimensions", type=int, default=1536)
+    parser.add_argument("--spacy-pipeline", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default=None, help="Path of the JSON results (default: stdout)"
+    )
+
+
+def resolve_input_arguments(args: argparse.Namespace) -> argparse.Namespace:
+    """Resolve paths before changing to the repository root, and the spaCy pipeline"""
+    if args.output:
+        args.output = str(Path(args.output).resolve())
+    if args.sheet:
+        args.sheet = str(Path(args.sheet).resolve())
+    if args.queries:
+        args.queries = str(Path(args.queries).resolve())
+    if args.spacy_pipeline is None:
+        import spacy.util
+
+        args.spacy_pipeline = (
+            "en_core_web_sm"
+            if spacy.util.is_package("en_core_web_sm")
+            else "sentencizer"
+        )
+    return args
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_input_arguments(parser)
+    int_list = lambda v: [int(item) for item in parse_list(v)]
+    parser.add_argument("--m", type=int_list, default=[4, 6, 8, 10])
+    parser.add_argument("--ef-construction", type=int_list, default=[100, 400])
+    parser.add_argument("--ef-search", type=int_list, default=[100, 200, 500])
+    parser.add_argument("--k", type=int_list, default=[5, 8])
+    return resolve_input_arguments(parser.parse_args(argv))
+
+
+def embed_inputs(args: argparse.Namespace) -> tuple:
+    """Chunk the sheet and embed its chunks and the queries, return normalized vectors"""
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+    # without translator credentials, e.g. for the synthetic sheet, texts are not translated
+    fake_translator = "MSCOGNITIVE_KEY" not in os.environ
+    # only the settings missing from the environment
+    for key, value in DUMMY_ENVIRONMENT.items():
+        os.environ.setdefault(key, value)
+    if fake_translator:
+        import utils.translator
+        from benchmarks.fakes import FakeTranslator
+
+        translator = FakeTranslator(latency=0.0)
+        utils.translator._translate = translator.translate
+        utils.translator._detect_language = translator.detect_language
+    rng = random.Random(args.seed)
+
+    if args.sheet:
+        with open(args.sheet) as f:
+            sheet = json.load(f)
+    else:
+        sheet = make_sheet(args.sheet_size, rng)
+    print("Chunking sheet...", file=sys.stderr)
+    chunks = load_chunks(args, sheet)
+    if args.queries:
+        queries = load_queries(args.queries)
+    else:
+        queries = make_queries(sheet, args.n_queries, rng)
+
+    print(
+        f"Embedding {len(chunks)} chunks and {len(queries)} queries...",
+        file=sys.stderr,
+    )
+    embeddings = get_embeddings(args)
+    vectors = normalize(embeddings.embed_documents(chunks))
+    query_vectors = normalize(embeddings.embed_documents(queries))
+    return vectors, query_vectors
+
+
+def write_report(args: argparse.Namespace, report: dict):
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    vectors, query_vectors = embed_inputs(args)
+    ks = [k for k in args.k if k <= len(vectors)]
+    ground_truth = {
+        k: [exact_search(vectors, query, k) for query in query_vectors] for k in ks
+    }
+
+    results = [sweep_exhaustive(vectors, query_vectors, k) for k in ks]
+    for m, ef_construction in itertools.product(args.m, args.ef_construction):
+        print(
+            f"Building HNSW index with m={m}, efConstruction={ef_construction}...",
+            file=sys.stderr,
+        )
+        results += sweep_hnsw(
+            vectors,
+            query_vectors,
+            ground_truth,
+            m,
+            ef_construction,
+            args.ef_search,
+            ks,
+            args.seed,
+        )
+    print_table(results)
+
+    report = {
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ["output"]
+        },
+        "chunks": len(vectors),
+        "queries": len(query_vectors),
+        "dimensions": int(vectors.shape[1]),
+        "results": results,
+    }
+    write_report(args, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,33 @@
 from __future__ import annotations
+import time
+
+# measure startup time from the first import
+STARTUP_START = time.perf_counter()
+
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import (
     FastAPI,
+    Request,
 )
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from routes import search, data, chat
+from routes import search, data, chat, profiles
 import os
-import logging
-import sys
-
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s : %(levelname)s : %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger("azure").setLevel(logging.WARNING)
-logging.getLogger("requests_oauthlib").setLevel(logging.WARNING)
 from dotenv import load_dotenv
+from utils.logger import logger, set_up_log_export
+from utils.metrics import (
+    REQUEST_DURATION,
+    STAGE_DURATION,
+    render_metrics,
+    set_up_telemetry,
+)
+from utils.checkpointer import close_checkpointer
+from utils.warmup import warm_up, WARMUP_ENABLED
+from utils.prewarm import schedule_prewarm
+from utils.traffic_capture import TrafficCaptureMiddleware, TRAFFIC_CAPTURE_ENABLED
+from utils.profiler import ProfilerMiddleware, PROFILER_ENABLED
 
 load_dotenv()
 
@@ -55,8 +61,31 @@ tags_metadata = [
         "name": "models",
         "description": "Get information on the AI models used.",
     },
+    {
+        "name": "profiles",
+        "description": "Get the profiles of slow requests.",
+    },
 ]
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up telemetry and, if enabled, warm up before accepting traffic and prewarm caches after; close connections on shutdown."""
+    set_up_log_export()
+    set_up_telemetry()
+    if WARMUP_ENABLED:
+        await run_in_threadpool(warm_up)
+    startup_duration = time.perf_counter() - STARTUP_START
+    STAGE_DURATION.record(startup_duration, stage="startup")
+    logger.info(f"Started in {startup_duration:.2f}s, ready to accept traffic.")
+    app.state.ready = True
+    # runs in the background, while serving traffic
+    schedule_prewarm()
+    yield
+    app.state.ready = False
+    close_checkpointer()
+
+
 # initialize FastAPI
 app = FastAPI(
     title="hia-search",
@@ -67,7 +96,9 @@ app = FastAPI(
         "url": "https://www.gnu.org/licenses/agpl-3.0.en.html",
     },
     openapi_tags=tags_metadata,
+    lifespan=lifespan,
 )
+app.state.ready = False
 
 app.add_middleware(
     CORSMiddleware,
@@ -77,6 +108,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# record the shape of search and chat requests, to replay them in load tests
+if TRAFFIC_CAPTURE_ENABLED:
+    app.add_middleware(TrafficCaptureMiddleware)
+
+# profile search and chat requests on demand, or a sample of them
+if PROFILER_ENABLED:
+    app.add_middleware(ProfilerMiddleware)
+
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    """Record the duration of each request, by route and status code."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_DURATION.record(
+        time.perf_counter() - start,
+        path=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    return response
+
 
 @app.get("/", include_in_schema=False)
 async def docs_redirect():
@@ -88,6 +141,7 @@ async def docs_redirect():
 app.include_router(search.router)
 app.include_router(data.router)
 app.include_router(chat.router)
+app.include_router(profiles.router)
 
 
 @app.get("/get-models", tags=["models"])
@@ -103,5 +157,25 @@ async def get_models():
     )
 
 
+@app.get("/health", include_in_schema=False)
+async def health():
+    """Liveness: the process is up and serving requests."""
+    return {"status": "ok"}
+
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """Readiness: startup (and warmup, if enabled) is complete."""
+    if not app.state.ready:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Stage latencies, cache lookups and outbound calls in Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=int(port), reload=True)
@@ -2,27 +2,77 @@ from __future__ import annotations
 
 from fastapi import Depends, Request, Response, APIRouter, HTTPException
 from fastapi.security import APIKeyHeader
+from starlette.concurrency import run_in_threadpool
 from twilio.twiml.messaging_response import MessagingResponse
-from langchain.messages import SystemMessage, HumanMessage
+from langchain.messages import AIMessage, SystemMessage, HumanMessage
 from pydantic import BaseModel, Field
 from utils.vector_store import get_vector_store
-from agents.rag_agent import rag_agent
-from utils.logger import logger
+from agents.rag_agent import (
+    get_rag_agent,
+    ContextSchema,
+    CHAT_SUMMARY_ENABLED,
+    CHAT_SESSION_TIMEOUT,
+)
+from utils.logger import query_logger
 from utils.prompt_loader import PromptLoader
+from utils.checkpointer import (
+    schedule_prune_thread,
+    POSTGRES,
+    CHECKPOINTER_CHAT_TWILIO,
+    CHECKPOINTER_CHAT_DUMMY,
+)
+from utils.answer_cache import answer_cache, get_prompt_version, ANSWER_CACHE_ENABLED
+from utils.profiler import profiled
+from utils.admission import admission, estimate_tokens, ADMISSION_COMPLETION_TOKENS
+from collections import OrderedDict
+from datetime import datetime, timezone
 import os
 import hashlib
+import threading
+import time
 from utils.translator import translate, detect_language
 
 router = APIRouter()
 
 key_query_scheme = APIKeyHeader(name="Authorization")
 
-
-def chat(threadId: str, googleSheetId: str, message: str) -> dict:
-    """Core chat function used by multiple endpoints."""
+# Threads with a turn on this worker, most recent last: a thread seen within
+# CHAT_SESSION_TIMEOUT is not on its first turn, which saves reading its checkpoint
+RECENT_THREADS_MAX_SIZE = 10000
+_recent_threads = OrderedDict()
+_recent_threads_lock = threading.Lock()
+
+
+def record_turn(thread_id: str):
+    """Remember that a thread had a turn on this worker."""
+    with _recent_threads_lock:
+        _recent_threads[thread_id] = time.monotonic()
+        _recent_threads.move_to_end(thread_id)
+        while len(_recent_threads) > RECENT_THREADS_MAX_SIZE:
+            _recent_threads.popitem(last=False)
+
+
+def is_first_turn(rag_agent, config: dict) -> bool:
+    """Check if the thread is new, or idle for longer than CHAT_SESSION_TIMEOUT."""
+    last_turn = _recent_threads.get(config["configurable"]["thread_id"])
+    if last_turn is not None and time.monotonic() - last_turn <= CHAT_SESSION_TIMEOUT:
+        return False
+    state = rag_agent.get_state(config)
+    if not state.values.get("messages") or state.created_at is None:
+        return True
+    idle = datetime.now(timezone.utc) - datetime.fromisoformat(state.created_at)
+    return idle.total_seconds() > CHAT_SESSION_TIMEOUT
+
+
+# sample the thread running the chat if the request is profiled
+@profiled()
+def chat(
+    threadId: str, googleSheetId: str, message: str, checkpointer: str = POSTGRES
+) -> dict:
+    """Core chat function used by multiple endpoints, each with its own checkpointer."""
 
     # check if vector store exists for the given googleSheetId (if it doesn't, it will be created)
-    _ = get_vector_store(googleSheetId, check_if_exists=True)
+    vector_store = get_vector_store(googleSheetId, check_if_exists=True)
 
     # translate message to English if needed
     detected_lang = detect_language(message)
@@ -40,17 +90,62 @@ def chat(threadId: str, googleSheetId: str, message: str) -> dict:
         with open("config/rag_agent_prompt.txt", "r") as f:
             prompt = f.read()
 
-    # invoke the agent graph with the question
-    response = rag_agent.invoke(
-        {
-            "messages": [
-                SystemMessage(prompt + f" googleSheetId is {googleSheetId}."),
-                HumanMessage(message),
-            ]
-        },
-        config={"configurable": {"thread_id": threadId}},
-    )
-    response_text = response["messages"][-1].content
+    # get the agent graph for the retrieval mode of this sheet, or the default one
+    rag_agent = get_rag_agent(prompt_loader.get_retrieval_mode(), checkpointer)
+    config = {"configurable": {"thread_id": threadId}}
+    system_message = SystemMessage(prompt + f" googleSheetId is {googleSheetId}.")
+
+    # answer the first question of a conversation from the cache, if a similar one was answered before
+    response_text = None
+    use_answer_cache = ANSWER_CACHE_ENABLED and is_first_turn(rag_agent, config)
+    if use_answer_cache:
+        prompt_version = get_prompt_version(system_message.content)
+        embedding = vector_store.embed_query(message)
+        response_text = answer_cache.get(googleSheetId, prompt_version, embedding)
+        if response_text is not None:
+            # add the cached answer to the thread, for the agent to remember the conversation,
+            # as written by the last node of a turn so that the next turn starts afresh
+            rag_agent.update_state(
+                config,
+                {
+                    "messages": [
+                        system_message,
+                        HumanMessage(message),
+                        AIMessage(response_text),
+                    ]
+                },
+                as_node="summarize" if CHAT_SUMMARY_ENABLED else "generate",
+            )
+
+    if response_text is None:
+        # wait for the sheet's and the global Azure OpenAI budget, or fail with 429
+        admission.admit(
+            googleSheetId,
+            tokens=estimate_tokens(system_message.content + message)
+            + ADMISSION_COMPLETION_TOKENS,
+        )
+        # invoke the agent graph with the question
+        response = rag_agent.invoke(
+            {
+                "messages": [
+                    system_message,
+                    HumanMessage(message),
+                ]
+            },
+            config=config,
+            context=ContextSchema(googleSheetId=googleSheetId),
+        )
+        response_text = response["messages"][-1].content
+
+        if use_answer_cache:
+            answer_cache.put(
+                googleSheetId, prompt_version, embedding, message, response_text
+            )
+
+    # drop old checkpoint versions of this thread, only the latest state is needed, and idle threads
+    schedule_prune_thread(threadId, checkpointer)
+    if ANSWER_CACHE_ENABLED:
+        record_turn(threadId)
 
     # translate response back to original language if needed
     if detected_lang != "en":
@@ -75,11 +170,16 @@ async def chat_twilio_webhook(
     # use the hashed phone number or channel address that sent this message as memory thread ID
     threadId = hashlib.sha256(form_data.get("From").encode()).hexdigest()
 
-    response_text = chat(threadId, googleSheetId, message)
+    # run the blocking chat in the threadpool, not to block the event loop
+    response_text = await run_in_threadpool(
+        chat, threadId, googleSheetId, message, CHECKPOINTER_CHAT_TWILIO
+    )
 
     # log user message and assistant response
     extra_logs = {"googleSheetId": googleSheetId, "threadId": threadId}
-    logger.info(f"user: {message}, assistant: {response_text}", extra=extra_logs)
+    query_logger.info(
+        "user: %s, assistant: %s", message, response_text, extra=extra_logs
+    )
 
     # return TwiML response
     resp = MessagingResponse()
@@ -112,6 +212,8 @@ async def chat_dummy(
     if threadId is None:
         threadId = hashlib.sha256(str(request.client.host).encode()).hexdigest()
 
-    response_text = chat(threadId, googleSheetId, payload.message)
+    response_text = await run_in_threadpool(
+        chat, threadId, googleSheetId, payload.message, CHECKPOINTER_CHAT_DUMMY
+    )
 
     return {"response": response_text}
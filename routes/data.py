@@ -1,16 +1,39 @@
 from __future__ import annotations
+import tempfile
 from fastapi import (
     Depends,
     APIRouter,
     HTTPException,
+    File,
+    Form,
+    UploadFile,
 )
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.security import APIKeyHeader
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
+from typing import Literal
 from azure.search.documents.indexes import SearchIndexClient
 from azure.core.credentials import AzureKeyCredential
-from utils.vector_store import create_vector_store_index, googleid_to_vectorstoreid
+from utils.vector_store import (
+    create_vector_store_index,
+    forget_vector_store,
+    googleid_to_vectorstoreid,
+    VectorSearchSettings,
+    VECTOR_SEARCH_ALGORITHM,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    VECTOR_COMPRESSION,
+    VECTOR_OVERSAMPLING,
+    VECTOR_STORED,
+)
 from utils.constants import DocumentMetadata
+from utils.answer_cache import answer_cache
+from utils.cache import invalidate_sheet
+from utils.prewarm import schedule_prewarm
+from utils.vector_store_snapshot import export_vector_store, import_vector_store
 import os
 
 dm = DocumentMetadata()
@@ -20,6 +43,40 @@ router = APIRouter()
 key_query_scheme = APIKeyHeader(name="Authorization")
 
 
+class VectorSearchPayload(BaseModel):
+    algorithm: Literal["hnsw", "exhaustive", "auto"] = Field(
+        VECTOR_SEARCH_ALGORITHM,
+        description="Vector search algorithm: hnsw (approximate), exhaustive (exact) or auto (exhaustive for small sheets)",
+    )
+    m: int = Field(HNSW_M, ge=4, le=10, description="HNSW: number of links per vector")
+    efConstruction: int = Field(
+        HNSW_EF_CONSTRUCTION,
+        ge=100,
+        le=1000,
+        description="HNSW: number of candidates kept while building the graph",
+    )
+    efSearch: int = Field(
+        HNSW_EF_SEARCH,
+        ge=100,
+        le=1000,
+        description="HNSW: number of candidates kept while searching",
+    )
+    compression: Literal["none", "scalar"] = Field(
+        VECTOR_COMPRESSION,
+        description="Vector compression: none or scalar (int8, rescored with the full-precision vectors)",
+    )
+    oversampling: float = Field(
+        VECTOR_OVERSAMPLING,
+        ge=1,
+        le=10,
+        description="Scalar compression: number of candidates rescored, relative to the number of results",
+    )
+    stored: bool = Field(
+        VECTOR_STORED,
+        description="Store a retrievable copy of the vectors, which searches never return",
+    )
+
+
 class VectorStorePayload(BaseModel):
     googleSheetId: str = Field(
         ...,
@@ -29,6 +86,10 @@ class VectorStorePayload(BaseModel):
         {},
         description=" JSON data from Google Sheet",
     )
+    vectorSearch: VectorSearchPayload = Field(
+        None,
+        description="Vector search settings of the index, instead of the default ones",
+    )
 
 
 @router.post("/create-vector-store", tags=["data"])
@@ -45,16 +106,102 @@ async def create_vector_store(
     else:
         document_type = "googlesheet"
 
-    vector_store = create_vector_store_index(
+    vector_search_settings = None
+    if payload.vectorSearch:
+        vector_search_settings = VectorSearchSettings(
+            algorithm=payload.vectorSearch.algorithm,
+            m=payload.vectorSearch.m,
+            ef_construction=payload.vectorSearch.efConstruction,
+            ef_search=payload.vectorSearch.efSearch,
+            compression=payload.vectorSearch.compression,
+            oversampling=payload.vectorSearch.oversampling,
+            stored=payload.vectorSearch.stored,
+        )
+
+    # run the blocking ingestion in the threadpool, not to block the event loop while
+    # it loads, embeds (waiting for admission) and uploads the sheet
+    vector_store = await run_in_threadpool(
+        create_vector_store_index,
         document_type=document_type,
         document_id=payload.googleSheetId,
         document_data=payload.data,
+        vector_search_settings=vector_search_settings,
     )
+    # the caches of the sheet were invalidated
+    schedule_prewarm([payload.googleSheetId])
+    n_docs = await run_in_threadpool(vector_store.client.get_document_count)
 
     return JSONResponse(
         status_code=200,
         content=f"Created vector store index {googleid_to_vectorstoreid(payload.googleSheetId)} "
-        f"with {vector_store.client.get_document_count()} documents.",
+        f"with {n_docs} documents.",
+    )
+
+
+@router.post("/export-vector-store", tags=["data"])
+async def export_vector_store_snapshot(
+    payload: VectorStorePayload,
+    makeRetrievable: bool = False,
+    api_key: str = Depends(key_query_scheme),
+):
+    """
+    Export a snapshot of a vector store (NPZ), with its vectors, to import it elsewhere without embedding again.
+    Older indexes with hidden vectors are only exported with makeRetrievable, which changes their schema.
+    """
+
+    if api_key != os.environ["API_KEY_WRITE"]:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # run the blocking export in the threadpool, not to block the event loop, into a
+    # temporary file that is streamed and then deleted
+    with tempfile.NamedTemporaryFile(suffix=".npz", delete=False) as snapshot:
+        try:
+            manifest = await run_in_threadpool(
+                export_vector_store, payload.googleSheetId, snapshot, makeRetrievable
+            )
+        except Exception:
+            os.remove(snapshot.name)
+            raise
+
+    return FileResponse(
+        snapshot.name,
+        media_type="application/octet-stream",
+        filename=f'{manifest["store_id"]}.npz',
+        headers={
+            "X-Vectors-Made-Retrievable": str(
+                manifest["vectors_made_retrievable"]
+            ).lower(),
+        },
+        background=BackgroundTask(os.remove, snapshot.name),
+    )
+
+
+@router.post("/import-vector-store", tags=["data"])
+async def import_vector_store_snapshot(
+    file: UploadFile = File(..., description="Snapshot from /export-vector-store"),
+    googleSheetId: str = Form(
+        None, description="HIA Google sheet ID, by default that of the snapshot"
+    ),
+    api_key: str = Depends(key_query_scheme),
+):
+    """Replace a vector store with a snapshot from /export-vector-store, without loading or embedding the sheet."""
+
+    if api_key != os.environ["API_KEY_WRITE"]:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # run the blocking import in the threadpool, not to block the event loop, from the
+    # spooled temporary file of the upload, not a copy in memory
+    vector_store, google_sheet_id = await run_in_threadpool(
+        import_vector_store, googleSheetId, file.file
+    )
+    # the caches of the sheet were invalidated
+    schedule_prewarm([google_sheet_id])
+    n_docs = await run_in_threadpool(vector_store.client.get_document_count)
+
+    return JSONResponse(
+        status_code=200,
+        content=f"Imported vector store index {vector_store.store_id} "
+        f"with {n_docs} documents.",
     )
 
 
@@ -77,6 +224,9 @@ async def delete_vector_store(
         _ = azure_search_index_client.delete_index(vector_store_id)
     except Exception as ex:
         raise HTTPException(status_code=400, detail=str(ex))
+    forget_vector_store(payload.googleSheetId)
+    answer_cache.invalidate(payload.googleSheetId)
+    invalidate_sheet(payload.googleSheetId)
 
     return JSONResponse(
         status_code=200, content=f"Deleted vector store index {vector_store_id}."
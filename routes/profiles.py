@@ -0,0 +1,42 @@
+from __future__ import annotations
+from fastapi import Depends, APIRouter, HTTPException
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.security import APIKeyHeader
+from typing import Literal
+from utils.profiler import list_profiles, profile_path
+import os
+
+router = APIRouter()
+
+key_query_scheme = APIKeyHeader(name="Authorization")
+
+
+@router.get("/profiles", tags=["profiles"])
+async def get_profiles(api_key: str = Depends(key_query_scheme)):
+    """List the stored request profiles, most recent first."""
+
+    if api_key != os.environ["API_KEY_WRITE"]:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return JSONResponse(status_code=200, content={"profiles": list_profiles()})
+
+
+@router.get("/profiles/{profileId}", tags=["profiles"])
+async def get_profile(
+    profileId: str,
+    kind: Literal["wall", "cpu"] = "wall",
+    api_key: str = Depends(key_query_scheme),
+):
+    """Download the wall-clock or CPU profile of a request, as folded stacks."""
+
+    if api_key != os.environ["API_KEY_WRITE"]:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        path = profile_path(profileId, kind)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Profile {profileId} not found.")
+
+    return FileResponse(path, media_type="text/plain", filename=os.path.basename(path))
@@ -5,17 +5,32 @@ from fastapi import Depends, APIRouter, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field
-from utils.vector_store import get_vector_store
+from utils.vector_store import get_vector_store, RESULT_FIELDS
 from utils.constants import DocumentMetadata
-import json
-from utils.logger import logger
+from utils.logger import logger, query_logger
+from utils.metrics import timed
+from utils.profiler import profiled
+from utils.cache import search_cache, hierarchy_cache
 import orjson
-from typing import Any
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait as wait_futures
+from typing import Any, List
 from utils.translator import translate
+from utils.admission import INTERACTIVE
 import os
 
 dm = DocumentMetadata()
 
+# Deadline of a search across several sheets, in seconds: slower sheets are left out
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", 5))
+# Label of the sheet of each result, in searches across several sheets
+GOOGLE_SHEET_ID = "googleSheetId"
+
+_fanout_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SEARCH_FANOUT_WORKERS", 16)),
+    thread_name_prefix="search-fanout",
+)
+
 router = APIRouter()
 
 key_query_scheme = APIKeyHeader(name="Authorization")
@@ -32,68 +47,8 @@ def get_score_google_index(docs_and_scores, google_index: str) -> float:
     return max(scores)
 
 
-class ORJSONResponse(JSONResponse):
-    """Custom JSONResponse class that uses orjson for serialization."""
-
-    media_type = "application/json"
-
-    def render(self, content: Any) -> bytes:
-        return orjson.dumps(content)
-
-
-class SearchPayload(BaseModel):
-    """Search payload."""
-
-    query: str = Field(
-        ...,
-        description="""Text of the search query""",
-    )
-    googleSheetId: str = Field(
-        ...,
-        description="""HIA Google sheet ID""",
-    )
-    k: int = Field(
-        5,
-        description="""Number of results to return""",
-    )
-    lang: str = Field(
-        "en",
-        description="""Language of the search query; results will be translated to this language""",
-    )
-
-
-@router.post("/search", tags=["search"])
-async def search(payload: SearchPayload, api_key: str = Depends(key_query_scheme)):
-    """Search HIA."""
-
-    if api_key != os.environ["API_KEY"]:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
-    # load vector store
-    vector_store = get_vector_store(payload.googleSheetId, check_if_exists=True)
-
-    # translate if necessary
-    if payload.lang != "en":
-        payload.query = translate(
-            from_lang=payload.lang, to_lang="en", text=payload.query
-        )
-
-    # log query
-    extra_logs = {"googleSheetId": payload.googleSheetId, "lang": payload.lang}
-    logger.info(f"query: {payload.query}", extra=extra_logs)
-
-    # retrieve documents
-    docs_and_scores = vector_store.similarity_search_with_score(
-        query=payload.query, k=payload.k
-    )
-
-    # build results they way HIA likes them
-    df = pd.DataFrame.from_records(
-        [
-            json.loads(doc["metadata"], strict=False)
-            for doc in vector_store.get_documents()
-        ]
-    )  # load all documents from vector store
+def build_results(docs_and_scores, df: pd.DataFrame) -> list:
+    """Build search results they way HIA likes them, with parent and children questions."""
     results = []
     for doc_and_score in docs_and_scores:
         doc = doc_and_score[0]
@@ -171,25 +126,310 @@ async def search(payload: SearchPayload, api_key: str = Depends(key_query_scheme
     for result in results:
         result.pop(dm.GOOGLE_INDEX)
 
-    # translate results if necessary
-    if payload.lang != "en":
-        for result in results:
-            result[dm.QUESTION] = translate(
-                from_lang="en", to_lang=payload.lang, text=result[dm.QUESTION]
+    return results
+
+
+class ORJSONResponse(JSONResponse):
+    """Custom JSONResponse class that uses orjson for serialization."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+class SearchPayload(BaseModel):
+    """Search payload."""
+
+    query: str = Field(
+        ...,
+        description="""Text of the search query""",
+    )
+    googleSheetId: str = Field(
+        None,
+        description="""HIA Google sheet ID""",
+    )
+    googleSheetIds: List[str] = Field(
+        None,
+        description="""HIA Google sheet IDs, to search several sheets (e.g. neighboring regions) at once instead of googleSheetId; results are merged by score and labeled with their googleSheetId""",
+    )
+    k: int = Field(
+        5,
+        description="""Number of results to return""",
+    )
+    categoryID: int = Field(
+        None,
+        description="""Only search questions of this category""",
+    )
+    subcategoryID: int = Field(
+        None,
+        description="""Only search questions of this subcategory""",
+    )
+    lang: str = Field(
+        "en",
+        description="""Language of the search query; results will be translated to this language""",
+    )
+
+
+def search_sheet(
+    google_sheet_id: str,
+    query: str,
+    k: int,
+    category_id: int = None,
+    subcategory_id: int = None,
+    priority: int = INTERACTIVE,
+) -> list:
+    """
+    Search a sheet (optionally one category and/or subcategory) for an English query and
+    build its results. Embedding the query waits for the Azure OpenAI budget at the given
+    priority, unless the embedding is cached.
+    """
+    vector_store = get_vector_store(google_sheet_id, check_if_exists=True)
+
+    # a background search embeds its query at its own priority, the search below then
+    # gets it from the embeddings cache
+    if priority != INTERACTIVE:
+        vector_store.embed_query(query, priority=priority)
+
+    # retrieve documents
+    docs_and_scores = vector_store.similarity_search_with_score(
+        query=query, k=k, category_id=category_id, subcategory_id=subcategory_id
+    )
+
+    # build results they way HIA likes them
+    with timed("hierarchy_assembly"):
+        # load all documents from vector store, or from the hierarchy cache
+        # (one row per question: the first chunk of each)
+        df = hierarchy_cache.get_or_set(
+            "documents",
+            lambda: pd.DataFrame.from_records(
+                vector_store.get_rows(), columns=RESULT_FIELDS
+            ),
+            scope=google_sheet_id,
+        )
+        return build_results(docs_and_scores, df)
+
+
+def translate_results(results: list, lang: str):
+    """Translate questions and answers of results (and their children) from English."""
+    for result in results:
+        result[dm.QUESTION] = translate(
+            from_lang="en", to_lang=lang, text=result[dm.QUESTION]
+        )
+        result[dm.ANSWER] = translate(
+            from_lang="en", to_lang=lang, text=result[dm.ANSWER]
+        )
+        if result["children"]:
+            for child in result["children"]:
+                child[dm.QUESTION] = translate(
+                    from_lang="en", to_lang=lang, text=child[dm.QUESTION]
+                )
+                child[dm.ANSWER] = translate(
+                    from_lang="en", to_lang=lang, text=child[dm.ANSWER]
+                )
+
+
+def embed_query(google_sheet_id: str, query: str, deadline: float):
+    """Embed a query once for the searches of several sheets, within the deadline."""
+    get_vector_store(google_sheet_id).embed_query(
+        query, timeout=max(deadline - time.monotonic(), 0)
+    )
+
+
+def search_sheets(
+    google_sheet_ids: List[str],
+    query: str,
+    k: int,
+    category_id: int = None,
+    subcategory_id: int = None,
+) -> dict:
+    """
+    Search several sheets concurrently for an English query, within SEARCH_DEADLINE seconds.
+    Merge the results by score, labeled with their googleSheetId; sheets that fail or are
+    too slow are left out and reported as "error" or "timeout". The results of each sheet
+    come from the search cache if possible. Searches that have not
+    started by the deadline are cancelled; those already running finish in the background.
+    """
+    deadline = time.monotonic() + SEARCH_DEADLINE
+    # embed the query once: the concurrent searches get it from the embeddings cache
+    embedding = _fanout_executor.submit(
+        embed_query, google_sheet_ids[0], query, deadline
+    )
+    try:
+        embedding.result(timeout=max(deadline - time.monotonic(), 0))
+    except TimeoutError:
+        embedding.cancel()
+        logger.warning(
+            f"Embedding of a query for sheets {google_sheet_ids} exceeded the deadline"
+        )
+        raise HTTPException(
+            status_code=504,
+            detail=f"None of the sheets {google_sheet_ids} could be searched in time.",
+        )
+
+    # each sheet's results are cached like those of single-sheet searches in English
+    futures = {
+        google_sheet_id: _fanout_executor.submit(
+            cached_search,
+            google_sheet_id,
+            query,
+            k,
+            "en",
+            category_id,
+            subcategory_id,
+            log_query=False,
+        )
+        for google_sheet_id in google_sheet_ids
+    }
+    wait_futures(futures.values(), timeout=max(deadline - time.monotonic(), 0))
+
+    results, sheets, errors = [], {}, []
+    for google_sheet_id, future in futures.items():
+        if not future.done():
+            sheets[google_sheet_id] = "timeout"
+            cancelled = future.cancel()
+            logger.warning(
+                f"Search of sheet {google_sheet_id} exceeded the deadline "
+                f"({'cancelled' if cancelled else 'still running'})"
             )
-            result[dm.ANSWER] = translate(
-                from_lang="en", to_lang=payload.lang, text=result[dm.ANSWER]
+        elif future.exception() is not None:
+            sheets[google_sheet_id] = "error"
+            errors.append(future.exception())
+            logger.error(
+                f"Search of sheet {google_sheet_id} failed: {future.exception()}"
             )
-            if result["children"]:
-                for child in result["children"]:
-                    child[dm.QUESTION] = translate(
-                        from_lang="en", to_lang=payload.lang, text=child[dm.QUESTION]
-                    )
-                    child[dm.ANSWER] = translate(
-                        from_lang="en", to_lang=payload.lang, text=child[dm.ANSWER]
-                    )
+        else:
+            sheets[google_sheet_id] = "ok"
+            for result in future.result():
+                result[GOOGLE_SHEET_ID] = google_sheet_id
+                results.append(result)
+
+    if "ok" not in sheets.values():
+        # report the error of the first failed sheet, e.g. a 429, or that all timed out
+        if errors and isinstance(errors[0], HTTPException):
+            raise errors[0]
+        raise HTTPException(
+            status_code=504 if not errors else 502,
+            detail=f"None of the sheets {google_sheet_ids} could be searched in time.",
+        )
+    results.sort(key=lambda result: result[dm.SCORE], reverse=True)
+    return {
+        "results": results[:k],
+        "partial": any(status != "ok" for status in sheets.values()),
+        "sheets": sheets,
+    }
+
 
-    return ORJSONResponse(
-        status_code=200,
-        content={"results": results},
+# a plain function, run in the threadpool: the blocking calls of concurrent searches
+# overlap, and their query embeddings can be batched together
+@router.post("/search", tags=["search"])
+def search(payload: SearchPayload, api_key: str = Depends(key_query_scheme)):
+    """Search HIA."""
+
+    if api_key != os.environ["API_KEY"]:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # sample this thread if the request is profiled
+    with profiled():
+        if payload.googleSheetIds:
+            return search_multiple(payload)
+        if not payload.googleSheetId:
+            raise HTTPException(
+                status_code=400,
+                detail="Either googleSheetId or googleSheetIds is required.",
+            )
+
+        results = cached_search(
+            payload.googleSheetId,
+            payload.query,
+            payload.k,
+            payload.lang,
+            payload.categoryID,
+            payload.subcategoryID,
+        )
+
+        return ORJSONResponse(
+            status_code=200,
+            content={"results": results},
+        )
+
+
+def cached_search(
+    google_sheet_id: str,
+    query: str,
+    k: int = 5,
+    lang: str = "en",
+    category_id: int = None,
+    subcategory_id: int = None,
+    priority: int = INTERACTIVE,
+    log_query: bool = True,
+) -> list:
+    """
+    Search a sheet for a query in the given language, and translate the results to it.
+    Results are cached until the sheet is reindexed. Searches of the cache prewarming
+    (see utils.prewarm) run at background priority and are not logged as queries.
+    """
+    # load vector store
+    get_vector_store(google_sheet_id, check_if_exists=True)
+
+    extra_logs = {
+        "googleSheetId": google_sheet_id,
+        "lang": lang,
+        "categoryID": category_id,
+        "subcategoryID": subcategory_id,
+    }
+
+    # return the cached results of the same search, if the sheet was not reindexed since
+    cache_key = (query, k, lang, category_id, subcategory_id)
+    results = search_cache.get(cache_key, scope=google_sheet_id)
+    if results is not None:
+        if log_query:
+            query_logger.info("query (cached): %s", query, extra=extra_logs)
+        return results
+
+    # translate if necessary
+    if lang != "en":
+        query = translate(from_lang=lang, to_lang="en", text=query)
+
+    # log query
+    if log_query:
+        query_logger.info("query: %s", query, extra=extra_logs)
+
+    results = search_sheet(
+        google_sheet_id, query, k, category_id, subcategory_id, priority
     )
+
+    # translate results if necessary
+    if lang != "en":
+        translate_results(results, lang)
+    search_cache.set(cache_key, results, scope=google_sheet_id)
+    return results
+
+
+def search_multiple(payload: SearchPayload) -> ORJSONResponse:
+    """Search several sheets at once."""
+    google_sheet_ids = list(dict.fromkeys(payload.googleSheetIds))
+
+    # translate if necessary
+    if payload.lang != "en":
+        payload.query = translate(
+            from_lang=payload.lang, to_lang="en", text=payload.query
+        )
+
+    # log query
+    extra_logs = {"googleSheetIds": google_sheet_ids, "lang": payload.lang}
+    query_logger.info("query: %s", payload.query, extra=extra_logs)
+
+    content = search_sheets(
+        google_sheet_ids,
+        payload.query,
+        payload.k,
+        payload.categoryID,
+        payload.subcategoryID,
+    )
+
+    # translate results if necessary
+    if payload.lang != "en":
+        translate_results(content["results"], payload.lang)
+
+    return ORJSONResponse(status_code=200, content=content)
@@ -0,0 +1,54 @@
+import os
+import random
+import pytest
+from benchmarks.run import DUMMY_ENVIRONMENT
+
+# Dummy credentials, set before the modules that read them are imported, so that no real
+# service is ever called
+os.environ.update(DUMMY_ENVIRONMENT)
+
+
+@pytest.fixture(scope="session")
+def services():
+    """Local stand-ins of all external services (see benchmarks/fakes.py)"""
+    from benchmarks import run
+
+    return run.set_up(
+        run.parse_args(
+            ["--llm-latency", "0", "--embedding-latency", "0", "--search-latency", "0"]
+        )
+    )
+
+
+@pytest.fixture(scope="session")
+def make_vector_store(services):
+    """Make the vector store of a sheet with n_rows rows, registered for its requests"""
+    from benchmarks import run
+    from utils.constants import DocumentMetadata
+    from utils.document_loader import DocumentLoader
+    from utils.vector_store import VectorStore, register_vector_store
+    import utils.vector_store
+
+    def make_vector_store(google_sheet_id: str, n_rows: int = 20):
+        documents = DocumentLoader(
+            document_type="json",
+            document_id=google_sheet_id,
+            document_data=run.make_sheet(n_rows, random.Random(0)),
+        ).load()
+        # one chunk per row, without the tokenizer of the chunker
+        for document in documents:
+            document.metadata[DocumentMetadata.NTH_CHUNK] = 0
+        vector_store = VectorStore(
+            store_path="https://benchmark.search.windows.net",
+            store_service="azuresearch",
+            store_password="benchmark",
+            embedding_source=utils.vector_store.EMBEDDING_SOURCE,
+            embedding_model=utils.vector_store.get_embedding_model(),
+            store_id=utils.vector_store.googleid_to_vectorstoreid(google_sheet_id),
+            google_sheet_id=google_sheet_id,
+        )
+        vector_store.add_documents(documents, google_sheet_id=google_sheet_id)
+        register_vector_store(google_sheet_id, vector_store)
+        return vector_store
+
+    return make_vector_store
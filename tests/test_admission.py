@@ -0,0 +1,76 @@
+import threading
+import time
+import pytest
+from fastapi import HTTPException
+from utils.admission import AdmissionController, TokenBucket, INTERACTIVE, BACKGROUND
+
+
+def test_bucket_starts_full():
+    bucket = TokenBucket(600)
+    assert bucket.capacity == 100
+    assert bucket.time_until(100) == 0
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(600)
+    bucket.take(100)
+    assert bucket.time_until(10) == pytest.approx(1, abs=0.05)
+
+
+def test_bucket_take_larger_than_capacity_leaves_no_debt():
+    bucket = TokenBucket(600)
+    bucket.take(100_000)
+    assert bucket.level >= 0
+    assert bucket.time_until(10) == pytest.approx(1, abs=0.05)
+
+
+def test_disabled_controller_admits_everything():
+    controller = AdmissionController(0, 0, 0, 0)
+    for _ in range(100):
+        controller.admit("sheet", tokens=10**6)
+
+
+def test_rejects_when_sheet_budget_cannot_be_met_in_time():
+    controller = AdmissionController(sheet_rpm=6)
+    controller.admit("sheet", tokens=1)
+    with pytest.raises(HTTPException) as e:
+        controller.admit("sheet", tokens=1, timeout=0.1)
+    assert e.value.status_code == 429
+    assert int(e.value.headers["Retry-After"]) >= 1
+    # other sheets have their own budget
+    controller.admit("other sheet", tokens=1, timeout=0.1)
+
+
+def test_rejects_when_queue_is_full():
+    controller = AdmissionController(global_rpm=60, max_queue=0)
+    with pytest.raises(HTTPException) as e:
+        controller.admit("sheet", tokens=1)
+    assert e.value.status_code == 429
+
+
+def test_large_background_request_does_not_block_interactive_ones():
+    controller = AdmissionController(global_tpm=600, sheet_tpm=600)
+    controller.admit("sheet", tokens=100_000, priority=BACKGROUND)
+    start = time.monotonic()
+    controller.admit("sheet", tokens=10, priority=INTERACTIVE, timeout=2)
+    assert time.monotonic() - start < 1.5
+
+
+def test_interactive_requests_are_admitted_before_background_ones():
+    controller = AdmissionController(global_rpm=60)
+    for _ in range(10):
+        controller.admit("sheet", tokens=1)
+    admitted = []
+
+    def admit(priority: int):
+        controller.admit("sheet", tokens=1, priority=priority, timeout=5)
+        admitted.append(priority)
+
+    background = threading.Thread(target=admit, args=(BACKGROUND,))
+    background.start()
+    time.sleep(0.1)
+    interactive = threading.Thread(target=admit, args=(INTERACTIVE,))
+    interactive.start()
+    background.join()
+    interactive.join()
+    assert admitted == [INTERACTIVE, BACKGROUND]
@@ -0,0 +1,58 @@
+import pytest
+import utils.answer_cache
+import utils.cache
+from utils.answer_cache import AnswerCache
+from utils.cache import Cache
+
+
+@pytest.fixture
+def answer_cache():
+    return AnswerCache(threshold=0.9, ttl=60, max_size=2)
+
+
+def test_returns_answer_of_similar_question(answer_cache):
+    answer_cache.put("sheet", "prompt", [1.0, 0.0], "where?", "here")
+    assert answer_cache.get("sheet", "prompt", [1.0, 0.1]) == "here"
+    assert answer_cache.stats()["hits"] == 1
+
+
+def test_misses_dissimilar_question(answer_cache):
+    answer_cache.put("sheet", "prompt", [1.0, 0.0], "where?", "here")
+    assert answer_cache.get("sheet", "prompt", [1.0, 1.0]) is None
+    assert answer_cache.get("other-sheet", "prompt", [1.0, 0.0]) is None
+    assert answer_cache.stats()["misses"] == 2
+
+
+def test_expires_answers(answer_cache, monkeypatch):
+    now = utils.answer_cache.time.time()
+    answer_cache.put("sheet", "prompt", [1.0, 0.0], "where?", "here")
+    monkeypatch.setattr(utils.answer_cache.time, "time", lambda: now + 61)
+    assert answer_cache.get("sheet", "prompt", [1.0, 0.0]) is None
+    assert answer_cache.stats()["size"] == 0
+
+
+def test_evicts_least_recently_used_answer(answer_cache):
+    answer_cache.put("sheet", "prompt", [1.0, 0.0], "where?", "here")
+    answer_cache.put("sheet", "prompt", [0.0, 1.0], "when?", "now")
+    # "where?" is used after "when?" was cached
+    assert answer_cache.get("sheet", "prompt", [1.0, 0.0]) == "here"
+    answer_cache.put("sheet", "prompt", [-1.0, 0.0], "who?", "me")
+    assert answer_cache.get("sheet", "prompt", [0.0, 1.0]) is None
+    assert answer_cache.get("sheet", "prompt", [1.0, 0.0]) == "here"
+    assert answer_cache.stats()["size"] == 2
+
+
+def test_drops_answers_when_prompt_changes(answer_cache):
+    answer_cache.put("sheet", "prompt", [1.0, 0.0], "where?", "here")
+    assert answer_cache.get("sheet", "new-prompt", [1.0, 0.0]) is None
+    assert answer_cache.get("sheet", "prompt", [1.0, 0.0]) is None
+
+
+def test_drops_answers_when_sheet_is_reindexed_on_another_worker(
+    answer_cache, monkeypatch
+):
+    monkeypatch.setattr(utils.cache, "CACHE_VERSION_TTL", 0)
+    answer_cache.put("sheet", "prompt", [1.0, 0.0], "where?", "here")
+    # invalidate_sheet on the other worker, sharing the cache backend
+    Cache("search").invalidate("sheet")
+    assert answer_cache.get("sheet", "prompt", [1.0, 0.0]) is None
@@ -0,0 +1,118 @@
+import pytest
+import utils.cache
+from benchmarks.fakes import FakeRedis
+from utils.cache import Cache, MemoryBackend, RedisBackend, SQLiteBackend
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path, monkeypatch):
+    """Each cache backend, used by all caches for the duration of a test"""
+    if request.param == "memory":
+        backend = MemoryBackend()
+    elif request.param == "sqlite":
+        backend = SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+    else:
+        backend = RedisBackend(client=FakeRedis())
+    monkeypatch.setattr(utils.cache, "_backend", backend)
+    return backend
+
+
+@pytest.fixture
+def now(monkeypatch):
+    """Current time of the backends, which tests can move forward"""
+    now = [1000.0]
+    monkeypatch.setattr(utils.cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_backend_stores_values_until_they_expire(backend, now):
+    backend.set("namespace", "key", b"value", ttl=10, max_entries=10)
+    assert backend.get("namespace", "key") == b"value"
+    assert backend.get("other-namespace", "key") is None
+    now[0] += 11
+    assert backend.get("namespace", "key") is None
+
+
+def test_backend_counts(backend):
+    assert backend.get_counter("namespace", "key") == 0
+    assert backend.incr("namespace", "key") == 1
+    assert backend.incr("namespace", "key") == 2
+    assert backend.get_counter("namespace", "key") == 2
+
+
+def test_get_or_set_computes_value_once(backend):
+    cache = Cache("test", ttl=60, max_entries=10)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"results": [1, 2]}
+
+    assert cache.get_or_set("key", compute, scope="sheet") == {"results": [1, 2]}
+    assert cache.get_or_set("key", compute, scope="sheet") == {"results": [1, 2]}
+    assert len(calls) == 1
+
+
+def test_invalidate_drops_only_values_of_the_scope(backend):
+    cache = Cache("test", ttl=60, max_entries=10)
+    cache.set("key", "a", scope="sheet-a")
+    cache.set("key", "b", scope="sheet-b")
+    cache.invalidate("sheet-a")
+    assert cache.get("key", scope="sheet-a") is None
+    assert cache.get("key", scope="sheet-b") == "b"
+
+
+def test_invalidation_reaches_other_workers_after_version_ttl(backend, monkeypatch):
+    monkeypatch.setattr(utils.cache, "CACHE_VERSION_TTL", 60)
+    monotonic = [0.0]
+    monkeypatch.setattr(utils.cache.time, "monotonic", lambda: monotonic[0])
+    cache, other_worker = Cache("test", ttl=600), Cache("test", ttl=600)
+    cache.set("key", "value", scope="sheet")
+    assert cache.get("key", scope="sheet") == "value"
+
+    other_worker.invalidate("sheet")
+    # the version of the sheet is kept for CACHE_VERSION_TTL seconds
+    assert cache.get("key", scope="sheet") == "value"
+    monotonic[0] += 61
+    assert cache.get("key", scope="sheet") is None
+
+
+def test_cache_with_zero_ttl_is_disabled(backend):
+    cache = Cache("test", ttl=0)
+    cache.set("key", "value")
+    assert cache.get("key", default="missing") == "missing"
+
+
+def test_backend_errors_are_misses(monkeypatch):
+    class BrokenBackend(MemoryBackend):
+        def get(self, namespace, key):
+            raise ConnectionError("down")
+
+        def set(self, namespace, key, value, ttl, max_entries):
+            raise ConnectionError("down")
+
+    monkeypatch.setattr(utils.cache, "_backend", BrokenBackend())
+    cache = Cache("test", ttl=60)
+    assert cache.get_or_set("key", lambda: "value") == "value"
+    assert cache.get("key") is None
+
+
+def test_memory_backend_evicts_least_recently_used_entries():
+    backend = MemoryBackend()
+    for key in ["a", "b"]:
+        backend.set("namespace", key, b"value", ttl=60, max_entries=2)
+    backend.get("namespace", "a")
+    backend.set("namespace", "c", b"value", ttl=60, max_entries=2)
+    assert backend.get("namespace", "b") is None
+    assert backend.get("namespace", "a") == b"value"
+
+
+def test_sqlite_backend_trims_every_namespace(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteBackend, "PURGE_EVERY", 5)
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+    for ix in range(4):
+        backend.set("rare", f"key-{ix}", b"value", ttl=60, max_entries=2)
+    # only the frequent namespace is written when the cache is purged
+    backend.set("frequent", "key", b"value", ttl=60, max_entries=2)
+    assert backend.get("rare", "key-1") is None
+    assert backend.get("rare", "key-3") == b"value"
@@ -0,0 +1,47 @@
+from langchain_core.documents import Document
+from utils.chunk_deduplicator import ChunkDeduplicator
+from utils.constants import DocumentMetadata
+
+dm = DocumentMetadata()
+
+DISCLAIMER = (
+    "For more information about your rights and the support available in your "
+    "region, please contact the helpdesk by phone or visit one of our offices "
+    "during opening hours from Monday to Friday"
+)
+
+
+def test_finds_exact_and_near_duplicates():
+    texts = [
+        DISCLAIMER,
+        "Children can go to school from the age of four, registration is free",
+        DISCLAIMER.upper() + ".",
+        DISCLAIMER.replace("Friday", "Saturday"),
+    ]
+    assert ChunkDeduplicator(threshold=0.9).find_duplicates(texts) == {
+        0: [2, 3],
+        1: [],
+    }
+
+
+def test_keeps_texts_below_threshold():
+    texts = [DISCLAIMER, DISCLAIMER.replace("helpdesk by phone", "lawyer by email")]
+    assert ChunkDeduplicator(threshold=0.9).find_duplicates(texts) == {0: [], 1: []}
+    assert ChunkDeduplicator(threshold=0.5).find_duplicates(texts) == {0: [1]}
+
+
+def test_keeps_empty_and_short_texts():
+    texts = ["", "Yes", "yes!", "No"]
+    assert ChunkDeduplicator().find_duplicates(texts) == {0: [], 1: [2], 3: []}
+
+
+def test_deduplicate_keeps_metadata_of_duplicates():
+    documents = [
+        Document(page_content=DISCLAIMER, metadata={dm.GOOGLE_INDEX: 1}),
+        Document(page_content="Something else entirely", metadata={dm.GOOGLE_INDEX: 2}),
+        Document(page_content=DISCLAIMER, metadata={dm.GOOGLE_INDEX: 3}),
+    ]
+    kept = ChunkDeduplicator().deduplicate(documents)
+    assert [doc.metadata[dm.GOOGLE_INDEX] for doc in kept] == [1, 2]
+    assert kept[0].metadata[dm.DUPLICATES] == [{dm.GOOGLE_INDEX: 3}]
+    assert dm.DUPLICATES not in kept[1].metadata
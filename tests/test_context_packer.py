@@ -0,0 +1,79 @@
+import pytest
+import tiktoken
+from langchain_core.documents import Document
+from utils.context_packer import ContextPacker
+from utils.constants import DocumentMetadata
+
+dm = DocumentMetadata()
+
+# One token per byte, so that budgets are easy to count and no encoding is downloaded
+BYTE_ENCODING = tiktoken.Encoding(
+    "bytes",
+    pat_str=r"\S+|\s+",
+    mergeable_ranks={bytes([i]): i for i in range(256)},
+    special_tokens={},
+)
+
+
+@pytest.fixture
+def packer(monkeypatch):
+    monkeypatch.setattr(ContextPacker, "encoding", BYTE_ENCODING)
+    return ContextPacker(token_budget=100)
+
+
+def chunk(text: str, google_index: int, nth_chunk: int, score: float) -> Document:
+    return Document(
+        page_content=text,
+        metadata={
+            dm.GOOGLE_INDEX: google_index,
+            dm.NTH_CHUNK: nth_chunk,
+            dm.SCORE: score,
+        },
+    )
+
+
+def test_merges_consecutive_chunks_removing_overlap(packer):
+    documents = [
+        chunk("Registration opens at nine in the morning", 1, 0, 0.5),
+        chunk("in the morning and closes at five", 1, 1, 0.8),
+    ]
+    assert packer.pack(documents) == [
+        "Registration opens at nine in the morning and closes at five"
+    ]
+
+
+def test_joins_consecutive_chunks_without_overlap(packer):
+    documents = [chunk("First part.", 1, 0, 0.5), chunk("Second part.", 1, 1, 0.5)]
+    assert packer.pack(documents) == ["First part. Second part."]
+
+
+def test_does_not_merge_chunks_of_other_rows_or_gaps(packer):
+    documents = [
+        chunk("Row one, chunk zero.", 1, 0, 0.9),
+        chunk("Row one, chunk two.", 1, 2, 0.5),
+        chunk("Row two, chunk one.", 2, 1, 0.7),
+    ]
+    assert packer.pack(documents) == [
+        "Row one, chunk zero.",
+        "Row two, chunk one.",
+        "Row one, chunk two.",
+    ]
+
+
+def test_drops_duplicates(packer):
+    documents = [chunk("Same text.", 1, 0, 0.4), chunk("Same text.", 1, 0, 0.6)]
+    documents.append(chunk("Same text.", 2, 0, 0.5))
+    assert packer.pack(documents) == ["Same text."]
+
+
+def test_fills_budget_by_descending_score(packer):
+    documents = [
+        chunk("a" * 60, 1, 0, 0.9),
+        chunk("b" * 50, 2, 0, 0.8),
+        chunk("c" * 40, 3, 0, 0.7),
+    ]
+    assert packer.pack(documents) == ["a" * 60, "c" * 40]
+
+
+def test_truncates_best_document_to_budget(packer):
+    assert packer.pack([chunk("x" * 150, 1, 0, 0.9)]) == ["x" * 100]
@@ -0,0 +1,73 @@
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from utils.embedding_batcher import EmbeddingBatcher
+
+
+class StubEmbedder:
+    """Embeds a text as [its length], recording the texts of each call"""
+
+    def __init__(self, drop_last: bool = False, release: threading.Event = None):
+        self.calls = []
+        self.drop_last = drop_last
+        self.release = release
+
+    def embed_query(self, text: str) -> list:
+        self.calls.append([text])
+        return [float(len(text))]
+
+    def embed_documents(self, texts: list) -> list:
+        self.calls.append(list(texts))
+        if self.release is not None:
+            self.release.wait(5)
+        embeddings = [[float(len(text))] for text in texts]
+        return embeddings[:-1] if self.drop_last else embeddings
+
+
+def embed_concurrently(batcher: EmbeddingBatcher, queries: list) -> list:
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        return list(executor.map(batcher.embed_query, queries))
+
+
+def test_batches_concurrent_queries():
+    embedder = StubEmbedder()
+    batcher = EmbeddingBatcher(embedder, "OpenAI/model", window_ms=200)
+    queries = ["a", "bb", "ccc", "dddd"]
+    # each caller gets the embedding of its own query
+    assert embed_concurrently(batcher, queries) == [[1.0], [2.0], [3.0], [4.0]]
+    assert len(embedder.calls) == 1
+    assert sorted(embedder.calls[0]) == queries
+
+
+def test_splits_batches_at_max_size():
+    embedder = StubEmbedder()
+    batcher = EmbeddingBatcher(
+        embedder, "OpenAI/model", window_ms=200, max_batch_size=2
+    )
+    assert embed_concurrently(batcher, ["a", "bb", "ccc"]) == [[1.0], [2.0], [3.0]]
+    assert sorted(len(call) for call in embedder.calls) == [1, 2]
+
+
+def test_without_window_embeds_each_query():
+    embedder = StubEmbedder()
+    batcher = EmbeddingBatcher(embedder, "OpenAI/model", window_ms=0)
+    assert batcher.embed_query("abc") == [3.0]
+    assert embedder.calls == [["abc"]]
+
+
+def test_fails_whole_batch_if_embeddings_are_missing():
+    batcher = EmbeddingBatcher(StubEmbedder(drop_last=True), "OpenAI/model")
+    with pytest.raises(ValueError):
+        batcher.embed_query("abc")
+
+
+def test_times_out_with_504():
+    release = threading.Event()
+    batcher = EmbeddingBatcher(StubEmbedder(release=release), "OpenAI/model")
+    try:
+        with pytest.raises(HTTPException) as e:
+            batcher.embed_query("abc", timeout=0.05)
+        assert e.value.status_code == 504
+    finally:
+        release.set()
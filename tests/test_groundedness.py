@@ -0,0 +1,62 @@
+import threading
+import utils.groundedness
+from utils.groundedness import check_groundedness, redact_ungrounded
+
+TEXT = "The clinic opens at 9. It is free. Bring your passport."
+
+
+def result(*spans, percentage: float = 0.5) -> dict:
+    """Result of the groundedness detection API with the given (offset, length) spans"""
+    return {
+        "ungroundedDetected": bool(spans),
+        "ungroundedPercentage": percentage,
+        "ungroundedDetails": [
+            {"offset": {"codePoint": offset}, "length": {"codePoint": length}}
+            for offset, length in spans
+        ],
+    }
+
+
+def redact(*spans, percentage: float = 0.5) -> str:
+    return redact_ungrounded(TEXT, result(*spans, percentage=percentage), [], "query")
+
+
+def test_removes_ungrounded_span():
+    assert redact((23, 12)) == "The clinic opens at 9. Bring your passport."
+
+
+def test_merges_overlapping_spans():
+    assert redact((23, 8), (27, 8)) == "The clinic opens at 9. Bring your passport."
+
+
+def test_merges_adjacent_spans():
+    assert redact((0, 23), (23, 12)) == "Bring your passport."
+
+
+def test_removes_unsorted_spans():
+    assert redact((35, 20), (0, 23)) == "It is free. "
+
+
+def test_keeps_text_below_threshold():
+    assert redact((23, 12), percentage=0.1) == TEXT
+
+
+def test_keeps_text_without_ungrounded_content():
+    assert redact() == TEXT
+
+
+def test_skips_check_when_too_many_are_pending(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        utils.groundedness,
+        "_detect_ungrounded",
+        lambda *args: calls.append(args) or result(),
+    )
+    monkeypatch.setattr(utils.groundedness, "_pending", threading.BoundedSemaphore(1))
+    utils.groundedness._pending.acquire()
+    assert check_groundedness(TEXT, ["source"], "query", mode="blocking") == TEXT
+    assert calls == []
+
+    utils.groundedness._pending.release()
+    assert check_groundedness(TEXT, ["source"], "query", mode="blocking") == TEXT
+    assert len(calls) == 1
@@ -0,0 +1,143 @@
+import threading
+import pytest
+import requests
+import utils.http_client
+from utils.http_client import (
+    CircuitBreaker,
+    CircuitOpenError,
+    OutboundClient,
+    PoolExhaustedError,
+)
+
+
+def response(status_code: int, **headers) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff delays, without waiting"""
+    sleeps = []
+    monkeypatch.setattr(utils.http_client.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def client_answering(statuses: list, **kwargs) -> tuple:
+    """Client whose calls get the given statuses (or raise the given exceptions) in turn"""
+    client = OutboundClient("service", backoff=0, **kwargs)
+    calls = []
+
+    def send(method, url, **kwargs):
+        calls.append(method)
+        status = statuses[min(len(calls), len(statuses)) - 1]
+        if isinstance(status, Exception):
+            raise status
+        return status if isinstance(status, requests.Response) else response(status)
+
+    client._send = send
+    return client, calls
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("service", failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_half_open_circuit_allows_one_trial():
+    breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    # a trial that never reached the service frees the way for another one
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_successful_trial_closes_circuit():
+    breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_opens_circuit_again():
+    breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_retries_idempotent_calls(sleeps):
+    client, calls = client_answering([503, requests.Timeout(), 200], retries=2)
+    assert client.get("https://service").status_code == 200
+    assert len(calls) == 3
+
+
+def test_returns_last_retryable_response(sleeps):
+    client, calls = client_answering([503], retries=2)
+    assert client.get("https://service").status_code == 503
+    assert len(calls) == 3
+
+
+def test_does_not_retry_non_idempotent_calls(sleeps):
+    client, calls = client_answering([503, 200], retries=2)
+    assert client.post("https://service").status_code == 503
+    assert calls == ["POST"]
+
+
+def test_waits_for_retry_after(sleeps):
+    client, _ = client_answering(
+        [response(429, **{"Retry-After": "2"}), 200], retries=1
+    )
+    client.get("https://service")
+    assert sleeps == [2.0]
+
+
+def test_fails_fast_while_circuit_is_open(sleeps):
+    client, calls = client_answering([requests.ConnectionError()], retries=0)
+    client.breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=60)
+    with pytest.raises(requests.ConnectionError):
+        client.get("https://service")
+    with pytest.raises(CircuitOpenError):
+        client.get("https://service")
+    assert len(calls) == 1
+
+
+def test_pool_exhaustion_does_not_open_circuit():
+    client = OutboundClient("service", retries=0, max_connections=1)
+    client.breaker = CircuitBreaker("service", failure_threshold=1, reset_timeout=60)
+    client._connections.acquire()
+    with pytest.raises(PoolExhaustedError):
+        client.get("https://service", timeout=(0.01, 1))
+    assert client.breaker.state == "closed"
+
+
+def test_hedged_call_uses_first_answer():
+    client = OutboundClient("service", retries=0, hedge_delay_ms=10)
+    first_call = threading.Event()
+    release_first = threading.Event()
+
+    def send(method, url, **kwargs):
+        if not first_call.is_set():
+            first_call.set()
+            release_first.wait(5)
+            return response(500)
+        return response(200)
+
+    client._send = send
+    try:
+        assert client.get("https://service", hedge=True).status_code == 200
+    finally:
+        release_first.set()
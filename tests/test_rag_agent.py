@@ -0,0 +1,158 @@
+import time
+from types import SimpleNamespace
+import pytest
+from langchain.messages import (
+    AIMessage,
+    HumanMessage,
+    RemoveMessage,
+    SystemMessage,
+    ToolMessage,
+)
+import agents.rag_agent as rag_agent
+from agents.rag_agent import bounded_messages
+
+
+def turn(n: int, with_tools: bool = False) -> list:
+    messages = [SystemMessage(f"prompt {n}"), HumanMessage(f"question {n}")]
+    if with_tools:
+        messages += [
+            AIMessage("", tool_calls=[{"name": "retrieve", "args": {}, "id": f"{n}"}]),
+            ToolMessage(f"documents {n}", tool_call_id=f"{n}"),
+        ]
+    return messages + [AIMessage(f"answer {n}")]
+
+
+def conversation(messages: list) -> list:
+    return [
+        message.content
+        for message in messages
+        if rag_agent.is_conversation_message(message)
+    ]
+
+
+@pytest.fixture
+def max_messages(monkeypatch):
+    monkeypatch.setattr(rag_agent, "CHAT_STATE_MAX_MESSAGES", 4)
+    monkeypatch.setattr(rag_agent, "CHAT_SUMMARY_ENABLED", False)
+
+
+def test_keeps_only_latest_system_message(max_messages):
+    messages = bounded_messages(turn(1), turn(2))
+    assert [m.content for m in messages if m.type == "system"] == ["prompt 2"]
+
+
+def test_keeps_only_tool_messages_of_latest_turn(max_messages):
+    messages = bounded_messages(turn(1, with_tools=True), turn(2, with_tools=True))
+    assert [m.content for m in messages if m.type == "tool"] == ["documents 2"]
+    assert conversation(messages) == [
+        "question 1",
+        "answer 1",
+        "question 2",
+        "answer 2",
+    ]
+
+
+def test_drops_oldest_conversation_messages(max_messages):
+    messages = []
+    for n in range(4):
+        messages = bounded_messages(messages, turn(n))
+    assert conversation(messages) == [
+        "question 2",
+        "answer 2",
+        "question 3",
+        "answer 3",
+    ]
+
+
+def test_keeps_unsummarized_messages_with_summaries(max_messages, monkeypatch):
+    monkeypatch.setattr(rag_agent, "CHAT_SUMMARY_ENABLED", True)
+    messages = []
+    for n in range(4):
+        messages = bounded_messages(messages, turn(n))
+    assert len(conversation(messages)) == 8
+    # summarize removes the messages it folded into the summary
+    messages = bounded_messages(
+        messages,
+        [
+            RemoveMessage(id=message.id)
+            for message in messages
+            if message.content in ["question 0", "answer 0"]
+        ],
+    )
+    assert conversation(messages)[0] == "question 1"
+
+
+@pytest.mark.parametrize(
+    "message", ["Hi!", "thank you very much", "Good morning there", "bye, see you"]
+)
+def test_detects_small_talk(message):
+    assert rag_agent.is_small_talk(message)
+
+
+@pytest.mark.parametrize(
+    "message", ["", "hi, where can I find a doctor?", "thanks, and the price?", "yes"]
+)
+def test_does_not_detect_questions_as_small_talk(message):
+    assert not rag_agent.is_small_talk(message)
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    searches = []
+
+    def retrieve_documents(query, googleSheetId, *args):
+        searches.append(query)
+        return f"documents of {query}", []
+
+    monkeypatch.setattr(rag_agent, "retrieve_documents", retrieve_documents)
+    return searches
+
+
+def retrieve_first(questions: list, **state) -> dict:
+    runtime = SimpleNamespace(context=rag_agent.ContextSchema(googleSheetId="sheet"))
+    messages = [HumanMessage(question) for question in questions]
+    return rag_agent.retrieve_first({"messages": messages, **state}, runtime)
+
+
+def test_retrieve_first_skips_small_talk(searches):
+    update = retrieve_first(
+        ["where is the clinic?", "thanks"],
+        retrieved_query="where is the clinic?",
+        retrieved_at=time.time(),
+    )
+    assert update == {"messages": []}
+    assert searches == []
+
+
+def test_retrieve_first_searches_follow_up_with_previous_question(searches):
+    update = retrieve_first(["where is the clinic?"])
+    update.pop("messages")
+    update = retrieve_first(["where is the clinic?", "and the price?"], **update)
+    update.pop("messages")
+    update = retrieve_first(
+        ["where is the clinic?", "and the price?", "on sundays?"], **update
+    )
+    assert searches == [
+        "where is the clinic?",
+        "where is the clinic? and the price?",
+        "where is the clinic? on sundays?",
+    ]
+    assert update["retrieved_query"] == "where is the clinic?"
+
+
+def test_retrieve_first_does_not_follow_up_previous_session(searches):
+    retrieve_first(
+        ["where is the clinic?", "and the price?"],
+        retrieved_query="where is the clinic?",
+        retrieved_at=time.time() - rag_agent.CHAT_SESSION_TIMEOUT - 1,
+    )
+    assert searches == ["and the price?"]
+
+
+def test_retrieve_first_does_not_follow_up_long_questions(searches):
+    retrieve_first(
+        ["where is the clinic?", "where can I get a vaccine for my children?"],
+        retrieved_query="where is the clinic?",
+        retrieved_at=time.time(),
+    )
+    assert searches == ["where can I get a vaccine for my children?"]
@@ -0,0 +1,41 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def sheets(make_vector_store):
+    for google_sheet_id in ["region-a", "region-b", "region-c"]:
+        make_vector_store(google_sheet_id)
+    return ["region-a", "region-b", "region-c"]
+
+
+def test_search_of_several_sheets_embeds_and_admits_query_once(sheets, monkeypatch):
+    import routes.search
+    import utils.vector_store
+
+    admitted = []
+    monkeypatch.setattr(
+        utils.vector_store.admission,
+        "admit",
+        lambda sheet_id, **kwargs: admitted.append(sheet_id),
+    )
+    content = routes.search.search_sheets(sheets, "where is the hospital?", k=5)
+    assert content["sheets"] == {sheet: "ok" for sheet in sheets}
+    assert len(content["results"]) == 5
+    assert len(admitted) == 1
+
+
+def test_search_of_several_sheets_uses_search_cache(sheets, monkeypatch):
+    import routes.search
+
+    searched = []
+    search_sheet = routes.search.search_sheet
+
+    def counting_search_sheet(google_sheet_id, *args):
+        searched.append(google_sheet_id)
+        return search_sheet(google_sheet_id, *args)
+
+    monkeypatch.setattr(routes.search, "search_sheet", counting_search_sheet)
+    first = routes.search.search_sheets(sheets, "how do I find a school?", k=3)
+    second = routes.search.search_sheets(sheets, "how do I find a school?", k=3)
+    assert sorted(searched) == sheets
+    assert second == first
@@ -0,0 +1,63 @@
+import pytest
+import utils.cache
+from utils.cache import Cache
+
+
+@pytest.fixture
+def other_worker(services, monkeypatch):
+    """Cache of another worker, sharing the backend, whose invalidations are seen at once"""
+    monkeypatch.setattr(utils.cache, "CACHE_VERSION_TTL", 0)
+    return Cache("search")
+
+
+def test_reuses_vector_store(make_vector_store):
+    from utils.vector_store import get_vector_store
+
+    vector_store = make_vector_store("sheet-reused")
+    assert get_vector_store("sheet-reused", check_if_exists=True) is vector_store
+
+
+def test_vector_store_deleted_on_another_worker_is_not_reused(
+    make_vector_store, other_worker
+):
+    from utils.vector_store import get_vector_store, SearchIndexClient
+
+    vector_store = make_vector_store("sheet-deleted")
+    # /delete-vector-store on the other worker
+    SearchIndexClient(None).delete_index(vector_store.store_id)
+    other_worker.invalidate("sheet-deleted")
+
+    current = get_vector_store("sheet-deleted")
+    assert current is not vector_store
+    assert not current.exists
+    assert current.count_documents() == 0
+
+
+def test_vector_store_recreated_on_another_worker_is_reloaded(
+    make_vector_store, other_worker
+):
+    from utils.vector_store import get_vector_store
+
+    vector_store = make_vector_store("sheet-recreated")
+    # /create-vector-store on the other worker
+    other_worker.invalidate("sheet-recreated")
+
+    current = get_vector_store("sheet-recreated", check_if_exists=True)
+    assert current is not vector_store
+    assert current.exists
+    assert current.count_documents() == vector_store.count_documents()
+
+
+def test_query_embedding_is_admitted_only_if_not_cached(make_vector_store, monkeypatch):
+    import utils.vector_store
+
+    vector_store = make_vector_store("sheet-admitted")
+    admitted = []
+    monkeypatch.setattr(
+        utils.vector_store.admission,
+        "admit",
+        lambda sheet_id, **kwargs: admitted.append((sheet_id, kwargs["priority"])),
+    )
+    for _ in range(2):
+        vector_store.similarity_search_with_score("where is the clinic?", k=3)
+    assert admitted == [("sheet-admitted", utils.vector_store.INTERACTIVE)]
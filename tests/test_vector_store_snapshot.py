@@ -0,0 +1,110 @@
+import io
+import os
+import tempfile
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from utils.constants import DocumentMetadata
+
+dm = DocumentMetadata()
+
+
+@pytest.fixture(scope="module")
+def vector_store(make_vector_store):
+    """Vector store of a sheet in the local stand-in of Azure AI Search"""
+    return make_vector_store("sheet-a")
+
+
+def export(google_sheet_id: str) -> tuple:
+    from utils.vector_store_snapshot import export_vector_store
+
+    snapshot = io.BytesIO()
+    manifest = export_vector_store(google_sheet_id, snapshot)
+    snapshot.seek(0)
+    return manifest, snapshot
+
+
+def test_export_writes_vectors_and_manifest(vector_store):
+    manifest, snapshot = export("sheet-a")
+    assert manifest["documents"] == vector_store.count_documents()
+    assert manifest["embedding_model"] == vector_store.embedding_model
+    assert not manifest["vectors_made_retrievable"]
+    with np.load(snapshot, allow_pickle=False) as arrays:
+        assert arrays["vectors"].shape == (
+            manifest["documents"],
+            manifest["dimensions"],
+        )
+        assert arrays["vectors"].dtype == np.float32
+
+
+def test_import_restores_documents_and_vectors(vector_store):
+    from utils.vector_store_snapshot import import_vector_store
+
+    _, snapshot = export("sheet-a")
+    imported, google_sheet_id = import_vector_store("sheet-b", snapshot)
+    assert google_sheet_id == "sheet-b"
+    assert imported.count_documents() == vector_store.count_documents()
+
+    def documents(store) -> dict:
+        return {doc["id"]: doc for doc in store.client.search(search_text="*")}
+
+    original, copy = documents(vector_store), documents(imported)
+    assert copy.keys() == original.keys()
+    for key, doc in original.items():
+        assert copy[key]["content"] == doc["content"]
+        assert copy[key][dm.GOOGLE_INDEX] == doc[dm.GOOGLE_INDEX]
+        np.testing.assert_allclose(
+            copy[key]["content_vector"], doc["content_vector"], rtol=1e-6
+        )
+
+    # the copy is searched like the original
+    query = next(iter(vector_store.client.search(search_text="*")))["content"]
+    assert [
+        doc.metadata[dm.GOOGLE_INDEX]
+        for doc, _ in imported.similarity_search_with_score(query, k=3)
+    ] == [
+        doc.metadata[dm.GOOGLE_INDEX]
+        for doc, _ in vector_store.similarity_search_with_score(query, k=3)
+    ]
+
+
+def test_import_rejects_invalid_snapshot(vector_store):
+    from utils.vector_store_snapshot import import_vector_store
+
+    with pytest.raises(HTTPException) as e:
+        import_vector_store("sheet-b", io.BytesIO(b"not a snapshot"))
+    assert e.value.status_code == 400
+
+
+def test_export_of_missing_vector_store_fails(vector_store):
+    with pytest.raises(HTTPException) as e:
+        export("missing-sheet")
+    assert e.value.status_code == 404
+
+
+def test_endpoints_export_and_import_snapshot(
+    vector_store, services, tmp_path, monkeypatch
+):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    client = TestClient(services["app"])
+    headers = {"Authorization": os.environ["API_KEY_WRITE"]}
+
+    response = client.post(
+        "/export-vector-store", json={"googleSheetId": "sheet-a"}, headers=headers
+    )
+    assert response.status_code == 200
+    assert response.headers["X-Vectors-Made-Retrievable"] == "false"
+    assert 'filename="sheet-a.npz"' in response.headers["Content-Disposition"]
+    # the temporary file of the snapshot is deleted once sent
+    assert list(tmp_path.glob("*.npz")) == []
+
+    response = client.post(
+        "/import-vector-store",
+        files={"file": ("sheet-a.npz", response.content)},
+        data={"googleSheetId": "sheet-c"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert f"with {vector_store.count_documents()} documents" in response.json()
@@ -0,0 +1,224 @@
+from __future__ import annotations
+import itertools
+import math
+import os
+import threading
+import time
+from fastapi import HTTPException
+from utils.logger import logger
+from utils.metrics import timed, ADMISSION_REQUESTS
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Rate limits of the calls to Azure OpenAI, per minute, for the whole process and per
+# sheet, in requests and in (estimated) tokens; 0 means no limit
+ADMISSION_GLOBAL_RPM = int(os.getenv("ADMISSION_GLOBAL_RPM", 0))
+ADMISSION_GLOBAL_TPM = int(os.getenv("ADMISSION_GLOBAL_TPM", 0))
+ADMISSION_SHEET_RPM = int(os.getenv("ADMISSION_SHEET_RPM", 0))
+ADMISSION_SHEET_TPM = int(os.getenv("ADMISSION_SHEET_TPM", 0))
+# Maximum number of requests waiting for admission; more are rejected right away
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 100))
+# Maximum time (seconds) a request waits for admission before being rejected
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", 10))
+ADMISSION_BACKGROUND_TIMEOUT = float(os.getenv("ADMISSION_BACKGROUND_TIMEOUT", 300))
+# Tokens an LLM answer is expected to use, on top of the prompt
+ADMISSION_COMPLETION_TOKENS = int(os.getenv("ADMISSION_COMPLETION_TOKENS", 1500))
+
+# Priorities, lower is served first
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough number of tokens of a text, ~4 characters per token"""
+    return math.ceil(len(text) / 4)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at limit per minute, holding at most 10 seconds of refill
+    (the window over which Azure OpenAI enforces its per-minute quotas).
+    A take larger than the capacity is allowed on a full bucket and empties it, without
+    leaving a debt that would hold back the requests after it.
+    """
+
+    def __init__(self, limit_per_minute: int):
+        self.rate = limit_per_minute / 60
+        self.capacity = max(self.rate * 10, 1.0)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until amount can be taken, 0 if it can be taken now"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0.0) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class _Waiter:
+    def __init__(self, sheet_id: str, tokens: int, priority: int, deadline: float):
+        self.sheet_id = sheet_id
+        self.tokens = tokens
+        self.priority = priority
+        self.deadline = deadline
+        self.admitted = False
+
+
+class AdmissionController:
+    """
+    Admission control of the calls to Azure OpenAI that:
+        1. Rate-limits requests and estimated tokens per sheet and for the whole process,
+           with token buckets
+        2. Admits waiting requests by priority (interactive before background), then by
+           arrival; a request waiting only for its own sheet's budget does not block others
+        3. Rejects requests with 429 when the queue is full or they cannot be admitted
+           before their deadline, instead of letting latency grow without bound
+    Limits apply per process: divide the deployment quota by the number of workers.
+    """
+
+    def __init__(
+        self,
+        global_rpm: int = ADMISSION_GLOBAL_RPM,
+        global_tpm: int = ADMISSION_GLOBAL_TPM,
+        sheet_rpm: int = ADMISSION_SHEET_RPM,
+        sheet_tpm: int = ADMISSION_SHEET_TPM,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+    ):
+        self.global_rpm = global_rpm
+        self.global_tpm = global_tpm
+        self.sheet_rpm = sheet_rpm
+        self.sheet_tpm = sheet_tpm
+        self.max_queue = max_queue
+        self.enabled = any([global_rpm, global_tpm, sheet_rpm, sheet_tpm])
+        self._global_buckets = self._make_buckets(global_rpm, global_tpm)
+        # googleSheetId -> (request bucket, token bucket)
+        self._sheet_buckets = {}
+        # (priority, arrival, waiter)
+        self._queue = []
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def _make_buckets(rpm: int, tpm: int) -> tuple:
+        return (
+            TokenBucket(rpm) if rpm else None,
+            TokenBucket(tpm) if tpm else None,
+        )
+
+    def _get_sheet_buckets(self, sheet_id: str) -> tuple:
+        if sheet_id not in self._sheet_buckets:
+            self._sheet_buckets[sheet_id] = self._make_buckets(
+                self.sheet_rpm, self.sheet_tpm
+            )
+        return self._sheet_buckets[sheet_id]
+
+    @staticmethod
+    def _time_until(buckets: tuple, tokens: int) -> float:
+        request_bucket, token_bucket = buckets
+        return max(
+            request_bucket.time_until(1) if request_bucket else 0.0,
+            token_bucket.time_until(tokens) if token_bucket else 0.0,
+        )
+
+    @staticmethod
+    def _take(buckets: tuple, tokens: int):
+        request_bucket, token_bucket = buckets
+        if request_bucket:
+            request_bucket.take(1)
+        if token_bucket:
+            token_bucket.take(tokens)
+
+    def _admit_waiters(self) -> float:
+        """Admit waiting requests in order, return the time until the next one may be admitted"""
+        next_wait = math.inf
+        for _, _, waiter in sorted(self._queue):
+            sheet_buckets = self._get_sheet_buckets(waiter.sheet_id)
+            sheet_wait = self._time_until(sheet_buckets, waiter.tokens)
+            if sheet_wait > 0:
+                # skip it, without holding back the requests of other sheets
+                next_wait = min(next_wait, sheet_wait)
+                continue
+            global_wait = self._time_until(self._global_buckets, waiter.tokens)
+            if global_wait > 0:
+                # requests behind it must not take the global budget it waits for
+                next_wait = min(next_wait, global_wait)
+                break
+            self._take(sheet_buckets, waiter.tokens)
+            self._take(self._global_buckets, waiter.tokens)
+            waiter.admitted = True
+        self._queue = [entry for entry in self._queue if not entry[2].admitted]
+        return next_wait
+
+    def _reject(self, waiter: _Waiter, reason: str, retry_after: float):
+        ADMISSION_REQUESTS.add(
+            priority=PRIORITY_NAMES[waiter.priority], result=f"rejected_{reason}"
+        )
+        logger.warning(
+            f"Rejected request of sheet {waiter.sheet_id} ({reason}, {len(self._queue)} waiting)"
+        )
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, try again later.",
+            headers={"Retry-After": str(max(math.ceil(min(retry_after, 60)), 1))},
+        )
+
+    def admit(
+        self,
+        sheet_id: str,
+        tokens: int,
+        priority: int = INTERACTIVE,
+        timeout: float = None,
+    ):
+        """
+        Wait until a call of the given sheet, using the given estimated number of tokens,
+        may be made. Raise HTTPException(429) if it cannot be admitted in time.
+        """
+        if not self.enabled:
+            return
+        if timeout is None:
+            timeout = (
+                ADMISSION_TIMEOUT
+                if priority == INTERACTIVE
+                else ADMISSION_BACKGROUND_TIMEOUT
+            )
+        waiter = _Waiter(sheet_id, tokens, priority, time.monotonic() + timeout)
+        with timed("admission", priority=PRIORITY_NAMES[priority]):
+            with self._condition:
+                if len(self._queue) >= self.max_queue:
+                    self._reject(waiter, "queue_full", timeout)
+                # fail fast if the sheet's own budget cannot cover the request in time
+                sheet_wait = self._time_until(self._get_sheet_buckets(sheet_id), tokens)
+                if sheet_wait > timeout:
+                    self._reject(waiter, "deadline", sheet_wait)
+                self._queue.append((priority, next(self._arrivals), waiter))
+                while True:
+                    next_wait = self._admit_waiters()
+                    if waiter.admitted:
+                        # others may be admissible too, e.g. of other sheets
+                        self._condition.notify_all()
+                        break
+                    remaining = waiter.deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._queue = [
+                            entry for entry in self._queue if entry[2] is not waiter
+                        ]
+                        self._condition.notify_all()
+                        self._reject(waiter, "deadline", next_wait)
+                    self._condition.wait(min(remaining, next_wait))
+        ADMISSION_REQUESTS.add(priority=PRIORITY_NAMES[priority], result="admitted")
+
+
+admission = AdmissionController()
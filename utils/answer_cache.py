@@ -0,0 +1,151 @@
+from __future__ import annotations
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+from utils.logger import logger
+from utils.metrics import count_cache
+from utils.cache import sheet_version
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+# Minimum cosine similarity between two questions to return the cached answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+# Time to live of a cached answer, in seconds
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))
+# Maximum number of cached answers per sheet
+ANSWER_CACHE_MAX_SIZE = int(os.getenv("ANSWER_CACHE_MAX_SIZE", 500))
+
+
+def get_prompt_version(prompt: str) -> str:
+    """Short hash of a system prompt, used to invalidate answers when the prompt changes"""
+    return hashlib.sha256(prompt.encode()).hexdigest()[:16]
+
+
+class AnswerCache:
+    """
+    Semantic cache of answers to first-turn questions that:
+        1. Is scoped per sheet, prompt version and sheet version, so that reindexing or
+           deleting a sheet on any worker invalidates its answers on all workers
+        2. Matches questions by cosine similarity of their embeddings
+        3. Evicts answers after a TTL, or the least recently used ones when full
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl: int = ANSWER_CACHE_TTL,
+        max_size: int = ANSWER_CACHE_MAX_SIZE,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # googleSheetId -> {"version", "embeddings", "entries"}, where entries[i]
+        # is [question, answer, created_at, last_used_at] of embeddings[i]
+        self._scopes = {}
+
+    def _get_scope(self, google_sheet_id: str, version: str) -> dict:
+        """Get the scope of a sheet, dropping it if the prompt or the sheet changed"""
+        scope = self._scopes.get(google_sheet_id)
+        if scope is None or scope["version"] != version:
+            scope = {
+                "version": version,
+                "embeddings": np.empty((0, 0), dtype=np.float32),
+                "entries": [],
+            }
+            self._scopes[google_sheet_id] = scope
+        return scope
+
+    def _remove(self, scope: dict, ixs: list):
+        """Remove entries from a scope"""
+        keep = [ix for ix in range(len(scope["entries"])) if ix not in set(ixs)]
+        scope["embeddings"] = scope["embeddings"][keep]
+        scope["entries"] = [scope["entries"][ix] for ix in keep]
+
+    def get(
+        self, google_sheet_id: str, prompt_version: str, embedding: list
+    ) -> str | None:
+        """Get the cached answer to the most similar question, if similar enough"""
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query)
+        version = f"{prompt_version}:{sheet_version(google_sheet_id)}"
+        now = time.time()
+        with self._lock:
+            scope = self._get_scope(google_sheet_id, version)
+            expired = [
+                ix
+                for ix, entry in enumerate(scope["entries"])
+                if now - entry[2] > self.ttl
+            ]
+            if expired:
+                self._remove(scope, expired)
+
+            if len(scope["entries"]) > 0:
+                similarities = scope["embeddings"] @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    count_cache("answer", hit=True)
+                    entry = scope["entries"][best]
+                    entry[3] = now
+                    logger.info(
+                        "Answer cache hit (similarity %.3f) for question: %s",
+                        similarities[best],
+                        entry[0],
+                    )
+                    return entry[1]
+            self.misses += 1
+            count_cache("answer", hit=False)
+        return None
+
+    def put(
+        self,
+        google_sheet_id: str,
+        prompt_version: str,
+        embedding: list,
+        question: str,
+        answer: str,
+    ):
+        """Cache the answer to a question, evicting the least recently used one if full"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        version = f"{prompt_version}:{sheet_version(google_sheet_id)}"
+        now = time.time()
+        with self._lock:
+            scope = self._get_scope(google_sheet_id, version)
+            if len(scope["entries"]) >= self.max_size:
+                lru = min(
+                    range(len(scope["entries"])),
+                    key=lambda ix: scope["entries"][ix][3],
+                )
+                self._remove(scope, [lru])
+            if len(scope["entries"]) == 0:
+                scope["embeddings"] = vector[np.newaxis, :]
+            else:
+                scope["embeddings"] = np.vstack([scope["embeddings"], vector])
+            scope["entries"].append([question, answer, now, now])
+
+    def invalidate(self, google_sheet_id: str):
+        """Drop all cached answers of a sheet, e.g. after its vector store is recreated"""
+        with self._lock:
+            self._scopes.pop(google_sheet_id, None)
+
+    def stats(self) -> dict:
+        """Hit and miss counts and hit ratio"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total > 0 else 0.0,
+                "size": sum(len(scope["entries"]) for scope in self._scopes.values()),
+            }
+
+
+answer_cache = AnswerCache()
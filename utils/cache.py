@@ -0,0 +1,350 @@
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from utils.logger import logger
+from utils.metrics import count_cache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Cache backend: "memory" (per process), "sqlite" (shared by the workers of a host),
+# "redis" (shared by all instances) or "none"
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "cache.sqlite3")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+# Scope versions are read from the backend at most once every CACHE_VERSION_TTL seconds
+# per worker, so invalidations reach the other workers within that time
+CACHE_VERSION_TTL = float(os.getenv("CACHE_VERSION_TTL", 5))
+
+# Default time to live (seconds) and maximum number of entries of each namespace,
+# overridable with CACHE_TTL_<NAMESPACE> and CACHE_MAX_ENTRIES_<NAMESPACE>
+NAMESPACES = {
+    "prompts": (5 * 60, 1000),
+    "translations": (7 * 24 * 60 * 60, 10000),
+    "embeddings": (7 * 24 * 60 * 60, 10000),
+    "search": (60 * 60, 5000),
+    "hierarchy": (60 * 60, 100),
+}
+
+
+class MemoryBackend:
+    """In-process LRU cache with expiry, one LRU per namespace"""
+
+    def __init__(self):
+        self._namespaces = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        with self._lock:
+            entries = self._namespaces.get(namespace)
+            if entries is None or key not in entries:
+                return None
+            value, expires_at = entries[key]
+            if expires_at < time.time():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return value
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: int, max_entries: int):
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, OrderedDict())
+            entries[key] = (value, time.time() + ttl)
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    def get_counter(self, namespace: str, key: str) -> int:
+        return self._counters.get((namespace, key), 0)
+
+    def incr(self, namespace: str, key: str) -> int:
+        with self._lock:
+            self._counters[(namespace, key)] = self.get_counter(namespace, key) + 1
+            return self._counters[(namespace, key)]
+
+
+class SQLiteBackend:
+    """
+    Cache in a SQLite file, shared by all worker processes of a host.
+    Expired entries are purged and every namespace written by this process is trimmed to
+    its most recently written entries every PURGE_EVERY writes.
+    """
+
+    PURGE_EVERY = 100
+
+    def __init__(self, path: str = CACHE_SQLITE_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._lock = threading.Lock()
+        self._n_writes = 0
+        # namespace -> maximum number of entries, of the namespaces written so far
+        self._max_entries = {}
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    written_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value INTEGER NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """)
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at >= ?",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: int, max_entries: int):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, value, now + ttl, now),
+            )
+            self._n_writes += 1
+            self._max_entries[namespace] = max_entries
+            if self._n_writes % self.PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+                for trimmed, trimmed_max_entries in self._max_entries.items():
+                    self._conn.execute(
+                        """
+                        DELETE FROM cache WHERE namespace = ? AND key NOT IN (
+                            SELECT key FROM cache WHERE namespace = ?
+                            ORDER BY written_at DESC LIMIT ?
+                        )
+                        """,
+                        (trimmed, trimmed, trimmed_max_entries),
+                    )
+
+    def get_counter(self, namespace: str, key: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM counters WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, namespace: str, key: str) -> int:
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO counters VALUES (?, ?, 1)
+                ON CONFLICT (namespace, key) DO UPDATE SET value = value + 1
+                """,
+                (namespace, key),
+            )
+            row = self._conn.execute(
+                "SELECT value FROM counters WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        return row[0]
+
+
+class RedisBackend:
+    """
+    Cache in Redis (or any server speaking the Redis protocol), shared by all instances.
+    Entries expire with their TTL; size is bounded by the server's maxmemory policy, which
+    should be volatile-lru so that scope versions (stored without TTL) are never evicted.
+    A client with the same interface can be passed instead, e.g. a local stand-in in tests.
+    """
+
+    def __init__(self, url: str = CACHE_REDIS_URL, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(
+                    "CACHE_BACKEND=redis requires the redis package: pip install redis"
+                )
+            client = redis.Redis.from_url(url)
+        self._client = client
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        return self._client.get(f"{namespace}:{key}")
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: int, max_entries: int):
+        self._client.set(f"{namespace}:{key}", value, ex=ttl)
+
+    def get_counter(self, namespace: str, key: str) -> int:
+        value = self._client.get(f"{namespace}:__counter__:{key}")
+        return int(value) if value else 0
+
+    def incr(self, namespace: str, key: str) -> int:
+        return int(self._client.incr(f"{namespace}:__counter__:{key}"))
+
+
+class NullBackend:
+    """No caching"""
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        return None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: int, max_entries: int):
+        pass
+
+    def get_counter(self, namespace: str, key: str) -> int:
+        return 0
+
+    def incr(self, namespace: str, key: str) -> int:
+        return 0
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Create the configured cache backend on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if CACHE_BACKEND == "memory":
+                    _backend = MemoryBackend()
+                elif CACHE_BACKEND == "sqlite":
+                    _backend = SQLiteBackend()
+                elif CACHE_BACKEND == "redis":
+                    _backend = RedisBackend()
+                elif CACHE_BACKEND == "none":
+                    _backend = NullBackend()
+                else:
+                    raise ValueError(
+                        f"Cache backend {CACHE_BACKEND} not available. Only 'memory', 'sqlite', 'redis' or 'none' are currently available."
+                    )
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the cache backend, e.g. with a local stand-in."""
+    global _backend
+    _backend = backend
+
+
+class Cache:
+    """
+    Cache of one namespace that:
+        1. Stores any picklable value (the backend must be trusted) for the namespace TTL
+        2. Groups keys by scope (e.g. a googleSheetId), each with a version stored in the
+           backend, so that invalidating a scope on one worker invalidates it on all of them
+           (versions are kept in-process for CACHE_VERSION_TTL, not read on every access)
+        3. Never fails a request: backend errors are logged and treated as misses
+    The maximum number of entries is enforced by the memory and sqlite backends; the redis
+    backend ignores it, the size of the cache is bounded by the server's maxmemory policy.
+    """
+
+    def __init__(self, namespace: str, ttl: int = None, max_entries: int = None):
+        default_ttl, default_max_entries = NAMESPACES.get(namespace, (60 * 60, 1000))
+        self.namespace = namespace
+        self.ttl = (
+            ttl
+            if ttl is not None
+            else int(os.getenv(f"CACHE_TTL_{namespace.upper()}", default_ttl))
+        )
+        self.max_entries = (
+            max_entries
+            if max_entries is not None
+            else int(
+                os.getenv(f"CACHE_MAX_ENTRIES_{namespace.upper()}", default_max_entries)
+            )
+        )
+        # scope -> (version, time it was read from the backend)
+        self._versions = {}
+
+    def version(self, scope: str) -> int:
+        """Current version of a scope, moved by invalidate on any worker"""
+        version, read_at = self._versions.get(scope, (None, 0.0))
+        if version is None or time.monotonic() - read_at > CACHE_VERSION_TTL:
+            version = get_backend().get_counter(self.namespace, f"version:{scope}")
+            self._versions[scope] = (version, time.monotonic())
+        return version
+
+    def _key(self, key, scope: str) -> str:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return f"{scope}:v{self.version(scope)}:{digest}"
+
+    def get(self, key, scope: str = "", default=None):
+        """Get a cached value, or default if not found"""
+        if self.ttl <= 0:
+            return default
+        try:
+            value = get_backend().get(self.namespace, self._key(key, scope))
+        except Exception as e:
+            logger.error(f"Could not read from cache {self.namespace}: {e}")
+            value = None
+        count_cache(self.namespace, hit=value is not None)
+        if value is None:
+            return default
+        return pickle.loads(value)[0]
+
+    def set(self, key, value, scope: str = ""):
+        """Cache a value"""
+        if self.ttl <= 0:
+            return
+        try:
+            get_backend().set(
+                self.namespace,
+                self._key(key, scope),
+                pickle.dumps((value,)),
+                self.ttl,
+                self.max_entries,
+            )
+        except Exception as e:
+            logger.error(f"Could not write to cache {self.namespace}: {e}")
+
+    def get_or_set(self, key, func, scope: str = ""):
+        """Get a cached value, or compute it with func() and cache it"""
+        missing = object()
+        value = self.get(key, scope, default=missing)
+        if value is missing:
+            value = func()
+            self.set(key, value, scope)
+        return value
+
+    def invalidate(self, scope: str):
+        """Invalidate all values of a scope, by moving to a new version"""
+        try:
+            version = get_backend().incr(self.namespace, f"version:{scope}")
+            self._versions[scope] = (version, time.monotonic())
+        except Exception as e:
+            logger.error(f"Could not invalidate cache {self.namespace}: {e}")
+
+
+prompt_cache = Cache("prompts")
+translation_cache = Cache("translations")
+embedding_cache = Cache("embeddings")
+search_cache = Cache("search")
+hierarchy_cache = Cache("hierarchy")
+
+
+def sheet_version(google_sheet_id: str) -> int | None:
+    """Version of the content of a sheet, shared by all workers, or None if unknown."""
+    try:
+        return search_cache.version(google_sheet_id)
+    except Exception as e:
+        logger.error(f"Could not read the version of sheet {google_sheet_id}: {e}")
+        return None
+
+
+def invalidate_sheet(google_sheet_id: str):
+    """Invalidate all cached values that depend on the content of a sheet, e.g. after a reindex."""
+    for cache in [prompt_cache, search_cache, hierarchy_cache]:
+        cache.invalidate(google_sheet_id)
@@ -0,0 +1,356 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.postgres import PostgresSaver
+from psycopg import Connection
+from psycopg.rows import dict_row
+from utils.logger import logger
+from utils.metrics import instrument_methods, EXPIRED_THREADS
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Checkpointers, where the chat endpoints keep the state of their threads: "postgres"
+# (the checkpoint database, shared by all instances), "sqlite" (a local file, shared by
+# the workers of a host) or "memory" (per process)
+POSTGRES = "postgres"
+SQLITE = "sqlite"
+MEMORY = "memory"
+CHECKPOINTERS = [POSTGRES, SQLITE, MEMORY]
+# Checkpointer of each chat endpoint
+CHECKPOINTER_CHAT_TWILIO = os.getenv("CHECKPOINTER_CHAT_TWILIO", POSTGRES).lower()
+CHECKPOINTER_CHAT_DUMMY = os.getenv("CHECKPOINTER_CHAT_DUMMY", MEMORY).lower()
+
+# Number of checkpoints to keep per thread, older ones are pruned after every turn (0 disables pruning)
+CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", 1))
+# Threads idle for longer than this are deleted: in days from the checkpoint database,
+# in seconds from the local checkpointers (0 disables expiry)
+CHECKPOINT_POSTGRES_TTL_DAYS = float(os.getenv("CHECKPOINT_POSTGRES_TTL_DAYS", 30))
+CHECKPOINT_LOCAL_TTL = float(os.getenv("CHECKPOINT_LOCAL_TTL", 24 * 60 * 60))
+# Maximum number of threads of the memory checkpointer, least recently used ones are evicted
+CHECKPOINT_MEMORY_MAX_THREADS = int(os.getenv("CHECKPOINT_MEMORY_MAX_THREADS", 10000))
+CHECKPOINT_SQLITE_PATH = os.getenv("CHECKPOINT_SQLITE_PATH", "checkpoints.sqlite3")
+# Idle threads of the postgres and sqlite checkpointers are looked for after a turn, at
+# most once every CHECKPOINT_EXPIRY_INTERVAL seconds per worker
+CHECKPOINT_EXPIRY_INTERVAL = float(os.getenv("CHECKPOINT_EXPIRY_INTERVAL", 60 * 60))
+# Idle threads are deleted from the checkpoint database at most this many per transaction
+CHECKPOINT_EXPIRY_BATCH_SIZE = int(os.getenv("CHECKPOINT_EXPIRY_BATCH_SIZE", 500))
+
+# Delete all but the latest checkpoints of a thread, then the writes and blobs that
+# are no longer referenced by any remaining checkpoint
+PRUNE_THREAD_SQL = [
+    """
+    DELETE FROM checkpoints
+    WHERE thread_id = %(thread_id)s
+    AND checkpoint_id NOT IN (
+        SELECT checkpoint_id FROM checkpoints
+        WHERE thread_id = %(thread_id)s
+        ORDER BY checkpoint_id DESC
+        LIMIT %(keep_last)s
+    )
+    """,
+    """
+    DELETE FROM checkpoint_writes
+    WHERE thread_id = %(thread_id)s
+    AND checkpoint_id NOT IN (
+        SELECT checkpoint_id FROM checkpoints WHERE thread_id = %(thread_id)s
+    )
+    """,
+    """
+    DELETE FROM checkpoint_blobs bl
+    WHERE bl.thread_id = %(thread_id)s
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoints cp, jsonb_each_text(cp.checkpoint -> 'channel_versions') cv
+        WHERE cp.thread_id = bl.thread_id
+        AND cp.checkpoint_ns = bl.checkpoint_ns
+        AND cv.key = bl.channel
+        AND cv.value = bl.version
+    )
+    """,
+]
+
+# Delete at most batch_size threads whose latest checkpoint is older than max_idle
+# seconds, with their writes and blobs, in one statement
+EXPIRE_THREADS_SQL = """
+WITH expired AS (
+    SELECT thread_id FROM checkpoints
+    GROUP BY thread_id
+    HAVING max((checkpoint ->> 'ts')::timestamptz) < now() - %(max_idle)s * interval '1 second'
+    LIMIT %(batch_size)s
+),
+deleted_writes AS (
+    DELETE FROM checkpoint_writes WHERE thread_id IN (SELECT thread_id FROM expired)
+),
+deleted_blobs AS (
+    DELETE FROM checkpoint_blobs WHERE thread_id IN (SELECT thread_id FROM expired)
+)
+DELETE FROM checkpoints WHERE thread_id IN (SELECT thread_id FROM expired)
+RETURNING thread_id
+"""
+
+
+class PostgresCheckpointer(PostgresSaver):
+    """Checkpoints in the checkpoint database, shared by all instances, with pruning and expiry"""
+
+    # connection string of the checkpoint database, to expire threads on a connection
+    # of their own (see _open_checkpointer)
+    conn_string = None
+
+    def prune_thread(self, thread_id: str, keep_last: int = 1):
+        """Delete old checkpoint versions of a thread, keeping only the latest ones."""
+        with self.lock, self.conn.transaction():
+            with self.conn.cursor() as cur:
+                for sql in PRUNE_THREAD_SQL:
+                    cur.execute(sql, {"thread_id": thread_id, "keep_last": keep_last})
+
+    def expire_threads(
+        self, max_idle: float, batch_size: int = CHECKPOINT_EXPIRY_BATCH_SIZE
+    ) -> int:
+        """
+        Delete the threads idle for longer than max_idle seconds, batch_size threads per
+        transaction, and return their number. Runs on a connection of its own, so that
+        the checkpoint reads and writes of chat turns do not wait for it.
+        """
+        n_threads = 0
+        with Connection.connect(
+            self.conn_string, autocommit=True, row_factory=dict_row
+        ) as conn:
+            while True:
+                with conn.transaction(), conn.cursor() as cur:
+                    cur.execute(
+                        EXPIRE_THREADS_SQL,
+                        {"max_idle": max_idle, "batch_size": batch_size},
+                    )
+                    n_expired = len({row["thread_id"] for row in cur.fetchall()})
+                n_threads += n_expired
+                if n_expired < batch_size:
+                    return n_threads
+
+
+class ExpiringMemorySaver(InMemorySaver):
+    """
+    Checkpoints in memory, for channels that do not need conversations to survive a
+    restart, bounded in time and size:
+        1. Threads are kept in order of last use (LRU)
+        2. Threads idle for longer than ttl seconds are forgotten
+        3. The least recently used threads beyond max_threads are evicted
+    """
+
+    def __init__(
+        self,
+        ttl: float = CHECKPOINT_LOCAL_TTL,
+        max_threads: int = CHECKPOINT_MEMORY_MAX_THREADS,
+    ):
+        super().__init__()
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self.lock = threading.RLock()
+        # thread ID -> time of last use, least recently used first
+        self._last_used = OrderedDict()
+
+    def _is_expired(self, thread_id: str) -> bool:
+        last_used = self._last_used.get(thread_id)
+        return (
+            bool(self.ttl)
+            and last_used is not None
+            and (time.monotonic() - last_used > self.ttl)
+        )
+
+    def _delete_threads(self, thread_ids: set):
+        for thread_id in thread_ids:
+            self._last_used.pop(thread_id, None)
+            self.storage.pop(thread_id, None)
+        for key in [key for key in self.writes if key[0] in thread_ids]:
+            del self.writes[key]
+        for key in [key for key in self.blobs if key[0] in thread_ids]:
+            del self.blobs[key]
+
+    def _evict(self, max_idle: float) -> int:
+        """Forget threads idle for longer than max_idle and evict the least recently used ones, return their number"""
+        now = time.monotonic()
+        n_threads = len(self._last_used)
+        evicted = set()
+        for thread_id, last_used in self._last_used.items():
+            if n_threads - len(evicted) <= self.max_threads and (
+                not max_idle or now - last_used <= max_idle
+            ):
+                break
+            evicted.add(thread_id)
+        if evicted:
+            self._delete_threads(evicted)
+        return len(evicted)
+
+    def _touch(self, thread_id: str):
+        self._last_used[thread_id] = time.monotonic()
+        self._last_used.move_to_end(thread_id)
+        n_evicted = self._evict(self.ttl)
+        if n_evicted:
+            EXPIRED_THREADS.add(n_evicted, checkpointer=MEMORY)
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            if self._is_expired(thread_id):
+                self._delete_threads({thread_id})
+                EXPIRED_THREADS.add(1, checkpointer=MEMORY)
+            return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self.lock:
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            self._touch(config["configurable"]["thread_id"])
+            return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        with self.lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self._touch(config["configurable"]["thread_id"])
+
+    def delete_thread(self, thread_id: str):
+        with self.lock:
+            self._last_used.pop(thread_id, None)
+            super().delete_thread(thread_id)
+
+    def prune_thread(self, thread_id: str, keep_last: int = 1):
+        """Delete old checkpoint versions of a thread, and their writes and blobs."""
+        with self.lock:
+            namespaces = self.storage.get(thread_id, {})
+            kept_versions = set()
+            for checkpoint_ns, checkpoints in namespaces.items():
+                for checkpoint_id in sorted(checkpoints)[:-keep_last]:
+                    del checkpoints[checkpoint_id]
+                for saved_checkpoint, _, _ in checkpoints.values():
+                    checkpoint = self.serde.loads_typed(saved_checkpoint)
+                    kept_versions.update(
+                        (checkpoint_ns, channel, version)
+                        for channel, version in checkpoint["channel_versions"].items()
+                    )
+            for key in [key for key in self.writes if key[0] == thread_id]:
+                if key[2] not in namespaces.get(key[1], {}):
+                    del self.writes[key]
+            for key in [key for key in self.blobs if key[0] == thread_id]:
+                if key[1:] not in kept_versions:
+                    del self.blobs[key]
+
+    def expire_threads(self, max_idle: float) -> int:
+        """Forget the threads idle for longer than max_idle seconds, return their number."""
+        with self.lock:
+            return self._evict(max_idle)
+
+
+def _open_checkpointer(name: str):
+    """Open the checkpointer of the given name, return it and its context, if any."""
+    if name == POSTGRES:
+        db_uri = f'postgresql://{os.environ["CHECKPOINT_DB_USER"]}:{os.environ["CHECKPOINT_DB_PASSWORD"]}@{os.environ["CHECKPOINT_DB_HOST"]}'
+        context = PostgresCheckpointer.from_conn_string(db_uri)
+        checkpointer = context.__enter__()
+        checkpointer.conn_string = db_uri
+        return checkpointer, context
+    elif name == SQLITE:
+        try:
+            # imported here, as it is only needed by this checkpointer
+            from utils.sqlite_checkpointer import SqliteCheckpointer
+        except ImportError:
+            raise ImportError(
+                "The sqlite checkpointer requires the langgraph-checkpoint-sqlite package: poetry install --extras sqlite"
+            )
+        context = SqliteCheckpointer.from_conn_string(CHECKPOINT_SQLITE_PATH)
+        return context.__enter__(), context
+    elif name == MEMORY:
+        return ExpiringMemorySaver(), None
+    raise ValueError(
+        f"Checkpointer {name} not available. Only 'postgres', 'sqlite' or 'memory' are currently available."
+    )
+
+
+_checkpointers = {}
+_checkpointer_contexts = {}
+_checkpointer_lock = threading.Lock()
+
+
+def get_checkpointer(name: str = POSTGRES):
+    """Open the checkpointer of the given name on first use (e.g. connect to the checkpoint database), and return it."""
+    if name not in _checkpointers:
+        with _checkpointer_lock:
+            if name not in _checkpointers:
+                checkpointer, context = _open_checkpointer(name)
+                instrument_methods(
+                    checkpointer,
+                    {
+                        "get_tuple": "checkpoint_read",
+                        "put": "checkpoint_write",
+                        "put_writes": "checkpoint_write",
+                    },
+                )
+                _checkpointer_contexts[name] = context
+                _checkpointers[name] = checkpointer
+    return _checkpointers[name]
+
+
+def close_checkpointer():
+    """Close the open checkpointers, e.g. the connection to the checkpoint database."""
+    with _checkpointer_lock:
+        for context in _checkpointer_contexts.values():
+            if context is not None:
+                context.__exit__(None, None, None)
+        _checkpointers.clear()
+        _checkpointer_contexts.clear()
+
+
+# Pruning and expiry run off the request path, one at a time
+_pruning_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prune")
+# Checkpointer name -> time of the last expiry run of this worker
+_last_expiry = {}
+
+
+def prune_thread(
+    thread_id: str, keep_last: int = CHECKPOINT_KEEP_LAST, name: str = POSTGRES
+):
+    """Delete old checkpoint versions of a thread, keeping only the latest ones."""
+    get_checkpointer(name).prune_thread(thread_id, keep_last)
+
+
+def expire_threads(name: str = POSTGRES):
+    """Delete the threads of a checkpointer idle for longer than its TTL, if it has one."""
+    max_idle = (
+        CHECKPOINT_POSTGRES_TTL_DAYS * 24 * 60 * 60
+        if name == POSTGRES
+        else CHECKPOINT_LOCAL_TTL
+    )
+    if max_idle <= 0:
+        return
+    n_threads = get_checkpointer(name).expire_threads(max_idle)
+    if n_threads:
+        EXPIRED_THREADS.add(n_threads, checkpointer=name)
+        logger.info(f"Deleted {n_threads} idle threads from the {name} checkpointer.")
+
+
+def maintain_thread(thread_id: str, name: str = POSTGRES):
+    """
+    After a turn: prune old checkpoint versions of the thread, and expire idle threads
+    if the last expiry run of this worker is old enough.
+    """
+    if CHECKPOINT_KEEP_LAST > 0:
+        prune_thread(thread_id, CHECKPOINT_KEEP_LAST, name)
+    now = time.monotonic()
+    if (
+        name not in _last_expiry
+        or now - _last_expiry[name] >= CHECKPOINT_EXPIRY_INTERVAL
+    ):
+        _last_expiry[name] = now
+        expire_threads(name)
+
+
+def _log_pruning_error(future):
+    if future.exception() is not None:
+        logger.error(f"Could not prune checkpoints: {future.exception()}")
+
+
+def schedule_prune_thread(thread_id: str, name: str = POSTGRES):
+    """Prune old checkpoint versions of a thread, and expire idle threads, in the background."""
+    future = _pruning_executor.submit(maintain_thread, thread_id, name)
+    future.add_done_callback(_log_pruning_error)
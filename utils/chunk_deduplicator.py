@@ -0,0 +1,122 @@
+from __future__ import annotations
+import re
+import zlib
+from collections import defaultdict
+from typing import List
+import numpy as np
+from langchain_core.documents import Document
+from utils.constants import DocumentMetadata
+
+dm = DocumentMetadata()
+
+WORD_PATTERN = re.compile(r"\w+")
+# MinHash signatures of NUM_PERMUTATIONS hashes, split into NUM_BANDS bands for
+# locality-sensitive hashing: chunks sharing a band are compared. With 16 bands of 8
+# rows, chunks of Jaccard similarity 0.9 are compared with a probability of 99.99%,
+# chunks of similarity 0.5 with a probability of 6%
+NUM_PERMUTATIONS = 128
+NUM_BANDS = 16
+# Hash permutations (a * x + b) mod prime, the same for every sheet
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(1)
+_A = _rng.randint(1, 2**32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.randint(0, 2**32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+class ChunkDeduplicator:
+    """
+    Near-duplicate detection of chunks (repeated disclaimers, contact blocks, answers
+    copy-pasted across subcategories) that:
+        1. Represents each chunk by its set of word shingles and their MinHash signature
+        2. Compares only chunks sharing a band of their signatures (LSH), by the Jaccard
+           similarity of their shingles
+        3. Merges each chunk into the first earlier chunk similar enough, which keeps the
+           metadata of the merged chunks (duplicates) and is the only one embedded
+    """
+
+    output: List[Document]
+
+    def __init__(self, threshold: float = 0.9, shingle_size: int = 3):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+    def _shingles(self, text: str) -> set:
+        """Sets of shingle_size consecutive words, ignoring case and punctuation"""
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)} if words else set()
+        return {
+            " ".join(words[ix : ix + self.shingle_size])
+            for ix in range(len(words) - self.shingle_size + 1)
+        }
+
+    @staticmethod
+    def _signature(shingles: set) -> np.ndarray:
+        """MinHash signature of a set of shingles"""
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        return ((np.outer(hashes, _A) + _B) % _MERSENNE_PRIME).min(axis=0)
+
+    @staticmethod
+    def _band_keys(signature: np.ndarray) -> list:
+        rows = NUM_PERMUTATIONS // NUM_BANDS
+        return [
+            (band, signature[band * rows : (band + 1) * rows].tobytes())
+            for band in range(NUM_BANDS)
+        ]
+
+    @staticmethod
+    def _jaccard(a: set, b: set) -> float:
+        return len(a & b) / len(a | b)
+
+    def find_duplicates(self, texts: List[str]) -> dict:
+        """Map the position of each kept text to the positions of its near-duplicates"""
+        buckets = defaultdict(list)
+        shingle_sets = []
+        duplicates = {}
+        for ix, text in enumerate(texts):
+            shingles = self._shingles(text)
+            shingle_sets.append(shingles)
+            if not shingles:
+                duplicates[ix] = []
+                continue
+            keys = self._band_keys(self._signature(shingles))
+            candidates = dict.fromkeys(kept for key in keys for kept in buckets[key])
+            similarities = {
+                kept: self._jaccard(shingles, shingle_sets[kept]) for kept in candidates
+            }
+            best = max(similarities, key=similarities.get, default=None)
+            if best is not None and similarities[best] >= self.threshold:
+                duplicates[best].append(ix)
+                continue
+            duplicates[ix] = []
+            for key in keys:
+                buckets[key].append(ix)
+        return duplicates
+
+    def deduplicate(self, documents: List[Document]) -> List[Document]:
+        """
+        Keep one chunk of each group of near-duplicates, with the metadata of the others
+        in its metadata (duplicates)
+        """
+        kept_documents = []
+        for ix, duplicate_ixs in self.find_duplicates(
+            [doc.page_content for doc in documents]
+        ).items():
+            doc = documents[ix]
+            if duplicate_ixs:
+                doc = Document(
+                    page_content=doc.page_content,
+                    metadata={
+                        **doc.metadata,
+                        dm.DUPLICATES: [
+                            documents[duplicate_ix].metadata
+                            for duplicate_ix in duplicate_ixs
+                        ],
+                    },
+                )
+            kept_documents.append(doc)
+        return kept_documents
@@ -1,3 +1,7 @@
+# tiktoken encoding used to count tokens, both when chunking and when packing the prompt context
+TIKTOKEN_ENCODING = "cl100k_base"
+
+
 class DocumentMetadata:
     """Document class metadata keys"""
 
@@ -10,9 +14,14 @@ class DocumentMetadata:
     PARENT = "parent"
     QUESTION = "question"
     ANSWER = "answer"
+    # rows of the chunks merged into a chunk as near-duplicates, and their categories
+    DUPLICATES = "duplicates"
+    DUPLICATE_CATEGORIES = "duplicate_categoryIDs"
+    DUPLICATE_SUBCATEGORIES = "duplicate_subcategoryIDs"
     # splitting and embedding fields
     EMBEDDING_MODEL = "embedding_model"
     NTH_CHUNK = "nth_chunk"
+    CONTENT_HASH = "content_hash"
     # search result fields
     SCORE = "score"
     CHILDREN = "children"
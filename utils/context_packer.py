@@ -0,0 +1,108 @@
+from __future__ import annotations
+from typing import List
+import tiktoken
+from langchain_core.documents import Document
+from utils.constants import DocumentMetadata, TIKTOKEN_ENCODING
+
+dm = DocumentMetadata()
+
+# Minimum number of characters two consecutive chunks must share to be considered overlapping
+MIN_OVERLAP_CHARS = 10
+
+
+class ContextPacker:
+    """
+    Context packing class that:
+        1. Merges consecutive chunks of the same document (row), removing their overlap
+        2. Drops duplicates
+        3. Fills a token budget with the highest scoring documents
+    """
+
+    output: List[str]
+
+    def __init__(self, token_budget: int, encoding_name: str = TIKTOKEN_ENCODING):
+        self.token_budget = token_budget
+        self.encoding_name = encoding_name
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        """Tokenizer, loaded on first use (tiktoken caches it)"""
+        return tiktoken.get_encoding(self.encoding_name)
+
+    def count_tokens(self, text: str) -> int:
+        """Count the number of tokens in a text, with the same encoding used for chunking"""
+        return len(self.encoding.encode(text))
+
+    def _merge_texts(self, text: str, next_text: str) -> str:
+        """
+        Merge two consecutive chunks, removing the longest suffix of the first one
+        that is also a prefix of the second one (the chunk overlap)
+        """
+        text, next_text = text.strip(), next_text.strip()
+        start = text.find(next_text[:MIN_OVERLAP_CHARS])
+        while start != -1:
+            if next_text.startswith(text[start:]):
+                return text[:start] + next_text
+            start = text.find(next_text[:MIN_OVERLAP_CHARS], start + 1)
+        return f"{text} {next_text}"
+
+    def _merge_chunks(self, documents: List[Document]) -> List[tuple[str, float]]:
+        """
+        Group chunks by document (google_index), merge runs of consecutive chunks (nth_chunk)
+        and return the merged texts with the highest score of their chunks
+        """
+        chunks = {}
+        for doc in documents:
+            key = (doc.metadata.get(dm.GOOGLE_INDEX), doc.metadata.get(dm.NTH_CHUNK))
+            score = doc.metadata.get(dm.SCORE, 0.0)
+            # drop duplicate chunks, keeping the highest score
+            if key not in chunks or chunks[key][1] < score:
+                chunks[key] = (doc.page_content, score)
+
+        merged = []
+        previous_key = None
+        for key in sorted(chunks, key=lambda k: (str(k[0]), k[1] or 0)):
+            text, score = chunks[key]
+            if (
+                previous_key is not None
+                and key[0] is not None
+                and key[0] == previous_key[0]
+                and key[1] == previous_key[1] + 1
+            ):
+                previous_text, previous_score = merged[-1]
+                merged[-1] = (
+                    self._merge_texts(previous_text, text),
+                    max(previous_score, score),
+                )
+            else:
+                merged.append((text.strip(), score))
+            previous_key = key
+        return merged
+
+    def pack(self, documents: List[Document]) -> List[str]:
+        """
+        Pack documents into a list of texts that fits the token budget, by descending score
+        """
+        packed = []
+        seen = set()
+        n_tokens = 0
+        for text, score in sorted(
+            self._merge_chunks(documents), key=lambda x: x[1], reverse=True
+        ):
+            if text in seen:
+                continue
+            seen.add(text)
+            text_tokens = self.count_tokens(text)
+            if n_tokens + text_tokens > self.token_budget:
+                if len(packed) == 0:
+                    # always keep the best document, truncated to the budget
+                    packed.append(
+                        self.encoding.decode(
+                            self.encoding.encode(text)[: self.token_budget]
+                        )
+                    )
+                    n_tokens = self.token_budget
+                continue
+            packed.append(text)
+            n_tokens += text_tokens
+        return packed
@@ -3,13 +3,14 @@ from typing import List
 import re
 
 from langchain_core.documents import Document
-from langchain_text_splitters import SpacyTextSplitter
 from utils.logger import logger
-from utils.constants import DocumentMetadata
-
+from utils.constants import DocumentMetadata, TIKTOKEN_ENCODING
 
 dm = DocumentMetadata()
 
+# Chunkers by strategy and arguments, since loading a spaCy pipeline is slow
+_chunkers = {}
+
 
 class DocumentChunker:
     """
@@ -21,13 +22,19 @@ class DocumentChunker:
     def __init__(self, chunking_strategy: str, **kwargs: dict):
         self.chunking_strategy = chunking_strategy
         self.__dict__.update(kwargs)
-        self.chunker = self._set_chunker()
+        key = (chunking_strategy.lower(), repr(sorted(kwargs.items())))
+        if key not in _chunkers:
+            _chunkers[key] = self._set_chunker()
+        self.chunker = _chunkers[key]
 
     def _set_chunker(self):
         """instantiates a document chunker based on the document strategy.
         Custom chunking strategies can be added by creating one that inherits from the ** langchain class.
         and adding them here.
         """
+        # imported here, as it imports spaCy
+        from langchain_text_splitters import SpacyTextSplitter
+
         if self.chunking_strategy.lower() == "sentencesplitting":
             """Splitting text using Spacy package."""
             logger.info("Using Langchain SpacyTextSplitter for chunking the documents")
@@ -45,7 +52,7 @@ class DocumentChunker:
                 chunk_overlap=self.kwargs["chunk_overlap"],
                 separator=self.kwargs.get("separator", "\n\n"),
                 pipeline=self.kwargs.get("pipeline", "en_core_web_sm"),
-                encoding_name=self.kwargs.get("encoding_name", "cl100k_base"),
+                encoding_name=self.kwargs.get("encoding_name", TIKTOKEN_ENCODING),
             )
         else:
             raise NotImplementedError(
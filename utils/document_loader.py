@@ -1,14 +1,15 @@
 from typing import List
 
-import urllib
+import io
+import requests
 from langchain_core.documents import Document
 import pandas as pd
 from utils.constants import DocumentMetadata
 from utils.logger import logger
-from langchain_community.document_loaders import DataFrameLoader
+from utils.metrics import timed
+from utils.http_client import google_sheets_client
 import uuid
 from fastapi import HTTPException
-from cleantext import clean
 from utils.translator import translate, detect_language
 
 dm = DocumentMetadata()
@@ -49,12 +50,19 @@ class DocumentLoader:
             sheet_name = "Q%26As"
             url = f"https://docs.google.com/spreadsheets/d/{self.document_id}/gviz/tq?tqx=out:csv&sheet={sheet_name}"
             try:
-                df = pd.read_csv(url)
-            except urllib.error.HTTPError as e:
+                with timed("sheet_fetch", sheet=sheet_name):
+                    response = google_sheets_client.get(url)
+            except requests.RequestException as e:
                 raise HTTPException(
-                    status_code=e.code,
+                    status_code=503,
                     detail=f"Could not load Google Sheet with ID {self.document_id}: {e}",
                 )
+            if not response.ok:
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=f"Could not load Google Sheet with ID {self.document_id}: {response.status_code} {response.reason}",
+                )
+            df = pd.read_csv(io.BytesIO(response.content))
 
         elif self.document_type.lower() == "json":
             logger.info("Loading from JSON.")
@@ -138,7 +146,9 @@ class DocumentLoader:
 
         df["text"] = df.apply(translate_row, axis=1)
 
-        # map to langchain doc
+        # map to langchain doc (imported here, as the document loaders import spaCy)
+        from langchain_community.document_loaders import DataFrameLoader
+
         documents = DataFrameLoader(df, page_content_column="text").load()
         return documents
 
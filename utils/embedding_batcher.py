@@ -0,0 +1,147 @@
+from __future__ import annotations
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import List
+from fastapi import HTTPException
+from utils.logger import logger
+from utils.metrics import (
+    timed,
+    count_outbound,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_FILL,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Queries arriving within this window (milliseconds) are embedded together; 0 disables batching
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", 5))
+# Maximum number of queries embedded together
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", 16))
+# Maximum number of batches being embedded at the same time
+QUERY_BATCH_WORKERS = int(os.getenv("QUERY_BATCH_WORKERS", 4))
+# Maximum time (seconds) a request waits for the embedding of its query
+QUERY_BATCH_TIMEOUT = float(os.getenv("QUERY_BATCH_TIMEOUT", 30))
+
+
+class EmbeddingBatcher:
+    """
+    Scheduler in front of an embedding model that:
+        1. Collects the queries of concurrent requests, from the first one until the
+           batch window has passed or the batch is full
+        2. Embeds each batch with a single embed_documents call
+        3. Returns to each caller the embedding of its own query, or fails it if its
+           batch fails or takes longer than the caller's timeout
+    """
+
+    def __init__(
+        self,
+        embedder,
+        name: str,
+        window_ms: float = QUERY_BATCH_WINDOW_MS,
+        max_batch_size: int = QUERY_BATCH_MAX_SIZE,
+        workers: int = QUERY_BATCH_WORKERS,
+    ):
+        self.embedder = embedder
+        self.name = name
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.enabled = self.window > 0 and self.max_batch_size > 1
+        self._queue = queue.SimpleQueue()
+        if self.enabled:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="embedding-batch"
+            )
+            self._thread = threading.Thread(
+                target=self._collect, name="embedding-batcher", daemon=True
+            )
+            self._thread.start()
+
+    @property
+    def service(self) -> str:
+        return self.name.split("/")[0].lower()
+
+    def embed_query(self, query: str, timeout: float = None) -> List[float]:
+        """
+        Embed a query, together with the queries of concurrent requests. Raise
+        HTTPException(504) if it takes longer than timeout (default QUERY_BATCH_TIMEOUT).
+        """
+        if not self.enabled:
+            count_outbound(f"{self.service}_embeddings")
+            return self.embedder.embed_query(query)
+        future = Future()
+        self._queue.put((query, future))
+        try:
+            return future.result(
+                timeout=QUERY_BATCH_TIMEOUT if timeout is None else timeout
+            )
+        except TimeoutError:
+            logger.warning(f"Embedding of a query with {self.name} timed out")
+            raise HTTPException(
+                status_code=504, detail="Embedding the query timed out."
+            )
+
+    def _collect(self):
+        """Collect queued queries into batches, in a background thread"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._executor.submit(self._embed_batch, batch)
+            except Exception as e:
+                # e.g. the executor is shut down at exit: fail the batch, keep collecting
+                self._fail_batch(batch, e)
+
+    def _fail_batch(self, batch: list, e: Exception):
+        logger.error(f"Could not embed batch of {len(batch)} queries: {e}")
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+    def _embed_batch(self, batch: list):
+        """Embed a batch of queries and hand each embedding to its caller"""
+        EMBEDDING_BATCH_SIZE.record(len(batch), model=self.name)
+        EMBEDDING_BATCH_FILL.record(len(batch) / self.max_batch_size, model=self.name)
+        try:
+            with timed("query_embedding_batch", size=len(batch)):
+                count_outbound(f"{self.service}_embeddings")
+                embeddings = self.embedder.embed_documents(
+                    [query for query, _ in batch]
+                )
+            if len(embeddings) != len(batch):
+                raise ValueError(
+                    f"Got {len(embeddings)} embeddings for {len(batch)} queries"
+                )
+        except Exception as e:
+            self._fail_batch(batch, e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+
+# "<embedding source>/<embedding model>" -> EmbeddingBatcher, shared by all vector stores
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(
+    embedding_source: str, embedding_model: str, embedder
+) -> EmbeddingBatcher:
+    """Get the batcher of an embedding model, creating it with the given embedder on first use."""
+    name = f"{embedding_source}/{embedding_model}"
+    if name not in _batchers:
+        with _batchers_lock:
+            if name not in _batchers:
+                _batchers[name] = EmbeddingBatcher(embedder, name)
+    return _batchers[name]
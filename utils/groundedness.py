@@ -1,13 +1,39 @@
-import re
-import requests
+import random
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from dotenv import load_dotenv
 from utils.logger import logger
+from utils.metrics import timed
+from utils.http_client import content_safety_client
 
 load_dotenv()
 
+# Groundedness check mode: "off", "shadow" (only log ungrounded content) or "blocking"
+# (redact ungrounded content if the check finishes within the timeout)
+GROUNDEDNESS_MODE = os.getenv("GROUNDEDNESS_MODE", "off").lower()
+# Latency budget of the groundedness check, in seconds
+GROUNDEDNESS_TIMEOUT = float(os.getenv("GROUNDEDNESS_TIMEOUT", 2.0))
+# Fraction of responses that are checked
+GROUNDEDNESS_SAMPLE_RATE = float(os.getenv("GROUNDEDNESS_SAMPLE_RATE", 1.0))
+# Minimum fraction of ungrounded content to redact a response
+UNGROUNDED_THRESHOLD = 0.25
+
+# Maximum number of checks running or waiting for a worker; further responses are not
+# checked, so that checks do not pile up under load
+GROUNDEDNESS_MAX_PENDING = int(os.getenv("GROUNDEDNESS_MAX_PENDING", 100))
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GROUNDEDNESS_WORKERS", 4)),
+    thread_name_prefix="groundedness",
+)
+_pending = threading.BoundedSemaphore(GROUNDEDNESS_MAX_PENDING)
 
-def detect_groundness(content_text: str, grounding_sources: list, query: str):
+
+def _detect_ungrounded(
+    content_text: str, grounding_sources: list, query: str, timeout: float = None
+):
+    """Call the groundedness detection API, return its result or None if it failed."""
 
     subscription_key = os.environ["AISAFETY_API_KEY"]
     endpoint = os.environ["AISAFETY_ENDPOINT"]
@@ -39,25 +65,117 @@ def detect_groundness(content_text: str, grounding_sources: list, query: str):
         "Content-Type": "application/json",
         "Ocp-Apim-Subscription-Key": subscription_key,
     }
-    response = requests.post(url, headers=headers, json=data)
+    with timed("groundedness_check"):
+        response = content_safety_client.post(
+            url, headers=headers, json=data, timeout=timeout
+        )
 
     # Handle the API response
     if response.status_code == 200:
-        result = response.json()
-        if result["ungroundedDetected"] and result["ungroundedPercentage"] >= 0.25:
-            for detail in result["ungroundedDetails"]:
-                # Redact ungrounded content
-                from_character = detail["offset"]["utf8"]
-                to_character = from_character + detail["length"]["utf8"]
-                content_text = content_text.replace(
-                    content_text[from_character:to_character], ""
-                )
-                logger.info(
-                    f"Ungrounded content redacted: {content_text[from_character:to_character]}. "
-                    f"Reason: {detail['reason']}. "
-                    f"User query: {query}. "
-                    f"Grounding sources: {grounding_sources}."
-                )
-    else:
-        logger.error("Error in detect_groundness:", response.status_code, response.text)
-    return content_text
+        return response.json()
+    logger.error(f"Error in detect_groundness: {response.status_code} {response.text}")
+    return None
+
+
+def redact_ungrounded(
+    content_text: str, result: dict, grounding_sources: list, query: str
+) -> str:
+    """Remove the ungrounded content found by the groundedness detection API, in a single pass."""
+    if not (
+        result["ungroundedDetected"]
+        and result["ungroundedPercentage"] >= UNGROUNDED_THRESHOLD
+    ):
+        return content_text
+
+    # character (code point) ranges of ungrounded content, in order
+    spans = []
+    for detail in result["ungroundedDetails"]:
+        from_character = detail["offset"]["codePoint"]
+        to_character = from_character + detail["length"]["codePoint"]
+        spans.append((from_character, to_character))
+        logger.info(
+            "Ungrounded content detected: %s. Reason: %s. User query: %s. Grounding sources: %s.",
+            content_text[from_character:to_character],
+            detail.get("reason"),
+            query,
+            grounding_sources,
+        )
+
+    # keep the text between ungrounded ranges, merging overlapping ones
+    redacted = []
+    position = 0
+    for from_character, to_character in sorted(spans):
+        if from_character > position:
+            redacted.append(content_text[position:from_character])
+        position = max(position, to_character)
+    redacted.append(content_text[position:])
+    return "".join(redacted)
+
+
+def detect_groundness(content_text: str, grounding_sources: list, query: str):
+    """Check groundedness and redact ungrounded content, waiting for the result."""
+    result = _detect_ungrounded(content_text, grounding_sources, query)
+    if result is None:
+        return content_text
+    return redact_ungrounded(content_text, result, grounding_sources, query)
+
+
+def check_groundedness(
+    content_text: str,
+    grounding_sources: list,
+    query: str,
+    mode: str = GROUNDEDNESS_MODE,
+    timeout: float = GROUNDEDNESS_TIMEOUT,
+    sample_rate: float = GROUNDEDNESS_SAMPLE_RATE,
+) -> str:
+    """
+    Check groundedness asynchronously, within a latency budget:
+    * in "shadow" mode, return the content immediately and only log ungrounded content
+    * in "blocking" mode, redact ungrounded content if the check finishes within the timeout,
+      otherwise return the content as is (and log the result when it arrives)
+    Responses are not checked while GROUNDEDNESS_MAX_PENDING checks are pending.
+    """
+    if mode not in ["shadow", "blocking"] or random.random() >= sample_rate:
+        return content_text
+
+    if not _pending.acquire(blocking=False):
+        logger.warning(
+            f"{GROUNDEDNESS_MAX_PENDING} groundedness checks pending, response not checked."
+        )
+        return content_text
+    # the HTTP timeout bounds the background check too, so that workers never hang
+    try:
+        future = _executor.submit(
+            _detect_ungrounded, content_text, grounding_sources, query, 5 * timeout
+        )
+    except Exception:
+        _pending.release()
+        raise
+    future.add_done_callback(lambda _: _pending.release())
+
+    def log_result(done_future):
+        if done_future.exception() is not None:
+            logger.error(f"Error in detect_groundness: {done_future.exception()}")
+        elif done_future.result() is not None:
+            redact_ungrounded(
+                content_text, done_future.result(), grounding_sources, query
+            )
+
+    if mode == "shadow":
+        future.add_done_callback(log_result)
+        return content_text
+
+    try:
+        result = future.result(timeout=timeout)
+    except TimeoutError:
+        logger.warning(
+            f"Groundedness check exceeded its budget of {timeout}s, response not redacted."
+        )
+        future.add_done_callback(log_result)
+        return content_text
+    except Exception as e:
+        logger.error(f"Error in detect_groundness: {e}")
+        return content_text
+    if result is None:
+        return content_text
+    return redact_ungrounded(content_text, result, grounding_sources, query)
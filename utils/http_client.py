@@ -0,0 +1,259 @@
+from __future__ import annotations
+import os
+import random
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait as wait_futures,
+)
+import requests
+from requests.adapters import HTTPAdapter
+from utils.logger import logger
+from utils.metrics import count_outbound, OUTBOUND_FAILURES
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Timeouts of outbound HTTP calls, in seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+# Maximum number of concurrent connections to each external service
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+# Number of retries of idempotent calls, with full-jitter exponential backoff
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.2))
+# A service is considered down after this many consecutive failures, and calls to it
+# fail immediately for CIRCUIT_RESET_TIMEOUT seconds
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+# Send a second, identical request if the first has not answered within this delay
+# (milliseconds), and use the first answer; 0 disables hedging
+HTTP_HEDGE_DELAY_MS = float(os.getenv("HTTP_HEDGE_DELAY_MS", 0))
+
+# Responses worth retrying: rate limited or temporarily unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling a service that is considered down"""
+
+
+class PoolExhaustedError(requests.ConnectionError):
+    """Raised when no local connection to a service is free in time, without calling it"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of an external service:
+        1. Closed: calls go through, consecutive failures are counted
+        2. Open: after failure_threshold consecutive failures, calls fail immediately
+        3. Half-open: after reset_timeout, one trial call goes through; it closes the
+           circuit if it succeeds, or opens it again if it fails
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """Whether a call may go through now"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit of {self.name} closed")
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or (
+                self.opened_at is None and self.failures >= self.failure_threshold
+            ):
+                logger.warning(
+                    f"Circuit of {self.name} opened after {self.failures} failures"
+                )
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self):
+        """End a trial call that never reached the service, leaving the state unchanged"""
+        with self._lock:
+            self._trial_running = False
+
+
+# One session for all services: connections are pooled and kept alive per host
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_MAX_CONNECTIONS),
+)
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="http-hedge")
+
+
+class OutboundClient:
+    """
+    Client of an external service that:
+        1. Reuses pooled keep-alive connections, at most max_connections at a time
+        2. Always sets connect and read timeouts
+        3. Retries idempotent calls on errors, timeouts and retryable statuses,
+           after a random (full-jitter) exponential backoff
+        4. Fails fast while the circuit breaker of the service is open
+        5. Optionally hedges calls: sends a second request if the first is slow
+    """
+
+    def __init__(
+        self,
+        service: str,
+        timeout: tuple = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        retries: int = HTTP_RETRIES,
+        backoff: float = HTTP_BACKOFF,
+        hedge_delay_ms: float = 0,
+        max_connections: int = HTTP_MAX_CONNECTIONS,
+    ):
+        self.service = service
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_delay = hedge_delay_ms / 1000
+        self.breaker = CircuitBreaker(service)
+        self._connections = threading.BoundedSemaphore(max_connections)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a single request, waiting at most the connect timeout for a free connection"""
+        connect_timeout = kwargs["timeout"][0]
+        if not self._connections.acquire(timeout=connect_timeout):
+            raise PoolExhaustedError(
+                f"No free connection to {self.service} within {connect_timeout}s"
+            )
+        try:
+            count_outbound(self.service)
+            return _session.request(method, url, **kwargs)
+        finally:
+            self._connections.release()
+
+    def _send_hedged(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request, and a second one if the first has not answered within the hedge delay"""
+        first = _hedge_executor.submit(self._send, method, url, **kwargs)
+        done, _ = wait_futures([first], timeout=self.hedge_delay)
+        if done:
+            return first.result()
+        futures = [first, _hedge_executor.submit(self._send, method, url, **kwargs)]
+        while True:
+            done, pending = wait_futures(futures, return_when=FIRST_COMPLETED)
+            # use the first successful answer, or the last failure
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if not pending:
+                return done.pop().result()
+            futures = list(pending)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        idempotent: bool = None,
+        hedge: bool = False,
+        **kwargs,
+    ) -> requests.Response:
+        """
+        Call the service. Calls are retried only if idempotent (by default GET, HEAD and
+        OPTIONS), and hedged only if idempotent and hedge is set.
+        Raise CircuitOpenError if the service is down, PoolExhaustedError if no connection
+        was free, or requests exceptions on failure; only the latter count as failures of
+        the service.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ["GET", "HEAD", "OPTIONS"]
+        kwargs["timeout"] = kwargs.get("timeout") or self.timeout
+        if not isinstance(kwargs["timeout"], tuple):
+            kwargs["timeout"] = (
+                min(HTTP_CONNECT_TIMEOUT, kwargs["timeout"]),
+                kwargs["timeout"],
+            )
+        send = (
+            self._send_hedged
+            if hedge and idempotent and self.hedge_delay > 0
+            else self._send
+        )
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                OUTBOUND_FAILURES.add(service=self.service, reason="circuit_open")
+                raise CircuitOpenError(f"{self.service} is unavailable (circuit open)")
+            try:
+                response = send(method, url, **kwargs)
+            except requests.RequestException as e:
+                if isinstance(e, PoolExhaustedError):
+                    # the service was not called: a local burst says nothing of its health
+                    self.breaker.release()
+                    reason = "pool_exhausted"
+                else:
+                    self.breaker.record_failure()
+                    reason = "timeout" if isinstance(e, requests.Timeout) else "error"
+                OUTBOUND_FAILURES.add(service=self.service, reason=reason)
+                if attempt == attempts - 1:
+                    raise
+                logger.warning(f"Call to {self.service} failed, retrying: {e}")
+                retry_after = None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                OUTBOUND_FAILURES.add(
+                    service=self.service, reason=str(response.status_code)
+                )
+                if attempt == attempts - 1:
+                    return response
+                logger.warning(
+                    f"Call to {self.service} returned {response.status_code}, retrying"
+                )
+                retry_after = response.headers.get("Retry-After")
+            backoff = random.uniform(0, self.backoff * 2**attempt)
+            if retry_after is not None and retry_after.isdigit():
+                backoff = max(backoff, min(float(retry_after), self.timeout[1]))
+            time.sleep(backoff)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+# Clients of the external services called over plain HTTP
+translator_client = OutboundClient("translator", hedge_delay_ms=HTTP_HEDGE_DELAY_MS)
+content_safety_client = OutboundClient("content_safety", retries=0)
+google_sheets_client = OutboundClient("google_sheets")
@@ -0,0 +1,121 @@
+from __future__ import annotations
+import os
+import threading
+from typing import List
+from langchain_core.embeddings import Embeddings
+from utils.logger import logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Run the model with ONNX Runtime instead of PyTorch (requires optimum[onnxruntime])
+EMBEDDING_ONNX = os.getenv("EMBEDDING_ONNX", "false").lower() == "true"
+# Use an int8-quantized ONNX export of the model, if the model repository has one
+EMBEDDING_QUANTIZED = os.getenv("EMBEDDING_QUANTIZED", "false").lower() == "true"
+EMBEDDING_QUANTIZED_FILE = os.getenv(
+    "EMBEDDING_QUANTIZED_FILE", "onnx/model_qint8_avx512_vnni.onnx"
+)
+# Number of threads used by a single inference (intra-op parallelism)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", os.cpu_count() or 1))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Sentence-transformers embedding model running on CPU, that:
+        1. Is loaded once per process (see get_local_embeddings)
+        2. Optionally runs an ONNX or int8-quantized ONNX export of the model
+        3. Embeds texts in batches of similar length, to minimize padding
+        4. Runs one inference at a time, each with EMBEDDING_THREADS threads
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        onnx: bool = EMBEDDING_ONNX,
+        quantized: bool = EMBEDDING_QUANTIZED,
+        threads: int = EMBEDDING_THREADS,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+    ):
+        self.model_name = model_name
+        self.onnx = onnx or quantized
+        self.quantized = quantized
+        self.threads = threads
+        self.batch_size = batch_size
+        # concurrent inferences would compete for the same cores
+        self._lock = threading.Lock()
+        self.model = self._load_model()
+
+    def _load_model(self):
+        """Load the model, imported here as torch and sentence-transformers are slow to import"""
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(self.threads)
+        if not self.onnx:
+            logger.info(f"Loading embedding model {self.model_name} (PyTorch)")
+            return SentenceTransformer(self.model_name, device="cpu")
+
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = self.threads
+        model_kwargs = {
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        }
+        if self.quantized:
+            try:
+                logger.info(
+                    f"Loading embedding model {self.model_name} (ONNX, {EMBEDDING_QUANTIZED_FILE})"
+                )
+                return SentenceTransformer(
+                    self.model_name,
+                    device="cpu",
+                    backend="onnx",
+                    model_kwargs={
+                        **model_kwargs,
+                        "file_name": EMBEDDING_QUANTIZED_FILE,
+                    },
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Could not load quantized model {EMBEDDING_QUANTIZED_FILE}, using the full ONNX model: {e}"
+                )
+        logger.info(f"Loading embedding model {self.model_name} (ONNX)")
+        return SentenceTransformer(
+            self.model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs
+        )
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        texts = [text.replace("\n", " ") for text in texts]
+        # encode sorts the texts by length and batches them, then restores their order
+        with self._lock:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+        return embeddings.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+# Model name -> LocalEmbeddings, shared by all vector stores of the process
+_local_embeddings = {}
+_local_embeddings_lock = threading.Lock()
+
+
+def get_local_embeddings(model_name: str) -> LocalEmbeddings:
+    """Get the embedding runtime of a model, loading it on first use."""
+    if model_name not in _local_embeddings:
+        with _local_embeddings_lock:
+            if model_name not in _local_embeddings:
+                _local_embeddings[model_name] = LocalEmbeddings(model_name)
+    return _local_embeddings[model_name]
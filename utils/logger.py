@@ -1,35 +1,187 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import sys
+from opentelemetry import context as otel_context
+from utils.metrics import DROPPED_LOGS
 from dotenv import load_dotenv
-from opentelemetry._logs import set_logger_provider
-from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
-from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
-from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
 
 # load environment variables
 load_dotenv()
 
-# Set up logs export to Azure Application Insights
-logger_provider = LoggerProvider()
-set_logger_provider(logger_provider)
-exporter = AzureMonitorLogExporter(
-    connection_string=os.environ["APPLICATIONINSIGHTS_CONNECTION_STRING"]
-)
-logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
 
-# Attach LoggingHandler to root logger
-handler = LoggingHandler()
-logging.getLogger().addHandler(handler)
-logging.getLogger().setLevel(logging.NOTSET)
-logger = logging.getLogger(__name__)
+def _parse_settings(value: str) -> dict:
+    """Parse "name=value,name=value" settings"""
+    settings = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            settings[name.strip()] = setting.strip()
+    return settings
+
+
+# Level of the root logger: records below it are not even created
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Levels of given loggers (modules), over the defaults below, e.g. "utils.logger=DEBUG,azure=INFO"
+LOG_LEVELS = _parse_settings(os.getenv("LOG_LEVELS", ""))
+# Fraction of the INFO and DEBUG records of given loggers that are kept, e.g. "queries=0.1"
+LOG_SAMPLE_RATES = {
+    name: float(rate)
+    for name, rate in _parse_settings(os.getenv("LOG_SAMPLE_RATES", "")).items()
+}
+# Arguments of log messages, and messages without arguments, are truncated to this length
+LOG_MAX_FIELD_LENGTH = int(os.getenv("LOG_MAX_FIELD_LENGTH", 2000))
+# Records waiting to be formatted and exported, new records are dropped when it is full
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
 
 # Silence noisy loggers
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("openai").setLevel(logging.WARNING)
-logging.getLogger("httpcore").setLevel(logging.WARNING)
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger("azure").setLevel(logging.WARNING)
-logging.getLogger("requests_oauthlib").setLevel(logging.WARNING)
-logging.getLogger("asyncio").setLevel(logging.WARNING)
-logging.getLogger("opentelemetry").setLevel(logging.ERROR)
+DEFAULT_LEVELS = {
+    "requests": "WARNING",
+    "openai": "WARNING",
+    "httpcore": "WARNING",
+    "httpx": "WARNING",
+    "urllib3": "WARNING",
+    "azure": "WARNING",
+    "requests_oauthlib": "WARNING",
+    "asyncio": "WARNING",
+    "opentelemetry": "ERROR",
+}
+
+
+def truncate(value, max_length: int = LOG_MAX_FIELD_LENGTH):
+    """Truncate a string, or the text of a container (e.g. a list of grounding sources)"""
+    if isinstance(value, (list, tuple, dict, set)):
+        value = str(value)
+    if not isinstance(value, str) or len(value) <= max_length:
+        return value
+    return f"{value[:max_length]}... ({len(value) - max_length} more characters)"
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records below WARNING of given loggers, marked with their sample rate"""
+
+    def __init__(self, sample_rates: dict):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.sample_rates:
+            return True
+        # the rate of the logger, or of its closest parent
+        name = record.name
+        while name and name not in self.sample_rates:
+            name = name.rpartition(".")[0]
+        rate = self.sample_rates.get(name, 1.0)
+        if rate >= 1.0:
+            return True
+        record.sample_rate = rate
+        return random.random() < rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue records unformatted, with the current trace context, so that the request thread
+    only pays for creating the record; drop records if the queue is full.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.otel_context = otel_context.get_current()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_LOGS.add(1)
+
+
+class LogListener(logging.handlers.QueueListener):
+    """
+    Background thread that takes the queued records and:
+        1. Truncates their long arguments (e.g. user messages, assistant responses,
+           grounding sources), or their message if it has none
+        2. Formats their message
+        3. Hands them to the handlers (stdout, Application Insights) in the trace
+           context they were logged in
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        try:
+            if isinstance(record.args, tuple) and record.args:
+                record.args = tuple(truncate(arg) for arg in record.args)
+                record.msg = record.getMessage()
+            else:
+                record.msg = truncate(record.getMessage())
+        except Exception:
+            record.msg = truncate(f"{record.msg} {record.args}")
+        record.args = None
+        return record
+
+    def handle(self, record: logging.LogRecord):
+        context = record.__dict__.pop("otel_context", None)
+        token = otel_context.attach(context) if context is not None else None
+        try:
+            super().handle(record)
+        finally:
+            if token is not None:
+                otel_context.detach(token)
+
+    def enqueue_sentinel(self):
+        # wait for room, unlike records, so that stop() can flush a full queue
+        self.queue.put(self._sentinel, timeout=5)
+
+
+logger = logging.getLogger(__name__)
+# Search queries and chat messages, high-volume and often sampled
+query_logger = logging.getLogger("queries")
+
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(
+    logging.Formatter("%(asctime)s : %(levelname)s : %(message)s")
+)
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_listener = LogListener(_log_queue, stdout_handler, respect_handler_level=True)
+_queue_handler = DeferredQueueHandler(_log_queue)
+_queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+
+logging.getLogger().setLevel(LOG_LEVEL)
+logging.getLogger().addHandler(_queue_handler)
+for name, level in {**DEFAULT_LEVELS, **LOG_LEVELS}.items():
+    logging.getLogger(name).setLevel(level.upper())
+
+_log_listener.start()
+# export the records still queued at exit
+atexit.register(_log_listener.stop)
+
+
+def add_log_handler(handler: logging.Handler):
+    """Hand the queued records to another handler, from the background thread."""
+    _log_listener.handlers = _log_listener.handlers + (handler,)
+
+
+def set_up_log_export():
+    """
+    Export logs to Azure Application Insights, if APPLICATIONINSIGHTS_CONNECTION_STRING is set.
+    Called once at startup; the exporter is imported here to keep imports fast.
+    """
+    connection_string = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
+    if not connection_string:
+        logger.warning(
+            "APPLICATIONINSIGHTS_CONNECTION_STRING not set, logs are not exported."
+        )
+        return
+    from opentelemetry._logs import set_logger_provider
+    from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
+    from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+    from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
+
+    logger_provider = LoggerProvider()
+    set_logger_provider(logger_provider)
+    exporter = AzureMonitorLogExporter(connection_string=connection_string)
+    logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
+
+    # Attach LoggingHandler to the background thread of the logging queue
+    add_log_handler(LoggingHandler(logger_provider=logger_provider))
@@ -0,0 +1,261 @@
+from __future__ import annotations
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from opentelemetry import metrics, trace
+
+# load environment variables
+load_dotenv()
+
+# Spans and instruments are no-ops until set_up_telemetry() sets the providers
+tracer = trace.get_tracer("hia-search")
+meter = metrics.get_meter("hia-search")
+
+# Histogram buckets, in seconds
+DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+# Histogram buckets, in number of items
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    """Format labels as {key="value",...} in Prometheus exposition format"""
+    pairs = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Counter exported both through OpenTelemetry and the local /metrics endpoint"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._otel_counter = meter.create_counter(name, description=description)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, value: float = 1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += value
+        self._otel_counter.add(value, labels)
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram exported both through OpenTelemetry and the local /metrics endpoint"""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: tuple = DURATION_BUCKETS,
+        unit: str = "s",
+    ):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._otel_histogram = meter.create_histogram(
+            name, unit=unit, description=description
+        )
+        # labels -> [count per bucket..., count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def record(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for ix, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    values[ix] += 1
+            values[-2] += 1
+            values[-1] += value
+        self._otel_histogram.record(value, labels)
+
+    def render(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for labels, values in self._values.items():
+                for ix, bucket in enumerate(self.buckets):
+                    bucket_labels = _format_labels(labels, f'le="{bucket}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {values[ix]}")
+                bucket_labels = _format_labels(labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {values[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {values[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {values[-1]}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    "hia_stage_duration_seconds", "Duration of each processing stage"
+)
+REQUEST_DURATION = Histogram(
+    "hia_request_duration_seconds", "Duration of each HTTP request"
+)
+CACHE_REQUESTS = Counter(
+    "hia_cache_requests_total", "Cache lookups, by cache and result (hit or miss)"
+)
+OUTBOUND_REQUESTS = Counter(
+    "hia_outbound_requests_total", "Calls to external services, by service"
+)
+OUTBOUND_FAILURES = Counter(
+    "hia_outbound_failures_total",
+    "Failed calls to external services, by service and reason (timeout, error, status code or circuit_open)",
+)
+ADMISSION_REQUESTS = Counter(
+    "hia_admission_requests_total",
+    "Requests to Azure OpenAI admitted or rejected by admission control, by priority and result",
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "hia_embedding_batch_size",
+    "Number of queries embedded together by the embedding batcher, by embedding model",
+    buckets=SIZE_BUCKETS,
+    unit="1",
+)
+EMBEDDING_BATCH_FILL = Histogram(
+    "hia_embedding_batch_fill_ratio",
+    "Batch size of the embedding batcher relative to its maximum batch size",
+    buckets=(0.1, 0.25, 0.5, 0.75, 1.0),
+    unit="1",
+)
+DEDUPLICATED_CHUNKS = Counter(
+    "hia_deduplicated_chunks_total",
+    "Chunks merged into a near-duplicate at ingestion instead of being embedded",
+)
+DROPPED_LOGS = Counter(
+    "hia_dropped_logs_total",
+    "Log records dropped because the logging queue was full",
+)
+EXPIRED_THREADS = Counter(
+    "hia_expired_threads_total",
+    "Chat threads deleted from a checkpointer after being idle for longer than its TTL, or evicted, by checkpointer",
+)
+REGISTRY = [
+    STAGE_DURATION,
+    REQUEST_DURATION,
+    CACHE_REQUESTS,
+    OUTBOUND_REQUESTS,
+    OUTBOUND_FAILURES,
+    ADMISSION_REQUESTS,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_FILL,
+    DEDUPLICATED_CHUNKS,
+    EXPIRED_THREADS,
+    DROPPED_LOGS,
+]
+
+
+@contextmanager
+def timed(stage: str, **attributes):
+    """Trace a processing stage as a span and record its duration"""
+    with tracer.start_as_current_span(stage, attributes=attributes):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            STAGE_DURATION.record(time.perf_counter() - start, stage=stage)
+
+
+def traced(stage: str):
+    """Decorator to trace a function as a processing stage"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_cache(cache: str, hit: bool):
+    """Count a cache lookup"""
+    CACHE_REQUESTS.add(cache=cache, result="hit" if hit else "miss")
+
+
+def count_outbound(service: str):
+    """Count a call to an external service"""
+    OUTBOUND_REQUESTS.add(service=service)
+
+
+def instrument_methods(obj, stages: dict):
+    """Trace methods of an object (e.g. a client from another library), given as {method name: stage}"""
+    for method_name, stage in stages.items():
+        setattr(obj, method_name, traced(stage)(getattr(obj, method_name)))
+    return obj
+
+
+def set_up_telemetry():
+    """
+    Export traces and metrics to Azure Application Insights, if APPLICATIONINSIGHTS_CONNECTION_STRING
+    is set. Called once at startup; the SDK and exporters are imported here to keep imports fast.
+    """
+    connection_string = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
+    if not connection_string:
+        return
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from azure.monitor.opentelemetry.exporter import (
+        AzureMonitorMetricExporter,
+        AzureMonitorTraceExporter,
+    )
+
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(
+        BatchSpanProcessor(
+            AzureMonitorTraceExporter(connection_string=connection_string)
+        )
+    )
+    trace.set_tracer_provider(tracer_provider)
+    meter_provider = MeterProvider(
+        metric_readers=[
+            PeriodicExportingMetricReader(
+                AzureMonitorMetricExporter(connection_string=connection_string)
+            )
+        ]
+    )
+    metrics.set_meter_provider(meter_provider)
+
+
+def render_metrics() -> str:
+    """Render all metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,280 @@
+from __future__ import annotations
+import copy
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+from fastapi import HTTPException
+from utils.logger import logger
+from utils.metrics import timed
+from utils.admission import BACKGROUND
+from utils.traffic_capture import TRAFFIC_CAPTURE_PATH
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Prewarm the caches with the most frequent queries of each sheet, after startup and
+# after a vector store is created
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "false").lower() == "true"
+# Where the frequent queries are read from: "capture" (the traffic capture file, with
+# TRAFFIC_CAPTURE_QUERY=text) or "appinsights" (the query logs exported to Application
+# Insights, requires azure-monitor-query and PREWARM_WORKSPACE_ID)
+PREWARM_SOURCE = os.getenv("PREWARM_SOURCE", "capture").lower()
+PREWARM_CAPTURE_PATH = os.getenv("PREWARM_CAPTURE_PATH", TRAFFIC_CAPTURE_PATH)
+# Log Analytics workspace of the Application Insights resource
+PREWARM_WORKSPACE_ID = os.getenv("PREWARM_WORKSPACE_ID")
+# Only queries of the last PREWARM_LOOKBACK_DAYS days are counted
+PREWARM_LOOKBACK_DAYS = float(os.getenv("PREWARM_LOOKBACK_DAYS", 7))
+# Budget of a prewarming run: number of queries in total and per sheet, and seconds
+PREWARM_MAX_QUERIES = int(os.getenv("PREWARM_MAX_QUERIES", 200))
+PREWARM_QUERIES_PER_SHEET = int(os.getenv("PREWARM_QUERIES_PER_SHEET", 50))
+PREWARM_MAX_SECONDS = float(os.getenv("PREWARM_MAX_SECONDS", 300))
+# Number of most used languages of a sheet whose result translations are prewarmed
+PREWARM_LANGUAGES = int(os.getenv("PREWARM_LANGUAGES", 3))
+# Pause between two prewarmed queries (milliseconds), to leave room for live traffic
+PREWARM_PAUSE_MS = float(os.getenv("PREWARM_PAUSE_MS", 50))
+
+SEARCH = "search"
+CHAT = "chat"
+CAPTURED_ENDPOINTS = {
+    "/search": SEARCH,
+    "/chat-dummy": CHAT,
+    "/chat-twilio-webhook": CHAT,
+}
+
+# Frequent search queries and chat messages of the query logs (see routes/search.py and
+# routes/chat.py). Search queries are logged in English (query_lang), or as sent if answered
+# from the cache; lang is the language of the request. Sampled logs count 1 / sample_rate.
+APPINSIGHTS_QUERY = """
+AppTraces
+| where TimeGenerated > ago({days}d)
+| where Message startswith "query: " or Message startswith "query (cached): " or Message startswith "user: "
+| extend googleSheetId = tostring(Properties.googleSheetId), lang = tostring(Properties.lang)
+| where isnotempty(googleSheetId)
+| extend endpoint = iff(Message startswith "user: ", "chat", "search")
+| extend query = case(
+    Message startswith "query: ", substring(Message, 7),
+    Message startswith "query (cached): ", substring(Message, 16),
+    extract(@"(?s)^user: (.*?), assistant: ", 1, Message))
+| extend query_lang = iff(Message startswith "query (cached): ", lang, "en")
+| extend weight = iff(isempty(Properties.sample_rate), 1.0, 1.0 / todouble(Properties.sample_rate))
+| summarize count_ = round(sum(weight)) by googleSheetId, endpoint, query, query_lang, lang
+| top {limit} by count_ desc
+"""
+
+
+@dataclass
+class FrequentQuery:
+    google_sheet_id: str
+    endpoint: str
+    query: str
+    lang: str = "en"
+    k: int = 5
+    category_id: int = None
+    subcategory_id: int = None
+    count: int = 1
+
+
+def read_captured_queries(path: str = PREWARM_CAPTURE_PATH) -> tuple:
+    """
+    Frequent queries of the traffic capture file, most frequent first, and the number of
+    queries per sheet and language. Queries captured as hashes cannot be replayed.
+    """
+    since = time.time() - PREWARM_LOOKBACK_DAYS * 24 * 3600
+    counts = Counter()
+    languages = defaultdict(Counter)
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            endpoint = CAPTURED_ENDPOINTS.get(record.get("endpoint"))
+            if (
+                endpoint is None
+                or not record.get("query")
+                or not record.get("googleSheetId")
+                or record.get("status", 200) != 200
+                or record.get("timestamp", since) < since
+            ):
+                continue
+            if endpoint == SEARCH:
+                languages[record["googleSheetId"]][record.get("lang", "en")] += 1
+                key = (
+                    record["googleSheetId"],
+                    endpoint,
+                    record["query"],
+                    record.get("lang", "en"),
+                    record.get("k", 5),
+                    record.get("categoryID"),
+                    record.get("subcategoryID"),
+                )
+            else:
+                key = (record["googleSheetId"], endpoint, record["query"], "en")
+            counts[key] += 1
+    queries = [FrequentQuery(*key, count=count) for key, count in counts.most_common()]
+    return queries, languages
+
+
+def read_logged_queries(limit: int = 10000) -> tuple:
+    """
+    Frequent queries of the query logs exported to Application Insights, most frequent
+    first, and the number of queries per sheet and language
+    """
+    # imported here, as it is only needed by this source
+    from azure.identity import DefaultAzureCredential
+    from azure.monitor.query import LogsQueryClient
+
+    client = LogsQueryClient(DefaultAzureCredential())
+    response = client.query_workspace(
+        PREWARM_WORKSPACE_ID,
+        APPINSIGHTS_QUERY.format(days=PREWARM_LOOKBACK_DAYS, limit=limit),
+        timespan=None,
+    )
+    counts = Counter()
+    languages = defaultdict(Counter)
+    for google_sheet_id, endpoint, query, query_lang, lang, count in response.tables[
+        0
+    ].rows:
+        counts[(google_sheet_id, endpoint, query, query_lang or "en")] += int(count)
+        if endpoint == SEARCH:
+            languages[google_sheet_id][lang or "en"] += int(count)
+    queries = [FrequentQuery(*key, count=count) for key, count in counts.most_common()]
+    return queries, languages
+
+
+def read_frequent_queries() -> tuple:
+    if PREWARM_SOURCE == "appinsights":
+        return read_logged_queries()
+    return read_captured_queries()
+
+
+def plan(queries: List[FrequentQuery], google_sheet_ids: List[str] = None) -> list:
+    """
+    Queries to prewarm within the budget: the most frequent of each sheet, taking
+    the sheets in turn so that every sheet gets part of the budget
+    """
+    by_sheet = defaultdict(list)
+    for query in queries:
+        if google_sheet_ids is None or query.google_sheet_id in google_sheet_ids:
+            if len(by_sheet[query.google_sheet_id]) < PREWARM_QUERIES_PER_SHEET:
+                by_sheet[query.google_sheet_id].append(query)
+    planned = []
+    for rank in range(PREWARM_QUERIES_PER_SHEET):
+        for sheet_queries in by_sheet.values():
+            if rank < len(sheet_queries):
+                planned.append(sheet_queries[rank])
+    return planned[:PREWARM_MAX_QUERIES]
+
+
+def prewarm_query(query: FrequentQuery, languages: List[str]):
+    """
+    Fill the caches a query goes through:
+        1. Search: translation of the query, its embedding, the search results and their
+           translations, and of English queries also the translations in the given languages
+        2. Chat: language detection and translation of the message, and its embedding
+    """
+    # imported here, as the routes import this module indirectly
+    from routes.search import cached_search, translate_results
+    from utils.translator import detect_language, translate
+    from utils.vector_store import get_vector_store
+
+    if query.endpoint == SEARCH:
+        results = cached_search(
+            query.google_sheet_id,
+            query.query,
+            query.k,
+            query.lang,
+            query.category_id,
+            query.subcategory_id,
+            priority=BACKGROUND,
+            log_query=False,
+        )
+        if query.lang == "en":
+            for lang in languages:
+                if lang != "en":
+                    translate_results(copy.deepcopy(results), lang)
+    else:
+        message = query.query
+        detected_lang = detect_language(message)
+        if detected_lang != "en":
+            message = translate(from_lang=detected_lang, to_lang="en", text=message)
+        get_vector_store(query.google_sheet_id, check_if_exists=True).embed_query(
+            message, priority=BACKGROUND
+        )
+
+
+def prewarm(google_sheet_ids: List[str] = None):
+    """
+    Prewarm the caches with the most frequent queries of the given sheets (by default
+    all sheets), one query at a time, within the budget of a run.
+    """
+    start = time.monotonic()
+    try:
+        queries, languages = read_frequent_queries()
+    except Exception as e:
+        logger.warning(
+            f"Could not read frequent queries, caches are not prewarmed: {e}"
+        )
+        return
+    planned = plan(queries, google_sheet_ids)
+    n_prewarmed = 0
+    with timed("prewarm"):
+        for query in planned:
+            if time.monotonic() - start > PREWARM_MAX_SECONDS:
+                logger.info("Prewarming stopped, time budget exhausted.")
+                break
+            sheet_languages = [
+                lang
+                for lang, _ in languages[query.google_sheet_id].most_common(
+                    PREWARM_LANGUAGES
+                )
+            ]
+            try:
+                prewarm_query(query, sheet_languages)
+                n_prewarmed += 1
+            except HTTPException as e:
+                if e.status_code == 429:
+                    # the Azure OpenAI budget is needed by live traffic
+                    logger.info("Prewarming stopped, rate limited.")
+                    break
+                logger.warning(
+                    f"Could not prewarm query of {query.google_sheet_id}: {e}"
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Could not prewarm query of {query.google_sheet_id}: {e}"
+                )
+            time.sleep(PREWARM_PAUSE_MS / 1000)
+    logger.info(
+        f"Prewarmed {n_prewarmed} of {len(planned)} frequent queries "
+        f"in {time.monotonic() - start:.1f}s."
+    )
+
+
+# Runs are queued and run one at a time, in the background
+_prewarm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prewarm")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def schedule_prewarm(google_sheet_ids: List[str] = None):
+    """Prewarm the caches of the given sheets (by default all) in the background, if enabled."""
+    if not PREWARM_ENABLED:
+        return
+    key = tuple(sorted(google_sheet_ids)) if google_sheet_ids else None
+    with _pending_lock:
+        # a run of the same sheets is already waiting
+        if key in _pending:
+            return
+        _pending.add(key)
+
+    def run():
+        with _pending_lock:
+            _pending.discard(key)
+        prewarm(google_sheet_ids)
+
+    _prewarm_executor.submit(run)
@@ -0,0 +1,271 @@
+from __future__ import annotations
+import contextvars
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from utils.logger import logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Profile requests with a statistical profiler: those sent with the PROFILER_HEADER header
+# set to the write API key, and a fraction PROFILER_SAMPLE_RATE of the others
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+PROFILER_SAMPLE_RATE = float(os.getenv("PROFILER_SAMPLE_RATE", 0.0))
+PROFILER_HEADER = "X-Profile"
+# Interval between two stack samples (milliseconds), and maximum duration of a profile (seconds)
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", 5))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", 60))
+# Directory the profiles are stored in, the oldest beyond PROFILER_MAX_PROFILES are deleted
+PROFILER_DIR = os.getenv("PROFILER_DIR", "profiles")
+PROFILER_MAX_PROFILES = int(os.getenv("PROFILER_MAX_PROFILES", 100))
+
+PROFILED_PATHS = ["/search", "/chat-dummy", "/chat-twilio-webhook"]
+# Wall-clock profiles count every sample, CPU profiles only those of threads that used CPU since the previous sample
+PROFILE_KINDS = ["wall", "cpu"]
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9-]{1,64}$")
+
+# Profile of the request being served, inherited by the threads it runs code in
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def _thread_cpu_time(thread_id: int) -> float | None:
+    """CPU time of a thread, where the platform exposes it (Linux)"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def _folded_stack(frame) -> str:
+    """Stack of a frame in folded format, outermost frame first"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+    """
+    Statistical profile of one request, that:
+        1. Samples, every interval, the stacks of the threads running the request's code
+           (see profiled), from a background thread
+        2. Counts each stack in a wall-clock profile, and in a CPU profile if the thread
+           used CPU since the previous sample
+        3. Writes both as folded stacks (flame graph input) to the profile directory,
+           with the request's metadata, once the request is done
+    """
+
+    def __init__(
+        self,
+        profile_id: str,
+        path: str,
+        interval: float = PROFILER_INTERVAL_MS / 1000,
+        max_seconds: float = PROFILER_MAX_SECONDS,
+        directory: str = PROFILER_DIR,
+    ):
+        self.profile_id = profile_id
+        self.path = path
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.directory = directory
+        self.samples = {kind: Counter() for kind in PROFILE_KINDS}
+        self.metadata = {"profile_id": profile_id, "path": path}
+        # thread ID -> number of nested profiled calls running in it
+        self._threads = Counter()
+        self._cpu_times = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._run, name=f"profiler-{profile_id}", daemon=True
+        )
+
+    def start(self):
+        self.metadata["timestamp"] = time.time()
+        self._start = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self, **metadata):
+        """Stop sampling; the profile is written in the background."""
+        self.metadata["duration_ms"] = round(
+            (time.perf_counter() - self._start) * 1000, 3
+        )
+        self.metadata.update(metadata)
+        self._stopped.set()
+
+    @contextmanager
+    def attach(self):
+        """Sample the current thread while in this context"""
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._threads[thread_id] += 1
+            self._cpu_times.setdefault(thread_id, _thread_cpu_time(thread_id))
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[thread_id] -= 1
+                if not self._threads[thread_id]:
+                    del self._threads[thread_id]
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            thread_ids = list(self._threads)
+        for thread_id in thread_ids:
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = _folded_stack(frame)
+            self.samples["wall"][stack] += 1
+            cpu_time = _thread_cpu_time(thread_id)
+            previous = self._cpu_times.get(thread_id)
+            if cpu_time is not None and previous is not None and cpu_time > previous:
+                self.samples["cpu"][stack] += 1
+            self._cpu_times[thread_id] = cpu_time
+
+    def _run(self):
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stopped.wait(self.interval):
+            if time.monotonic() > deadline:
+                self.metadata["truncated"] = True
+                break
+            self.sample()
+        self._stopped.wait()
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"Could not write profile {self.profile_id}: {e}")
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for kind, samples in self.samples.items():
+            with open(profile_path(self.profile_id, kind, self.directory), "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        self.metadata.update(
+            {
+                "interval_ms": self.interval * 1000,
+                "samples": {
+                    kind: sum(samples.values())
+                    for kind, samples in self.samples.items()
+                },
+            }
+        )
+        with open(profile_path(self.profile_id, "json", self.directory), "w") as f:
+            json.dump(self.metadata, f)
+        delete_old_profiles(self.directory)
+
+
+def profile_path(profile_id: str, kind: str, directory: str = PROFILER_DIR) -> str:
+    """Path of the metadata (kind json) or of the wall-clock or CPU folded stacks of a profile"""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        raise ValueError(f"Invalid profile ID {profile_id}.")
+    extension = "json" if kind == "json" else f"{kind}.folded"
+    return os.path.join(directory, f"{profile_id}.{extension}")
+
+
+def list_profiles(directory: str = PROFILER_DIR) -> list:
+    """Metadata of the stored profiles, most recent first"""
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return sorted(profiles, key=lambda profile: profile["timestamp"], reverse=True)
+
+
+def delete_old_profiles(
+    directory: str = PROFILER_DIR, max_profiles: int = PROFILER_MAX_PROFILES
+):
+    for profile in list_profiles(directory)[max_profiles:]:
+        for kind in ["json"] + PROFILE_KINDS:
+            try:
+                os.remove(profile_path(profile["profile_id"], kind, directory))
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def profiled():
+    """Sample the current thread for the profile of the request being served, if any"""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.attach():
+        yield
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware that profiles search and chat requests sent with the PROFILER_HEADER
+    header set to the write API key, or sampled with PROFILER_SAMPLE_RATE. The profile is
+    stored under the request ID (X-Request-ID, or a new one), returned in X-Profile-Id.
+    """
+
+    def __init__(self, app, sample_rate: float = PROFILER_SAMPLE_RATE):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    def _is_requested(self, scope: dict) -> bool:
+        headers = dict(scope.get("headers", []))
+        key = headers.get(PROFILER_HEADER.lower().encode())
+        if key is not None:
+            return hmac.compare_digest(key, os.environ["API_KEY_WRITE"].encode())
+        return random.random() < self.sample_rate
+
+    @staticmethod
+    def _request_id(scope: dict) -> str:
+        request_id = dict(scope.get("headers", [])).get(b"x-request-id", b"").decode()
+        if PROFILE_ID_PATTERN.match(request_id):
+            return request_id
+        return uuid.uuid4().hex
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["path"] not in PROFILED_PATHS
+            or not self._is_requested(scope)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(self._request_id(scope), scope["path"])
+        response = {"status": 500}
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.profile_id.encode())
+                ]
+            await send(message)
+
+        token = current_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            current_profile.reset(token)
+            profile.stop(status=response["status"])
@@ -1,6 +1,10 @@
-import urllib
+import io
+import requests
 import pandas as pd
 from utils.logger import logger
+from utils.metrics import timed
+from utils.http_client import google_sheets_client
+from utils.cache import prompt_cache
 from fastapi import HTTPException
 
 
@@ -25,17 +29,25 @@ class PromptLoader:
         self.document_data = document_data
         self.__dict__.update(kwargs)
 
-    def get_prompt(self):
+    def _to_dataframe(self):
         """
-        Loads system-prompt based on the document type. Google Sheet and JSON are currently supported.
+        Loads the chat settings as a pandas DataFrame based on the document type. Google Sheet and JSON are currently supported.
+        Returns None if the Google Sheet has no chat settings.
         """
         if self.document_type.lower() == "googlesheet":
             sheet_name = "Chat"
             url = f"https://docs.google.com/spreadsheets/d/{self.document_id}/gviz/tq?tqx=out:csv&sheet={sheet_name}"
             try:
-                df = pd.read_csv(url)
-            except urllib.error.HTTPError as e:
-                return ""
+                with timed("sheet_fetch", sheet=sheet_name):
+                    response = google_sheets_client.get(url)
+            except requests.RequestException as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"Could not load chat settings of Google Sheet with ID {self.document_id}: {e}",
+                )
+            if not response.ok:
+                return None
+            df = pd.read_csv(io.BytesIO(response.content))
 
         elif self.document_type.lower() == "json":
             logger.info("Loading from JSON.")
@@ -52,14 +64,41 @@ class PromptLoader:
                 status_code=500,
                 detail=f"Loader of document type {self.document_type} not available.",
             )
-        # get prompt from column #VALUE and row with #KEY containing #system-prompt
+        return df
+
+    def _load_settings(self):
+        """Load the chat settings, from the prompts cache if possible."""
+        if self.document_type.lower() != "googlesheet":
+            return self._to_dataframe()
+        return prompt_cache.get_or_set(
+            "settings", self._to_dataframe, scope=self.document_id
+        )
+
+    def get_value(self, key: str) -> str:
+        """
+        Get a chat setting from column #VALUE and row with #KEY containing the given key.
+        Returns an empty string if the setting is not found. The settings are loaded only once,
+        and cached in the prompts cache.
+        """
+        if not hasattr(self, "_df"):
+            self._df = self._load_settings()
+        if self._df is None:
+            return ""
         try:
-            df = df.dropna(subset=["#KEY"])
-            prompt = (
-                df[df["#KEY"].str.contains("#system-prompt")]["#VALUE"]
-                .values[0]
-                .strip()
-            )
+            df = self._df.dropna(subset=["#KEY"])
+            value = df[df["#KEY"].str.contains(key)]["#VALUE"].values[0].strip()
         except (IndexError, KeyError, AttributeError) as e:
-            prompt = ""
-        return prompt
+            value = ""
+        return value
+
+    def get_prompt(self) -> str:
+        """
+        Loads system-prompt based on the document type. Google Sheet and JSON are currently supported.
+        """
+        return self.get_value("#system-prompt")
+
+    def get_retrieval_mode(self) -> str:
+        """
+        Loads the retrieval mode of the chat agent ("agentic" or "retrieve-first"), if specified.
+        """
+        return self.get_value("#retrieval-mode").lower()
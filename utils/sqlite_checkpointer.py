@@ -0,0 +1,89 @@
+from __future__ import annotations
+import time
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# Last write of each thread, as SqliteSaver does not record when checkpoints were written
+SETUP_SQL = """
+CREATE TABLE IF NOT EXISTS thread_activity (
+    thread_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Delete all but the latest checkpoints of a thread, then the writes of the deleted ones
+# (channel values are stored within the checkpoints)
+PRUNE_THREAD_SQL = [
+    """
+    DELETE FROM checkpoints
+    WHERE thread_id = :thread_id
+    AND checkpoint_id NOT IN (
+        SELECT checkpoint_id FROM checkpoints
+        WHERE thread_id = :thread_id
+        ORDER BY checkpoint_id DESC
+        LIMIT :keep_last
+    )
+    """,
+    """
+    DELETE FROM writes
+    WHERE thread_id = :thread_id
+    AND checkpoint_id NOT IN (
+        SELECT checkpoint_id FROM checkpoints WHERE thread_id = :thread_id
+    )
+    """,
+]
+TOUCH_THREAD_SQL = """
+INSERT INTO thread_activity (thread_id, updated_at) VALUES (:thread_id, :now)
+ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at
+"""
+
+# Delete the threads last written before :before
+EXPIRE_THREADS_SQL = [
+    """
+    DELETE FROM checkpoints WHERE thread_id IN (
+        SELECT thread_id FROM thread_activity WHERE updated_at < :before
+    )
+    """,
+    """
+    DELETE FROM writes WHERE thread_id IN (
+        SELECT thread_id FROM thread_activity WHERE updated_at < :before
+    )
+    """,
+    "DELETE FROM thread_activity WHERE updated_at < :before",
+]
+
+
+class SqliteCheckpointer(SqliteSaver):
+    """
+    Checkpoints in a local SQLite file, shared by the workers of a host, that:
+        1. Records when each thread was last written
+        2. Deletes the threads idle for longer than a given time
+    """
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        super().setup()
+        self.conn.execute(SETUP_SQL)
+        self.conn.commit()
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        with self.cursor() as cur:
+            cur.execute(
+                TOUCH_THREAD_SQL,
+                {"thread_id": config["configurable"]["thread_id"], "now": time.time()},
+            )
+        return next_config
+
+    def prune_thread(self, thread_id: str, keep_last: int = 1):
+        """Delete old checkpoint versions of a thread, keeping only the latest ones."""
+        with self.cursor() as cur:
+            for sql in PRUNE_THREAD_SQL:
+                cur.execute(sql, {"thread_id": thread_id, "keep_last": keep_last})
+
+    def expire_threads(self, max_idle: float) -> int:
+        """Delete the threads idle for longer than max_idle seconds, return their number."""
+        with self.cursor() as cur:
+            for sql in EXPIRE_THREADS_SQL:
+                cur.execute(sql, {"before": time.time() - max_idle})
+            return cur.rowcount
@@ -0,0 +1,147 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import parse_qsl
+from utils.logger import logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRAFFIC_CAPTURE_ENABLED = (
+    os.getenv("TRAFFIC_CAPTURE_ENABLED", "false").lower() == "true"
+)
+# JSONL file the captured requests are appended to
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "traffic.jsonl")
+# How to record query texts: "hash" (anonymized) or "text"
+TRAFFIC_CAPTURE_QUERY = os.getenv("TRAFFIC_CAPTURE_QUERY", "hash").lower()
+# Fraction of requests that are captured
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE_RATE", 1.0))
+
+CAPTURED_PATHS = ["/search", "/chat-dummy", "/chat-twilio-webhook"]
+
+
+def hash_text(text: str) -> str:
+    """Short, irreversible hash of a text"""
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+class TrafficRecorder:
+    """Append records to a JSONL file from a background thread, off the request path"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._write, name="traffic-capture", daemon=True
+        )
+        self._thread.start()
+
+    def record(self, record: dict):
+        self._queue.put(record)
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logger.error(f"Could not write captured traffic to {self.path}: {e}")
+
+
+class TrafficCaptureMiddleware:
+    """
+    ASGI middleware that records the shape of search and chat requests:
+    endpoint, googleSheetId, query (hashed or as text), lang, k, status and duration.
+    User identifiers (threadId, phone numbers) are always hashed.
+    """
+
+    def __init__(
+        self,
+        app,
+        path: str = TRAFFIC_CAPTURE_PATH,
+        query_mode: str = TRAFFIC_CAPTURE_QUERY,
+        sample_rate: float = TRAFFIC_CAPTURE_SAMPLE_RATE,
+    ):
+        self.app = app
+        self.query_mode = query_mode
+        self.sample_rate = sample_rate
+        self.recorder = TrafficRecorder(path)
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["path"] not in CAPTURED_PATHS
+            or random.random() >= self.sample_rate
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        body = []
+        response = {"status": 500}
+
+        async def receive_and_capture():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.append(message.get("body", b""))
+            return message
+
+        async def send_and_capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            await send(message)
+
+        timestamp = time.time()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_and_capture, send_and_capture)
+        finally:
+            try:
+                record = self._build_record(scope, b"".join(body))
+                record.update(
+                    {
+                        "timestamp": timestamp,
+                        "status": response["status"],
+                        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                    }
+                )
+                self.recorder.record(record)
+            except Exception as e:
+                logger.error(f"Could not capture request to {scope['path']}: {e}")
+
+    def _build_record(self, scope: dict, body: bytes) -> dict:
+        """Extract the request shape from the query string and body"""
+        params = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        if scope["path"] == "/chat-twilio-webhook":
+            form = dict(parse_qsl(body.decode()))
+            query = form.get("Body", "")
+            user = form.get("From")
+        else:
+            payload = json.loads(body) if body else {}
+            query = payload.get("query", payload.get("message", ""))
+            user = params.get("threadId")
+        record = {
+            "endpoint": scope["path"],
+            "googleSheetId": params.get("googleSheetId"),
+            "query_length": len(query),
+            "user": hash_text(user) if user else None,
+        }
+        if scope["path"] == "/search":
+            record["googleSheetId"] = payload.get("googleSheetId")
+            if payload.get("googleSheetIds"):
+                record["googleSheetIds"] = payload["googleSheetIds"]
+            for field in ["categoryID", "subcategoryID"]:
+                if payload.get(field) is not None:
+                    record[field] = payload[field]
+            record["lang"] = payload.get("lang", "en")
+            record["k"] = payload.get("k", 5)
+        if self.query_mode == "text":
+            record["query"] = query
+        else:
+            record["query_hash"] = hash_text(query)
+        return record
@@ -2,14 +2,27 @@ import requests
 import os
 from dotenv import load_dotenv
 import pandas as pd
+from fastapi import HTTPException
+from utils.metrics import traced
+from utils.cache import translation_cache
+from utils.http_client import translator_client
 
 load_dotenv()
 
 
+@traced("translation")
 def translate(from_lang: str, to_lang: str, text: str) -> str:
     """Translate text from one language to another."""
     if pd.isna(text) or text.strip() == "":
         return ""
+    return translation_cache.get_or_set(
+        ("translate", from_lang, to_lang, text),
+        lambda: _translate(from_lang, to_lang, text),
+    )
+
+
+def _translate(from_lang: str, to_lang: str, text: str) -> str:
+    """Call the translator API."""
     translator_params = {"api-version": "3.0", "to": [to_lang], "from": [from_lang]}
     translator_headers = {
         "Ocp-Apim-Subscription-Key": os.getenv("MSCOGNITIVE_KEY"),
@@ -17,19 +30,33 @@ def translate(from_lang: str, to_lang: str, text: str) -> str:
         "Content-type": "application/json",
     }
     translator_url = "https://api.cognitive.microsofttranslator.com/translate"
-    translator_response = requests.post(
-        translator_url,
-        params=translator_params,
-        headers=translator_headers,
-        json=[{"text": text}],
-    ).json()
+    # translation and detection have no side effects: retry and hedge them
+    try:
+        translator_response = translator_client.post(
+            translator_url,
+            params=translator_params,
+            headers=translator_headers,
+            json=[{"text": text}],
+            idempotent=True,
+            hedge=True,
+        ).json()
+    except requests.RequestException as e:
+        raise HTTPException(status_code=503, detail=f"Translator unavailable: {e}")
     return translator_response[0]["translations"][0]["text"]
 
 
+@traced("language_detection")
 def detect_language(text: str) -> str:
     """Detect the language of the given text."""
     if pd.isna(text) or text.strip() == "":
         return "en"
+    return translation_cache.get_or_set(
+        ("detect", text), lambda: _detect_language(text)
+    )
+
+
+def _detect_language(text: str) -> str:
+    """Call the language detection API."""
     detector_params = {"api-version": "3.0"}
     detector_headers = {
         "Ocp-Apim-Subscription-Key": os.getenv("MSCOGNITIVE_KEY"),
@@ -37,10 +64,16 @@ def detect_language(text: str) -> str:
         "Content-type": "application/json",
     }
     detector_url = "https://api.cognitive.microsofttranslator.com/detect"
-    detector_response = requests.post(
-        detector_url,
-        params=detector_params,
-        headers=detector_headers,
-        json=[{"text": text}],
-    ).json()
+    # translation and detection have no side effects: retry and hedge them
+    try:
+        detector_response = translator_client.post(
+            detector_url,
+            params=detector_params,
+            headers=detector_headers,
+            json=[{"text": text}],
+            idempotent=True,
+            hedge=True,
+        ).json()
+    except requests.RequestException as e:
+        raise HTTPException(status_code=503, detail=f"Translator unavailable: {e}")
     return detector_response[0]["language"]
@@ -1,13 +1,13 @@
 from __future__ import annotations
 import re
 import copy
+import dataclasses
+import json
+import pandas as pd
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 from fastapi import HTTPException
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_openai import AzureOpenAIEmbeddings
 from langchain_core.documents import Document
-from langchain_community.vectorstores.azuresearch import AzureSearch
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
@@ -20,21 +20,108 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     HnswParameters,
     HnswAlgorithmConfiguration,
+    ExhaustiveKnnParameters,
+    ExhaustiveKnnAlgorithmConfiguration,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    RescoringOptions,
     VectorSearchAlgorithmKind,
     VectorSearchAlgorithmMetric,
     VectorSearchProfile,
 )
 from utils.logger import logger
+from utils.metrics import timed, count_outbound, DEDUPLICATED_CHUNKS
 from utils.constants import DocumentMetadata
-from utils.document_loader import DocumentLoader
+from utils.document_loader import DocumentLoader, uuid_hash
 from utils.document_chunker import DocumentChunker
+from utils.chunk_deduplicator import ChunkDeduplicator
+from utils.answer_cache import answer_cache
+from utils.cache import embedding_cache, invalidate_sheet, sheet_version
+from utils.local_embeddings import get_local_embeddings
+from utils.embedding_batcher import get_embedding_batcher
+from utils.admission import admission, estimate_tokens, BACKGROUND, INTERACTIVE
 import os
+import time
 
 DEFAULT_HUGGING_FACE_MODEL = "sentence-transformers/all-mpnet-base-v2"
+# Embedding source of new vector stores: "OpenAI" (Azure OpenAI deployment MODEL_EMBEDDINGS)
+# or "HuggingFace" (local model MODEL_EMBEDDINGS_LOCAL, on CPU)
+EMBEDDING_SOURCE = os.getenv("EMBEDDING_SOURCE", "OpenAI")
+# Maximum number of texts per Azure OpenAI embeddings request
+OPENAI_EMBEDDING_CHUNK_SIZE = int(os.getenv("OPENAI_EMBEDDING_CHUNK_SIZE", 16))
+CHUNKING_STRATEGY = "TokenizedSentenceSplitting"
+CHUNKING_KWARGS = {"chunk_overlap": 20, "chunk_size": 256}
+# Merge near-duplicate chunks at ingestion: chunks whose word shingles have a Jaccard
+# similarity of at least DEDUPLICATION_THRESHOLD are embedded and indexed once
+DEDUPLICATION_ENABLED = os.getenv("DEDUPLICATION_ENABLED", "false").lower() == "true"
+DEDUPLICATION_THRESHOLD = float(os.getenv("DEDUPLICATION_THRESHOLD", 0.9))
+DEDUPLICATION_SHINGLE_SIZE = int(os.getenv("DEDUPLICATION_SHINGLE_SIZE", 3))
 
 
 dm = DocumentMetadata()
 
+# Typed index fields: name -> type; all are filterable, only the row and chunk indexes are sortable
+INTEGER_FIELDS = [dm.GOOGLE_INDEX, dm.NTH_CHUNK, dm.CATEGORY, dm.SUBCATEGORY]
+STRING_FIELDS = [dm.SLUG, dm.PARENT, dm.CONTENT_HASH]
+# Fields only returned, never searched or filtered on
+RETRIEVABLE_FIELDS = [dm.QUESTION, dm.ANSWER]
+# Categories of the rows of near-duplicate chunks, to filter on
+DUPLICATE_CATEGORY_FIELDS = [dm.DUPLICATE_CATEGORIES, dm.DUPLICATE_SUBCATEGORIES]
+# Fields of a document needed to build search results and their hierarchy
+RESULT_FIELDS = [
+    dm.GOOGLE_INDEX,
+    dm.NTH_CHUNK,
+    dm.CATEGORY,
+    dm.SUBCATEGORY,
+    dm.SLUG,
+    dm.PARENT,
+    dm.QUESTION,
+    dm.ANSWER,
+]
+# Number of documents fetched per request by get_documents
+GET_DOCUMENTS_PAGE_SIZE = int(os.getenv("GET_DOCUMENTS_PAGE_SIZE", 1000))
+# Number of documents, with their vectors, sent per request by upload_documents
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", 500))
+# Filtered searches of indexes without typed fields fetch this many times more results
+LEGACY_FILTER_OVERFETCH = 10
+
+# Vector search algorithm of new indexes: "hnsw" (approximate nearest neighbors),
+# "exhaustive" (exact KNN, scans all vectors), or "auto": exhaustive for sheets of at
+# most EXHAUSTIVE_KNN_MAX_CHUNKS chunks, HNSW for larger ones
+HNSW = "hnsw"
+EXHAUSTIVE = "exhaustive"
+AUTO = "auto"
+VECTOR_SEARCH_ALGORITHMS = [HNSW, EXHAUSTIVE, AUTO]
+VECTOR_SEARCH_ALGORITHM = os.getenv("VECTOR_SEARCH_ALGORITHM", HNSW).lower()
+EXHAUSTIVE_KNN_MAX_CHUNKS = int(os.getenv("EXHAUSTIVE_KNN_MAX_CHUNKS", 1000))
+# HNSW parameters of new indexes: number of links per vector in the graph (4-10), and
+# number of candidates kept while building the graph and while searching it (100-1000)
+HNSW_M = int(os.getenv("HNSW_M", 4))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 400))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 500))
+# Vector compression of new indexes: "none" (full-precision vectors) or "scalar": int8
+# vectors in the vector index, 4 times smaller, searched for VECTOR_OVERSAMPLING times
+# more candidates which are rescored with the full-precision vectors
+NO_COMPRESSION = "none"
+SCALAR_QUANTIZATION = "scalar"
+VECTOR_COMPRESSIONS = [NO_COMPRESSION, SCALAR_QUANTIZATION]
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", NO_COMPRESSION).lower()
+VECTOR_OVERSAMPLING = float(os.getenv("VECTOR_OVERSAMPLING", 4))
+# Store a retrievable copy of the vectors besides the vector index; vectors are never
+# returned by searches, so "false" saves that storage
+VECTOR_STORED = os.getenv("VECTOR_STORED", "true").lower() == "true"
+
+# Vector stores by ID, with the version of their sheet (see utils.cache.sheet_version),
+# reused across requests until the sheet is reindexed or deleted on any worker
+_vector_stores = {}
+
+
+def get_embedding_model() -> str:
+    """Embedding model of the configured embedding source."""
+    if EMBEDDING_SOURCE.lower() == "huggingface":
+        return os.getenv("MODEL_EMBEDDINGS_LOCAL", DEFAULT_HUGGING_FACE_MODEL)
+    return os.environ["MODEL_EMBEDDINGS"]
+
 
 def googleid_to_vectorstoreid(googleid: str) -> str:
     """
@@ -50,6 +137,162 @@ def googleid_to_vectorstoreid(googleid: str) -> str:
     return googleid
 
 
+def category_filter(
+    category_id: int = None, subcategory_id: int = None, duplicates: bool = False
+) -> str:
+    """
+    Filter expression (OData) of documents of a category and/or subcategory, None if
+    neither; with duplicates, of documents with near-duplicates of the category and/or
+    subcategory.
+    """
+    clauses = []
+    if category_id is not None:
+        clauses.append(
+            f"{dm.DUPLICATE_CATEGORIES}/any(c: c eq {int(category_id)})"
+            if duplicates
+            else f"{dm.CATEGORY} eq {int(category_id)}"
+        )
+    if subcategory_id is not None:
+        clauses.append(
+            f"{dm.DUPLICATE_SUBCATEGORIES}/any(s: s eq {int(subcategory_id)})"
+            if duplicates
+            else f"{dm.SUBCATEGORY} eq {int(subcategory_id)}"
+        )
+    return " and ".join(clauses) or None
+
+
+def in_category(row: dict, category_id: int = None, subcategory_id: int = None) -> bool:
+    """Whether a row is of the given category and/or subcategory"""
+    return (category_id is None or row[dm.CATEGORY] == category_id) and (
+        subcategory_id is None or row[dm.SUBCATEGORY] == subcategory_id
+    )
+
+
+@dataclasses.dataclass
+class VectorSearchSettings:
+    """Vector search algorithm of an index, its HNSW parameters and vector compression"""
+
+    algorithm: str = VECTOR_SEARCH_ALGORITHM
+    m: int = HNSW_M
+    ef_construction: int = HNSW_EF_CONSTRUCTION
+    ef_search: int = HNSW_EF_SEARCH
+    compression: str = VECTOR_COMPRESSION
+    oversampling: float = VECTOR_OVERSAMPLING
+    stored: bool = VECTOR_STORED
+
+    @classmethod
+    def from_index(cls, index: SearchIndex) -> VectorSearchSettings:
+        """Settings of an existing index, None if it has no vector search configuration"""
+        vector_search = index.vector_search
+        if not vector_search or not vector_search.algorithms:
+            return None
+        algorithm = vector_search.algorithms[0]
+        settings = cls(algorithm=HNSW)
+        if algorithm.kind == VectorSearchAlgorithmKind.EXHAUSTIVE_KNN:
+            settings.algorithm = EXHAUSTIVE
+        elif algorithm.parameters:
+            settings.m = algorithm.parameters.m
+            settings.ef_construction = algorithm.parameters.ef_construction
+            settings.ef_search = algorithm.parameters.ef_search
+        compressions = vector_search.compressions or []
+        settings.compression = SCALAR_QUANTIZATION if compressions else NO_COMPRESSION
+        if compressions and compressions[0].rescoring_options:
+            settings.oversampling = compressions[
+                0
+            ].rescoring_options.default_oversampling
+        vector_field = next(
+            (field for field in index.fields if field.name == "content_vector"), None
+        )
+        settings.stored = vector_field is None or vector_field.stored is not False
+        return settings
+
+    def resolve(self, n_chunks: int) -> VectorSearchSettings:
+        """Settings of an index of n_chunks chunks: "auto" is replaced by the algorithm to use"""
+        if self.algorithm != AUTO:
+            return self
+        algorithm = EXHAUSTIVE if n_chunks <= EXHAUSTIVE_KNN_MAX_CHUNKS else HNSW
+        return dataclasses.replace(self, algorithm=algorithm)
+
+    @property
+    def profile_name(self) -> str:
+        return "ExhaustiveKnnProfile" if self.algorithm == EXHAUSTIVE else "HnswProfile"
+
+    def to_vector_search(self) -> VectorSearch:
+        """Vector search configuration of an index, HNSW unless exhaustive"""
+        if self.algorithm == EXHAUSTIVE:
+            algorithm = ExhaustiveKnnAlgorithmConfiguration(
+                name="ExhaustiveKnn",
+                kind=VectorSearchAlgorithmKind.EXHAUSTIVE_KNN,
+                parameters=ExhaustiveKnnParameters(
+                    metric=VectorSearchAlgorithmMetric.COSINE
+                ),
+            )
+        else:
+            algorithm = HnswAlgorithmConfiguration(
+                name="Hnsw",
+                kind=VectorSearchAlgorithmKind.HNSW,
+                parameters=HnswParameters(
+                    m=self.m,
+                    ef_construction=self.ef_construction,
+                    ef_search=self.ef_search,
+                    metric=VectorSearchAlgorithmMetric.COSINE,
+                ),
+            )
+        compressions = []
+        if self.compression == SCALAR_QUANTIZATION:
+            compressions.append(
+                ScalarQuantizationCompression(
+                    compression_name="ScalarQuantization",
+                    parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                    # rescore the candidates with the full-precision vectors
+                    rescoring_options=RescoringOptions(
+                        enable_rescoring=True,
+                        default_oversampling=self.oversampling,
+                        rescore_storage_method="preserveOriginals",
+                    ),
+                )
+            )
+        return VectorSearch(
+            algorithms=[algorithm],
+            profiles=[
+                VectorSearchProfile(
+                    name=self.profile_name,
+                    algorithm_configuration_name=algorithm.name,
+                    compression_name=(
+                        compressions[0].compression_name if compressions else None
+                    ),
+                )
+            ],
+            compressions=compressions or None,
+        )
+
+    def matches(self, index: SearchIndex) -> bool:
+        """Whether an existing index has these settings"""
+        vector_search = index.vector_search
+        algorithms = vector_search.algorithms if vector_search else None
+        if not algorithms:
+            return False
+        compressions = vector_search.compressions or []
+        if [compression.compression_name for compression in compressions] != (
+            ["ScalarQuantization"] if self.compression == SCALAR_QUANTIZATION else []
+        ):
+            return False
+        vector_field = next(
+            (field for field in index.fields if field.name == "content_vector"), None
+        )
+        # stored is not set on fields of indexes created without it, which are stored
+        if vector_field is None or (vector_field.stored is not False) != self.stored:
+            return False
+        if self.algorithm == EXHAUSTIVE:
+            return algorithms[0].kind == VectorSearchAlgorithmKind.EXHAUSTIVE_KNN
+        parameters = algorithms[0].parameters
+        return algorithms[0].kind == VectorSearchAlgorithmKind.HNSW and (
+            parameters.m,
+            parameters.ef_construction,
+            parameters.ef_search,
+        ) == (self.m, self.ef_construction, self.ef_search)
+
+
 class VectorStore:
     """
     Vector storage for chunked documents and embeddings
@@ -67,14 +310,32 @@ class VectorStore:
         embedding_source: str = None,
         embedding_model: str = None,
         store_id: str = "chunked_document_embeddings",
+        vector_search_settings: VectorSearchSettings = None,
+        dimensions: int = None,
+        google_sheet_id: str = None,
     ):
         self.store_id = store_id
+        # sheet whose Azure OpenAI budget the embeddings of the store use
+        self.google_sheet_id = google_sheet_id or store_id
+        # used when (re)creating the index; existing indexes keep their own
+        self.vector_search_settings = vector_search_settings or VectorSearchSettings()
         self.embedding_source = embedding_source
         self.embedding_model = embedding_model
         self.store_service = store_service
         self.store_password = store_password
         self.store_path = store_path
+        # whether the index is known to exist and contain documents
+        self.exists = False
+        # names of the fields of the index, and whether it has typed fields, or only the
+        # JSON metadata of older indexes
+        self._index_field_names = None
+        self._typed_schema = None
+        # known when importing a snapshot, else measured by embedding a text
+        self._dimensions = dimensions
         self.embedder = self._set_embedder()
+        self.batcher = get_embedding_batcher(
+            self.embedding_source, self.embedding_model, self.embedder
+        )
         self.client = self._set_client()
         self.langchain_client = self._set_langchain_client()
 
@@ -83,16 +344,18 @@ class VectorStore:
         If no embedding model is given, a default model is used.
         """
         if self.embedding_source.lower() == "openai":
+            from langchain_openai import AzureOpenAIEmbeddings
+
             return AzureOpenAIEmbeddings(
                 azure_endpoint=os.environ["OPENAI_ENDPOINT"],
                 deployment=self.embedding_model,
-                chunk_size=1,
+                chunk_size=OPENAI_EMBEDDING_CHUNK_SIZE,
             )
 
         elif self.embedding_source.lower() == "huggingface":
             if self.embedding_model is None:
                 self.embedding_model = DEFAULT_HUGGING_FACE_MODEL
-            return HuggingFaceEmbeddings(model_name=self.embedding_model)
+            return get_local_embeddings(self.embedding_model)
 
         else:
             raise HTTPException(
@@ -100,11 +363,19 @@ class VectorStore:
                 detail=f"Embedding source {self.embedding_source} not available. Only embedding models from 'HuggingFace' or 'OpenAI' are currently available.",
             )
 
-    def _create_azuresearch_index(self):
-        """Create a new index in Azure Search"""
-        client = SearchIndexClient(
-            self.store_path, AzureKeyCredential(self.store_password)
-        )
+    @property
+    def dimensions(self) -> int:
+        """Number of dimensions of the embeddings"""
+        if self._dimensions is None:
+            self._dimensions = len(self.embed_query("Text"))
+        return self._dimensions
+
+    def _index_fields(self) -> List[SearchField]:
+        """
+        Fields of the index: the content, its vector (searchable, retrievable if stored
+        for snapshots, but never selected by searches), typed metadata fields, and the
+        JSON of all metadata, written by LangChain
+        """
         fields = [
             SimpleField(
                 name="id",
@@ -121,38 +392,95 @@ class VectorStore:
                 name="content_vector",
                 type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
                 searchable=True,
-                vector_search_dimensions=len(self.embedder.embed_query("Text")),
-                vector_search_profile_name="HnswProfile",
+                hidden=not self.vector_search_settings.stored,
+                stored=self.vector_search_settings.stored,
+                vector_search_dimensions=self.dimensions,
+                vector_search_profile_name=self.vector_search_settings.profile_name,
             ),
-            SearchableField(
+            SimpleField(
                 name="metadata",
                 type=SearchFieldDataType.String,
-                searchable=True,
             ),
         ]
-        vector_search = VectorSearch(
-            algorithms=[
-                HnswAlgorithmConfiguration(
-                    name="Hnsw",
-                    kind=VectorSearchAlgorithmKind.HNSW,
-                    parameters=HnswParameters(
-                        m=4,
-                        ef_construction=400,
-                        ef_search=500,
-                        metric=VectorSearchAlgorithmMetric.COSINE,
-                    ),
+        for name in INTEGER_FIELDS:
+            fields.append(
+                SimpleField(
+                    name=name,
+                    type=SearchFieldDataType.Int32,
+                    filterable=True,
+                    sortable=name in [dm.GOOGLE_INDEX, dm.NTH_CHUNK],
                 )
-            ],
-            profiles=[
-                VectorSearchProfile(
-                    name="HnswProfile",
-                    algorithm_configuration_name="Hnsw",
+            )
+        for name in STRING_FIELDS:
+            fields.append(
+                SimpleField(name=name, type=SearchFieldDataType.String, filterable=True)
+            )
+        for name in RETRIEVABLE_FIELDS + [dm.DUPLICATES]:
+            fields.append(SimpleField(name=name, type=SearchFieldDataType.String))
+        for name in DUPLICATE_CATEGORY_FIELDS:
+            fields.append(
+                SimpleField(
+                    name=name,
+                    type=SearchFieldDataType.Collection(SearchFieldDataType.Int32),
+                    filterable=True,
                 )
-            ],
+            )
+        return fields
+
+    def _vector_search(self) -> VectorSearch:
+        """Vector search configuration of the index"""
+        return self.vector_search_settings.to_vector_search()
+
+    def _create_azuresearch_index(self):
+        """Create a new index in Azure Search"""
+        client = SearchIndexClient(
+            self.store_path, AzureKeyCredential(self.store_password)
         )
+        fields = self._index_fields()
         client.create_index(
-            SearchIndex(name=self.store_id, fields=fields, vector_search=vector_search)
+            SearchIndex(
+                name=self.store_id,
+                fields=fields,
+                vector_search=self._vector_search(),
+            )
         )
+        self._index_field_names = {field.name for field in fields}
+        self._typed_schema = True
+
+    @property
+    def index_field_names(self) -> set:
+        """Names of the fields of the index"""
+        if self._index_field_names is None:
+            index_client = SearchIndexClient(
+                self.store_path, AzureKeyCredential(self.store_password)
+            )
+            index = index_client.get_index(self.store_id)
+            self._index_field_names = {field.name for field in index.fields}
+        return self._index_field_names
+
+    @property
+    def typed_schema(self) -> bool:
+        """Whether the index has typed fields; indexes created before only have the JSON metadata"""
+        if self._typed_schema is None:
+            self._typed_schema = dm.GOOGLE_INDEX in self.index_field_names
+            if not self._typed_schema:
+                logger.warning(
+                    f"Vector store {self.store_id} has no typed fields, recreate it to speed up reads."
+                )
+        return self._typed_schema
+
+    @property
+    def stores_duplicates(self) -> bool:
+        """Whether the index has the fields of near-duplicates; indexes created before do not"""
+        return dm.DUPLICATES in self.index_field_names
+
+    def _has_vector_search_settings(self) -> bool:
+        """Whether the index was created with the vector search settings of this vector store"""
+        index_client = SearchIndexClient(
+            self.store_path, AzureKeyCredential(self.store_password)
+        )
+        index = index_client.get_index(self.store_id)
+        return self.vector_search_settings.matches(index)
 
     def _set_client(self):
         """Sets the vector store client"""
@@ -179,14 +507,89 @@ class VectorStore:
             new_metadatas.append(new_metadata)
         return new_metadatas
 
+    @staticmethod
+    def _to_field_values(metadata: dict, page_content: str) -> dict:
+        """
+        Convert metadata to the types of the index fields, with None for missing values
+        (e.g. NaN slugs and parents of sheet rows), and add the hash of the content
+        """
+        new_metadata = dict(metadata)
+        for name in INTEGER_FIELDS:
+            new_metadata[name] = (
+                None if pd.isna(metadata.get(name)) else int(metadata[name])
+            )
+        for name in STRING_FIELDS + RETRIEVABLE_FIELDS:
+            value = metadata.get(name)
+            new_metadata[name] = None if pd.isna(value) or value == "" else str(value)
+        new_metadata[dm.CONTENT_HASH] = uuid_hash(page_content)
+        # only the fields needed to build search results of the rows of near-duplicates
+        duplicates = [
+            {
+                name: value
+                for name, value in VectorStore._to_field_values(duplicate, "").items()
+                if name in RESULT_FIELDS
+            }
+            for duplicate in metadata.get(dm.DUPLICATES) or []
+        ]
+        new_metadata[dm.DUPLICATES] = json.dumps(duplicates) if duplicates else None
+        new_metadata[dm.DUPLICATE_CATEGORIES] = sorted(
+            {row[dm.CATEGORY] for row in duplicates if row[dm.CATEGORY] is not None}
+        )
+        new_metadata[dm.DUPLICATE_SUBCATEGORIES] = sorted(
+            {
+                row[dm.SUBCATEGORY]
+                for row in duplicates
+                if row[dm.SUBCATEGORY] is not None
+            }
+        )
+        return new_metadata
+
+    def embed_query(
+        self, query: str, timeout: float = None, priority: int = INTERACTIVE
+    ) -> List[float]:
+        """
+        Embed a search query, from the embeddings cache if possible, waiting at most timeout
+        seconds. With Azure OpenAI, a query that is not cached first waits for the sheet's
+        and the global budget at the given priority, or fails with 429
+        """
+
+        def embed():
+            deadline = None if timeout is None else time.monotonic() + timeout
+            if self.embedding_source.lower() == "openai":
+                admission.admit(
+                    self.google_sheet_id,
+                    tokens=estimate_tokens(query),
+                    priority=priority,
+                    timeout=timeout,
+                )
+            with timed("query_embedding"):
+                return self.batcher.embed_query(
+                    query,
+                    timeout=(
+                        None
+                        if deadline is None
+                        else max(deadline - time.monotonic(), 0)
+                    ),
+                )
+
+        return embedding_cache.get_or_set(
+            query, embed, scope=f"{self.embedding_source}/{self.embedding_model}"
+        )
+
     def _set_langchain_client(self):
         """Set the vector store langchain client"""
         if self.store_service.lower() == "azuresearch":
+            from langchain_community.vectorstores.azuresearch import AzureSearch
+
+            # creates the index if it does not exist yet
             return AzureSearch(
                 azure_search_endpoint=self.store_path,
                 azure_search_key=self.store_password,
                 index_name=self.store_id,
-                embedding_function=self.embedder.embed_query,
+                embedding_function=self.embed_query,
+                fields=self._index_fields(),
+                vector_search=self._vector_search(),
+                vector_search_dimensions=self.dimensions,
             )
         else:
             raise HTTPException(
@@ -194,9 +597,11 @@ class VectorStore:
                 detail=f"Vector store {self.store_service} not available. Only 'azuresearch' are currently available.",
             )
 
-    def add_documents(self, chunked_documents: List[Document]) -> int:
+    def add_documents(
+        self, chunked_documents: List[Document], google_sheet_id: str = None
+    ) -> int:
         """
-        Add new incoming chunked documents to the vector store
+        Add new incoming chunked documents (of the given sheet) to the vector store
         If the collection/index specified by store_id is not empty, replace all content
         Add metadata regarding the embedding model
         """
@@ -206,16 +611,18 @@ class VectorStore:
             if self.store_service.lower() == "azuresearch":
                 n_docs_in_collection = self.client.get_document_count()
 
-            if n_docs_in_collection > 0:
+            # indexes without all fields (e.g. without typed fields) or with other
+            # vector search settings are recreated, even if empty
+            if (
+                n_docs_in_collection > 0
+                or not {field.name for field in self._index_fields()}
+                <= self.index_field_names
+                or not self._has_vector_search_settings()
+            ):
                 logger.info(
                     f"Vector store already contains {n_docs_in_collection} documents. Replacing everything."
                 )
-                if self.store_service.lower() == "azuresearch":
-                    index_client = SearchIndexClient(
-                        self.store_path, AzureKeyCredential(self.store_password)
-                    )
-                    index_client.delete_index(self.store_id)
-                    self._create_azuresearch_index()
+                self.recreate_index()
 
             n_docs_added = len(chunked_documents)
             logger.info(f"Adding {n_docs_added} new incoming chunked documents")
@@ -224,17 +631,72 @@ class VectorStore:
             ids = []
             for doc in chunked_documents:
                 documents.append(doc.page_content)
-                metadatas.append(doc.metadata)
+                metadatas.append(self._to_field_values(doc.metadata, doc.page_content))
                 ids.append(
                     f"{doc.metadata[dm.GOOGLE_INDEX]}_{doc.metadata[dm.NTH_CHUNK]}"
                 )
             metadatas = self._add_embedding_model_to_metadata(metadatas)
-            self.langchain_client.add_texts(
-                texts=documents, metadatas=metadatas, ids=ids
-            )
+            with timed("ingestion.embed"):
+                embeddings = self.embed_documents(documents, google_sheet_id)
+            with timed("ingestion.upload"):
+                count_outbound("azuresearch")
+                self.langchain_client.add_embeddings(
+                    zip(documents, embeddings), metadatas=metadatas, keys=ids
+                )
 
             return n_docs_added
 
+    def embed_documents(
+        self, texts: List[str], google_sheet_id: str = None
+    ) -> List[List[float]]:
+        """
+        Embed texts to index. With Azure OpenAI, each request of OPENAI_EMBEDDING_CHUNK_SIZE
+        texts waits for the sheet's and the global budget at background priority, so that
+        embedding a whole sheet yields to interactive requests
+        """
+        if self.embedding_source.lower() != "openai":
+            count_outbound(f"{self.embedding_source.lower()}_embeddings")
+            return self.embedder.embed_documents(texts)
+        embeddings = []
+        for start in range(0, len(texts), OPENAI_EMBEDDING_CHUNK_SIZE):
+            batch = texts[start : start + OPENAI_EMBEDDING_CHUNK_SIZE]
+            admission.admit(
+                google_sheet_id or self.google_sheet_id,
+                tokens=sum(estimate_tokens(text) for text in batch),
+                priority=BACKGROUND,
+            )
+            count_outbound("openai_embeddings")
+            embeddings.extend(self.embedder.embed_documents(batch))
+        return embeddings
+
+    def recreate_index(self):
+        """Delete the index and create it again, empty, with the current fields and settings"""
+        if self.store_service.lower() == "azuresearch":
+            index_client = SearchIndexClient(
+                self.store_path, AzureKeyCredential(self.store_password)
+            )
+            index_client.delete_index(self.store_id)
+            self._create_azuresearch_index()
+
+    def upload_documents(self, documents: List[dict]) -> int:
+        """
+        Upload documents with their vectors as they are, UPLOAD_BATCH_SIZE at a time,
+        e.g. of a snapshot; nothing is embedded
+        """
+        for start in range(0, len(documents), UPLOAD_BATCH_SIZE):
+            with timed("ingestion.upload"):
+                count_outbound("azuresearch")
+                results = self.client.upload_documents(
+                    documents=documents[start : start + UPLOAD_BATCH_SIZE]
+                )
+            failed = [result.key for result in results if not result.succeeded]
+            if failed:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Failed to upload {len(failed)} documents to {self.store_id}, e.g. {failed[0]}.",
+                )
+        return len(documents)
+
     def count_documents(self) -> int:
         """Count the number of documents in the vector store"""
         n_docs_in_collection = None
@@ -242,34 +704,183 @@ class VectorStore:
             n_docs_in_collection = self.client.get_document_count()
         return n_docs_in_collection
 
-    def get_documents(self) -> List[Document]:
-        """Get all documents from the vector store"""
-        if self.store_service.lower() == "azuresearch":
-            docs = [d for d in self.client.search(search_text="*")]
-        return docs
+    def get_documents(
+        self,
+        select: List[str] = RESULT_FIELDS,
+        filter: str = None,
+        page_size: int = GET_DOCUMENTS_PAGE_SIZE,
+    ) -> Iterator[dict]:
+        """
+        Get all documents from the vector store, or those matching an OData filter
+        (e.g. "nth_chunk eq 0"), with only the selected fields.
+        Documents are fetched lazily, page by page.
+        """
+        if not self.typed_schema:
+            yield from self._get_documents_from_metadata(select, filter)
+            return
+        skip = 0
+        while True:
+            with timed("get_documents"):
+                count_outbound("azuresearch")
+                page = list(
+                    self.client.search(
+                        search_text="*",
+                        select=select,
+                        filter=filter,
+                        order_by=[dm.GOOGLE_INDEX, dm.NTH_CHUNK],
+                        top=page_size,
+                        skip=skip,
+                    )
+                )
+            yield from page
+            if len(page) < page_size:
+                return
+            skip += page_size
+
+    def _get_documents_from_metadata(self, select: List[str], filter: str = None):
+        """get_documents of indexes without typed fields, which only supports "nth_chunk eq 0" filters"""
+        with timed("get_documents"):
+            count_outbound("azuresearch")
+            for doc in self.client.search(search_text="*", select=["metadata"]):
+                metadata = json.loads(doc["metadata"], strict=False)
+                if filter == f"{dm.NTH_CHUNK} eq 0" and metadata.get(dm.NTH_CHUNK):
+                    continue
+                yield {name: metadata.get(name) for name in select}
+
+    def get_rows(self) -> List[dict]:
+        """
+        First chunk of each row (question), with the fields needed to build search results,
+        including the rows of near-duplicates merged into other chunks, by row
+        """
+        if not self.stores_duplicates:
+            return list(self.get_documents(filter=f"{dm.NTH_CHUNK} eq 0"))
+        rows = []
+        for doc in self.get_documents(
+            select=RESULT_FIELDS + [dm.DUPLICATES],
+            filter=f"{dm.NTH_CHUNK} eq 0 or {dm.DUPLICATE_CATEGORIES}/any()",
+        ):
+            duplicates = doc.pop(dm.DUPLICATES)
+            if doc[dm.NTH_CHUNK] == 0:
+                rows.append(doc)
+            for row in json.loads(duplicates) if duplicates else []:
+                if row[dm.NTH_CHUNK] == 0:
+                    rows.append(row)
+        rows.sort(key=lambda row: row[dm.GOOGLE_INDEX])
+        return rows
+
+    def _search_kwargs(self) -> dict:
+        """Return only the typed fields needed for results, not the JSON metadata nor the vector"""
+        if not self.typed_schema:
+            return {}
+        select = ["id", "content"] + RESULT_FIELDS
+        if self.stores_duplicates:
+            select.append(dm.DUPLICATES)
+        return {"select": select}
 
     def similarity_search(self, query: str, k: int) -> List[Document]:
         """Search for similar documents in the vector store"""
-        return self.langchain_client.similarity_search(query=query, k=k)
+        with timed("vector_search"):
+            count_outbound("azuresearch")
+            return self.langchain_client.similarity_search(
+                query=query, k=k, **self._search_kwargs()
+            )
 
     def similarity_search_with_score(
-        self, query: str, k: int
+        self, query: str, k: int, category_id: int = None, subcategory_id: int = None
     ) -> List[(Document, float)]:
-        """Search for similar documents in the vector store and return with scores"""
-        return self.langchain_client.similarity_search_with_score(query=query, k=k)
+        """
+        Search for similar documents in the vector store and return with scores.
+        If a category and/or subcategory is given, only its documents are searched:
+        the filter is applied by Azure Search before the vector search (prefilter).
+        Documents with near-duplicates of the category and/or subcategory are searched
+        too, and returned as the first of these near-duplicates.
+        """
+        filters = category_filter(category_id, subcategory_id)
+        if filters and not self.typed_schema:
+            return self._filtered_search_legacy(query, k, category_id, subcategory_id)
+        kwargs = self._search_kwargs()
+        if filters:
+            if self.stores_duplicates:
+                duplicate_filters = category_filter(
+                    category_id, subcategory_id, duplicates=True
+                )
+                filters = f"({filters}) or ({duplicate_filters})"
+            kwargs.update(filters=filters, vector_filter_mode="preFilter")
+        with timed("vector_search"):
+            count_outbound("azuresearch")
+            docs_and_scores = self.langchain_client.similarity_search_with_score(
+                query=query, k=k, **kwargs
+            )
+        if filters and self.stores_duplicates:
+            return self._resolve_duplicates(
+                docs_and_scores, category_id, subcategory_id
+            )
+        return docs_and_scores
+
+    @staticmethod
+    def _resolve_duplicates(
+        docs_and_scores: List[(Document, float)], category_id: int, subcategory_id: int
+    ) -> List[(Document, float)]:
+        """Return documents not of the category and/or subcategory as their first near-duplicate that is"""
+        resolved = []
+        for doc, score in docs_and_scores:
+            if not in_category(doc.metadata, category_id, subcategory_id):
+                duplicates = json.loads(doc.metadata.get(dm.DUPLICATES) or "[]")
+                row = next(
+                    (
+                        row
+                        for row in duplicates
+                        if in_category(row, category_id, subcategory_id)
+                    ),
+                    None,
+                )
+                # e.g. near-duplicates of the category and others of the subcategory
+                if row is None:
+                    continue
+                doc.metadata.update(row)
+            resolved.append((doc, score))
+        return resolved
+
+    def _filtered_search_legacy(
+        self, query: str, k: int, category_id: int, subcategory_id: int
+    ) -> List[(Document, float)]:
+        """
+        Filtered search in an index without typed fields, which cannot be filtered:
+        over-fetch and filter the results (until the index is recreated)
+        """
+        logger.warning(
+            f"Index {self.store_id} has no typed fields, filtering search results after the search"
+        )
+        with timed("vector_search"):
+            count_outbound("azuresearch")
+            docs_and_scores = self.langchain_client.similarity_search_with_score(
+                query=query, k=k * LEGACY_FILTER_OVERFETCH
+            )
+        return [
+            (doc, score)
+            for doc, score in docs_and_scores
+            if in_category(doc.metadata, category_id, subcategory_id)
+        ][:k]
 
 
 def create_vector_store_index(
-    document_type: str, document_id: str, document_data: dict
+    document_type: str,
+    document_id: str,
+    document_data: dict,
+    vector_search_settings: VectorSearchSettings = None,
 ):
-    """Create vector store index in Azure Search and return it."""
+    """
+    Create vector store index in Azure Search and return it, with the given vector
+    search settings (by default those of the environment variables).
+    """
     # load documents from Google Sheet
     doc_loader = DocumentLoader(
         document_type=document_type,
         document_id=document_id,
         document_data=document_data,
     )
-    docs = doc_loader.load()
+    with timed("ingestion.load"):
+        docs = doc_loader.load()
 
     if len(docs) == 0:
         raise HTTPException(
@@ -278,46 +889,97 @@ def create_vector_store_index(
         )
 
     document_chunker = DocumentChunker(
-        chunking_strategy="TokenizedSentenceSplitting",
-        kwargs={"chunk_overlap": 20, "chunk_size": 256},
+        chunking_strategy=CHUNKING_STRATEGY, kwargs=CHUNKING_KWARGS
+    )
+    with timed("ingestion.chunk"):
+        docs = document_chunker.split_documents(documents=docs)
+
+    # embed and index near-duplicate chunks once
+    if DEDUPLICATION_ENABLED:
+        n_chunks = len(docs)
+        deduplicator = ChunkDeduplicator(
+            threshold=DEDUPLICATION_THRESHOLD, shingle_size=DEDUPLICATION_SHINGLE_SIZE
+        )
+        with timed("ingestion.deduplicate"):
+            docs = deduplicator.deduplicate(docs)
+        DEDUPLICATED_CHUNKS.add(n_chunks - len(docs))
+        logger.info(
+            f"Merged {n_chunks - len(docs)} near-duplicate chunks of {document_id}: "
+            f"embedding {len(docs)} of {n_chunks} chunks "
+            f"({(n_chunks - len(docs)) / n_chunks:.0%} fewer embeddings and vectors)."
+        )
+
+    vector_search_settings = (vector_search_settings or VectorSearchSettings()).resolve(
+        len(docs)
     )
-    docs = document_chunker.split_documents(documents=docs)
 
     # add documents to vector store
     vector_store = VectorStore(
         store_path=os.environ["VECTOR_STORE_ADDRESS"],
         store_service="azuresearch",
         store_password=os.environ["VECTOR_STORE_PASSWORD"],
-        embedding_source="OpenAI",
-        embedding_model=os.environ["MODEL_EMBEDDINGS"],
+        embedding_source=EMBEDDING_SOURCE,
+        embedding_model=get_embedding_model(),
         store_id=googleid_to_vectorstoreid(document_id),
+        vector_search_settings=vector_search_settings,
+        google_sheet_id=document_id,
     )
-    n_docs = vector_store.add_documents(docs)
+    n_docs = vector_store.add_documents(docs, google_sheet_id=document_id)
+    register_vector_store(document_id, vector_store)
     logger.info(
-        f"Created vector store index {vector_store.store_id} with {n_docs} documents."
+        f"Created vector store index {vector_store.store_id} with {n_docs} documents "
+        f"({vector_search_settings.algorithm} vector search, "
+        f"{vector_search_settings.compression} compression)."
     )
     return vector_store
 
 
+def register_vector_store(google_sheet_id: str, vector_store: VectorStore):
+    """Use a newly filled vector store for the sheet's requests from now on."""
+    vector_store.exists = True
+    # cached answers, search results and hierarchies may be based on outdated content
+    answer_cache.invalidate(google_sheet_id)
+    invalidate_sheet(google_sheet_id)
+    _vector_stores[vector_store.store_id] = (
+        vector_store,
+        sheet_version(google_sheet_id),
+    )
+
+
 def get_vector_store(
     google_sheet_id: str, check_if_exists: bool = False
 ) -> VectorStore:
-    """Get vector store from Azure Search."""
+    """
+    Get vector store from Azure Search, reusing the clients of previous requests as long
+    as the sheet was not reindexed or deleted since, on this worker or any other.
+    """
     vector_store_id = googleid_to_vectorstoreid(google_sheet_id)
-    vector_store = VectorStore(
-        store_path=os.environ["VECTOR_STORE_ADDRESS"],
-        store_service="azuresearch",
-        store_password=os.environ["VECTOR_STORE_PASSWORD"],
-        embedding_source="OpenAI",
-        embedding_model=os.environ["MODEL_EMBEDDINGS"],
-        store_id=vector_store_id,
-    )
-    # if index is not found, create it
-    if check_if_exists and vector_store.count_documents() == 0:
-        logger.info(f"Vector store {vector_store_id} not found. Creating new one.")
-        vector_store = create_vector_store_index(
-            document_type="googlesheet",
-            document_id=google_sheet_id,
-            document_data={},
+    version = sheet_version(google_sheet_id)
+    vector_store, registered_version = _vector_stores.get(vector_store_id, (None, None))
+    if vector_store is None or registered_version != version:
+        vector_store = VectorStore(
+            store_path=os.environ["VECTOR_STORE_ADDRESS"],
+            store_service="azuresearch",
+            store_password=os.environ["VECTOR_STORE_PASSWORD"],
+            embedding_source=EMBEDDING_SOURCE,
+            embedding_model=get_embedding_model(),
+            store_id=vector_store_id,
+            google_sheet_id=google_sheet_id,
         )
+        _vector_stores[vector_store_id] = (vector_store, version)
+    # if index is not found, create it
+    if check_if_exists and not vector_store.exists:
+        if vector_store.count_documents() == 0:
+            logger.info(f"Vector store {vector_store_id} not found. Creating new one.")
+            vector_store = create_vector_store_index(
+                document_type="googlesheet",
+                document_id=google_sheet_id,
+                document_data={},
+            )
+        vector_store.exists = True
     return vector_store
+
+
+def forget_vector_store(google_sheet_id: str):
+    """Drop the vector store of a sheet from the registry, e.g. after its index is deleted."""
+    _vector_stores.pop(googleid_to_vectorstoreid(google_sheet_id), None)
@@ -0,0 +1,278 @@
+from __future__ import annotations
+import argparse
+import dataclasses
+import json
+import sys
+import time
+import zipfile
+from typing import BinaryIO, List
+import numpy as np
+from fastapi import HTTPException
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.indexes import SearchIndexClient
+from utils.logger import logger
+from utils.metrics import timed
+from utils.constants import DocumentMetadata
+from utils.vector_store import (
+    VectorStore,
+    VectorSearchSettings,
+    get_vector_store,
+    get_embedding_model,
+    googleid_to_vectorstoreid,
+    register_vector_store,
+    EMBEDDING_SOURCE,
+    INTEGER_FIELDS,
+    STRING_FIELDS,
+    RETRIEVABLE_FIELDS,
+    DUPLICATE_CATEGORY_FIELDS,
+)
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+dm = DocumentMetadata()
+
+# Version of the snapshots written by export_vector_store
+SNAPSHOT_FORMAT_VERSION = 1
+VECTOR_FIELD = "content_vector"
+# Typed fields, derived from the JSON metadata in snapshots of indexes without them
+TYPED_FIELDS = (
+    INTEGER_FIELDS
+    + STRING_FIELDS
+    + RETRIEVABLE_FIELDS
+    + [dm.DUPLICATES]
+    + DUPLICATE_CATEGORY_FIELDS
+)
+
+
+def _get_index_client() -> SearchIndexClient:
+    return SearchIndexClient(
+        os.environ["VECTOR_STORE_ADDRESS"],
+        AzureKeyCredential(os.environ["VECTOR_STORE_PASSWORD"]),
+    )
+
+
+def _to_array(content) -> np.ndarray:
+    """JSON of content as bytes, to be stored in an NPZ file without pickling"""
+    return np.frombuffer(json.dumps(content).encode(), dtype=np.uint8)
+
+
+def _from_array(array: np.ndarray):
+    return json.loads(array.tobytes().decode())
+
+
+def _make_vectors_retrievable(
+    index_client: SearchIndexClient, index, make_retrievable: bool = False
+) -> bool:
+    """
+    Check that the vectors of an index can be exported. Indexes created before snapshots
+    existed have hidden vectors: their schema is only changed to make them retrievable
+    if make_retrievable is set. Return whether it was changed.
+    """
+    vector_field = next(field for field in index.fields if field.name == VECTOR_FIELD)
+    if vector_field.stored is False:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Vectors of {index.name} are not stored, it cannot be exported. Create it again with stored vectors.",
+        )
+    if not getattr(vector_field, "hidden", False):
+        return False
+    if not make_retrievable:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Vectors of {index.name} are hidden. Export it with makeRetrievable to make them retrievable, which changes the schema of the index.",
+        )
+    logger.warning(f"Making the vectors of {index.name} retrievable, to export them.")
+    vector_field.hidden = False
+    index_client.create_or_update_index(index)
+    return True
+
+
+def export_vector_store(
+    google_sheet_id: str, file: BinaryIO, make_retrievable: bool = False
+) -> dict:
+    """
+    Write a snapshot of the vector store of a sheet to a file (NPZ): its vectors as a
+    float32 matrix, the other fields of its documents as JSON columns, and a manifest
+    of the embedding model and vector search settings. Return the manifest, which tells
+    whether hidden vectors were made retrievable (only if make_retrievable is set).
+    """
+    store_id = googleid_to_vectorstoreid(google_sheet_id)
+    index_client = _get_index_client()
+    try:
+        index = index_client.get_index(store_id)
+    except Exception:
+        raise HTTPException(
+            status_code=404, detail=f"Vector store {store_id} not found."
+        )
+    made_retrievable = _make_vectors_retrievable(index_client, index, make_retrievable)
+    vector_store = get_vector_store(google_sheet_id)
+    names = [field.name for field in index.fields]
+
+    with timed("snapshot.export"):
+        if vector_store.typed_schema:
+            documents = list(vector_store.get_documents(select=names))
+        else:
+            documents = list(vector_store.client.search(search_text="*", select=names))
+        if not documents:
+            raise HTTPException(
+                status_code=400, detail=f"Vector store {store_id} is empty."
+            )
+        vectors = np.asarray([doc[VECTOR_FIELD] for doc in documents], dtype=np.float32)
+        columns = {
+            name: [doc.get(name) for doc in documents]
+            for name in names
+            if name != VECTOR_FIELD
+        }
+        # the model the documents were embedded with, not necessarily the configured one
+        metadata = json.loads(documents[0].get("metadata") or "{}", strict=False)
+        settings = VectorSearchSettings.from_index(index)
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "google_sheet_id": google_sheet_id,
+            "store_id": store_id,
+            "timestamp": time.time(),
+            "embedding_model": metadata.get(
+                dm.EMBEDDING_MODEL, vector_store.embedding_model
+            ),
+            "documents": len(documents),
+            "dimensions": int(vectors.shape[1]),
+            "vector_search": dataclasses.asdict(settings) if settings else None,
+            "vectors_made_retrievable": made_retrievable,
+        }
+        np.savez_compressed(
+            file,
+            manifest=_to_array(manifest),
+            columns=_to_array(columns),
+            vectors=vectors,
+        )
+    logger.info(f"Exported {len(documents)} documents of vector store {store_id}.")
+    return manifest
+
+
+def _to_documents(columns: dict, vectors: np.ndarray, field_names: set) -> List[dict]:
+    """Documents of a snapshot, with only the fields of the index they are imported into"""
+    documents = []
+    for ix in range(len(vectors)):
+        doc = {name: values[ix] for name, values in columns.items()}
+        # snapshots of indexes without typed fields: derive them from the JSON metadata
+        if dm.GOOGLE_INDEX not in columns:
+            field_values = VectorStore._to_field_values(
+                json.loads(doc["metadata"], strict=False), doc["content"]
+            )
+            doc.update({name: field_values[name] for name in TYPED_FIELDS})
+        doc[VECTOR_FIELD] = vectors[ix].tolist()
+        documents.append(
+            {name: value for name, value in doc.items() if name in field_names}
+        )
+    return documents
+
+
+def import_vector_store(google_sheet_id: str, file: BinaryIO) -> tuple:
+    """
+    Replace the vector store of a sheet (by default the exported one) with a snapshot
+    written by export_vector_store, with the vector search settings of the exported
+    index. Nothing is loaded, translated nor embedded. Return the vector store and
+    the sheet.
+    """
+    try:
+        with np.load(file, allow_pickle=False) as snapshot:
+            manifest = _from_array(snapshot["manifest"])
+            columns = _from_array(snapshot["columns"])
+            vectors = snapshot["vectors"]
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot: {e}")
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported snapshot format {manifest.get('format_version')}.",
+        )
+    # queries must be embedded with the model of the vectors
+    if manifest["embedding_model"] != get_embedding_model():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Snapshot was embedded with {manifest['embedding_model']}, but queries are embedded with {get_embedding_model()}.",
+        )
+    google_sheet_id = google_sheet_id or manifest["google_sheet_id"]
+    vector_search_settings = (
+        VectorSearchSettings(**manifest["vector_search"])
+        if manifest["vector_search"]
+        else VectorSearchSettings().resolve(len(vectors))
+    )
+
+    vector_store = VectorStore(
+        store_path=os.environ["VECTOR_STORE_ADDRESS"],
+        store_service="azuresearch",
+        store_password=os.environ["VECTOR_STORE_PASSWORD"],
+        embedding_source=EMBEDDING_SOURCE,
+        embedding_model=get_embedding_model(),
+        store_id=googleid_to_vectorstoreid(google_sheet_id),
+        vector_search_settings=vector_search_settings,
+        dimensions=int(vectors.shape[1]),
+        google_sheet_id=google_sheet_id,
+    )
+    with timed("snapshot.import"):
+        vector_store.recreate_index()
+        n_docs = vector_store.upload_documents(
+            _to_documents(columns, vectors, vector_store.index_field_names)
+        )
+    register_vector_store(google_sheet_id, vector_store)
+    logger.info(
+        f"Imported {n_docs} documents of {manifest['store_id']} into vector store {vector_store.store_id}."
+    )
+    return vector_store, google_sheet_id
+
+
+def main(argv: list = None):
+    """
+    Export or import a snapshot of a sheet's vector store, in the vector store of the
+    environment (VECTOR_STORE_ADDRESS and VECTOR_STORE_PASSWORD), e.g.
+        python -m utils.vector_store_snapshot export --google-sheet-id <ID> --output snapshot.npz
+        python -m utils.vector_store_snapshot import --input snapshot.npz
+    """
+    parser = argparse.ArgumentParser(
+        description="Export or import a snapshot of a sheet's vector store"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write a snapshot to a file")
+    export_parser.add_argument("--google-sheet-id", required=True)
+    export_parser.add_argument(
+        "--output", default=None, help="Path of the snapshot (default: <index>.npz)"
+    )
+    export_parser.add_argument(
+        "--make-retrievable",
+        action="store_true",
+        help="Make hidden vectors retrievable, changing the schema of the index",
+    )
+    import_parser = subparsers.add_parser("import", help="Import a snapshot file")
+    import_parser.add_argument(
+        "--google-sheet-id",
+        default=None,
+        help="Sheet to import into (default: the exported sheet)",
+    )
+    import_parser.add_argument("--input", required=True, help="Path of the snapshot")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "export":
+            path = (
+                args.output or f"{googleid_to_vectorstoreid(args.google_sheet_id)}.npz"
+            )
+            with open(path, "wb") as f:
+                manifest = export_vector_store(
+                    args.google_sheet_id, f, args.make_retrievable
+                )
+            if manifest["vectors_made_retrievable"]:
+                print(f"Made the vectors of {manifest['store_id']} retrievable")
+            print(f"Exported {manifest['documents']} documents to {path}")
+        else:
+            with open(args.input, "rb") as f:
+                vector_store, _ = import_vector_store(args.google_sheet_id, f)
+            print(f"Imported snapshot into vector store {vector_store.store_id}")
+    except HTTPException as e:
+        sys.exit(e.detail)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from __future__ import annotations
+import os
+import tiktoken
+from utils.logger import logger
+from utils.metrics import timed
+from utils.constants import TIKTOKEN_ENCODING
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Preload models and clients at startup, before accepting traffic
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "false").lower() == "true"
+# Comma-separated Google Sheet IDs whose vector store and chat settings are preloaded
+WARMUP_SHEET_IDS = [
+    sheet_id.strip()
+    for sheet_id in os.getenv("WARMUP_SHEET_IDS", "").split(",")
+    if sheet_id.strip()
+]
+
+
+def _warm_up_step(name: str, func, *args, **kwargs):
+    """Run a warmup step, logging instead of failing: the service can start without it."""
+    try:
+        with timed(f"startup.warmup.{name}"):
+            func(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"Warmup step {name} failed: {e}")
+
+
+def warm_up(sheet_ids: list = WARMUP_SHEET_IDS):
+    """
+    Preload everything that is otherwise loaded by the first requests:
+        1. tiktoken encoding and spaCy pipeline used for chunking and context packing
+        2. LLM client and agent graphs (connects to the checkpoint database)
+        3. Local embedding model, if used
+        4. Vector stores and chat settings of the given sheets
+    """
+    # imported here, to keep importing this module fast
+    from utils.document_chunker import DocumentChunker
+    from utils.vector_store import (
+        get_vector_store,
+        get_embedding_model,
+        CHUNKING_STRATEGY,
+        CHUNKING_KWARGS,
+        EMBEDDING_SOURCE,
+    )
+    from utils.local_embeddings import get_local_embeddings
+    from utils.prompt_loader import PromptLoader
+    from agents.rag_agent import get_llm, get_rag_agent, RETRIEVAL_MODES
+    from utils.checkpointer import CHECKPOINTER_CHAT_TWILIO, CHECKPOINTER_CHAT_DUMMY
+
+    _warm_up_step("tiktoken", tiktoken.get_encoding, TIKTOKEN_ENCODING)
+    _warm_up_step(
+        "spacy",
+        DocumentChunker,
+        chunking_strategy=CHUNKING_STRATEGY,
+        kwargs=CHUNKING_KWARGS,
+    )
+    _warm_up_step("llm", get_llm)
+    for mode in RETRIEVAL_MODES:
+        for checkpointer in {CHECKPOINTER_CHAT_TWILIO, CHECKPOINTER_CHAT_DUMMY}:
+            _warm_up_step(
+                f"agent.{mode}.{checkpointer}", get_rag_agent, mode, checkpointer
+            )
+    if EMBEDDING_SOURCE.lower() == "huggingface":
+        _warm_up_step("embeddings", get_local_embeddings, get_embedding_model())
+    for sheet_id in sheet_ids:
+        _warm_up_step("vector_store", get_vector_store, sheet_id, check_if_exists=True)
+        _warm_up_step(
+            "chat_settings",
+            PromptLoader(document_type="googlesheet", document_id=sheet_id).get_prompt,
+        )